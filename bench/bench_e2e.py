@@ -0,0 +1,419 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings( 'ignore' )
+
+import os
+import time
+import json
+import shlex
+import socket
+import argparse
+import threading
+import subprocess
+
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# メモ
+# gw2・gw1 をループバックで起動し、ジョブ側の代役（エコー／読み捨て）を通して
+# gw2 のジョブ用ポートから N 本のチャネルを流して測る
+#   クライアント → gw2(ジョブ用ポート) → gw1 → 代役サーバ
+# frames_per_sec はクライアントが書き込んだ --size 単位の回数（rr では往復回数）
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 送り終えてから残りの応答を待つ時間（秒）
+DRAIN_TIMEOUT = 5.0
+
+@dataclass
+class Parameters:
+    clients: int
+    size: int
+    pattern: str
+    job: str
+    duration: float
+    warmup: float
+    base_port: int
+    gw1_args: List[str]
+    gw2_args: List[str]
+    output: str
+
+
+@dataclass
+class Result:
+    """クライアント1本の結果"""
+    sent: int = 0
+    received: int = 0
+    messages: int = 0
+    rtts: List[float] = field(default_factory=list)
+    error: str = ""
+
+
+class JobServer:
+    """ジョブ側の代役サーバ（echo: 受けたまま返す, sink: 読み捨てる）"""
+
+    def __init__(self, port: int, mode: str) -> None:
+        """コンストラクタ
+
+        Args:
+            port (int): 接続受付ポート番号
+            mode (str): echo / sink
+        """
+        self.mode: str = mode
+        self.received: int = 0
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(64)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self) -> None:
+        """接続受付"""
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn: socket.socket) -> None:
+        """1接続の処理"""
+        try:
+            while True:
+                data = conn.recv(262144)
+                if not data:
+                    break
+                with self.lock:
+                    self.received += len(data)
+                if self.mode == "echo":
+                    conn.sendall(data)
+        except OSError:
+            pass
+        conn.close()
+
+    def close(self) -> None:
+        """終了処理"""
+        self.sock.close()
+
+
+def main() -> None:
+
+    args = parse_args()
+    res = main_proc(args)
+    text = json.dumps(res, ensure_ascii=False)
+    if args.output != "":
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+    return
+
+
+def main_proc(args: Parameters) -> Dict[str, object]:
+    """計測処理
+
+    Args:
+        args (Parameters): 起動パラメータ
+
+    Returns:
+        Dict: 計測結果
+    """
+
+    if args.base_port > 0:
+        ctrl_port = args.base_port
+        job_port = args.base_port + 1
+        tgt_port = args.base_port + 2
+    else:
+        ctrl_port, job_port, tgt_port = free_ports(3)
+
+    srv = JobServer(tgt_port, args.job)
+    p2 = subprocess.Popen(
+        [sys.executable, "gw2.py", "--ctrl_port", str(ctrl_port), "--job_port", str(job_port), "--logfile", "bench"] + args.gw2_args,
+        cwd=os.path.join(ROOT, "gw2"))
+    time.sleep(0.5)
+    p1 = subprocess.Popen(
+        [sys.executable, "gw1.py", "--ctrl_ip", "127.0.0.1", "--ctrl_port", str(ctrl_port), "--job_port", str(tgt_port), "--logfile", "bench"] + args.gw1_args,
+        cwd=os.path.join(ROOT, "gw1"))
+    time.sleep(args.warmup)
+
+    try:
+        cpu0 = {"gw1": cpu_seconds(p1.pid), "gw2": cpu_seconds(p2.pid)}
+        results = [Result() for _ in range(args.clients)]
+        target = client_rr if args.pattern == "rr" else client_stream
+        ths = [threading.Thread(target=target, args=(args, job_port, r)) for r in results]
+        start = time.monotonic()
+        for th in ths:
+            th.start()
+        for th in ths:
+            th.join()
+        elapsed = time.monotonic() - start
+        sunk = srv.received
+        cpu1 = {"gw1": cpu_seconds(p1.pid), "gw2": cpu_seconds(p2.pid)}
+        alive = {"gw1": p1.poll() is None, "gw2": p2.poll() is None}
+    finally:
+        p1.kill()
+        p2.kill()
+        p1.wait()
+        p2.wait()
+        srv.close()
+
+    # 読み捨てではサーバへ届いた量、エコーではクライアントへ戻った量で測る
+    nbytes = sunk if args.job == "sink" else sum(r.received for r in results)
+    messages = sum(r.messages for r in results)
+    rtts = sorted(t for r in results for t in r.rtts)
+
+    cpu: Dict[str, object] = {}
+    for k in ("gw1", "gw2"):
+        if cpu0[k] is None or cpu1[k] is None:
+            cpu[k] = None
+        else:
+            sec = cpu1[k] - cpu0[k]
+            cpu[k] = {"sec": round(sec, 3), "pct": round(sec / elapsed * 100, 1)}
+
+    return {
+        "pattern": args.pattern,
+        "job": args.job,
+        "clients": args.clients,
+        "size": args.size,
+        "elapsed": round(elapsed, 3),
+        "bytes": nbytes,
+        "mb_per_sec": round(nbytes / 1048576 / elapsed, 3),
+        "frames_per_sec": round(messages / elapsed, 1),
+        "latency_ms": {
+            "p50": percentile(rtts, 50),
+            "p99": percentile(rtts, 99),
+        } if len(rtts) > 0 else None,
+        "cpu": cpu,
+        "alive": alive,
+        "errors": [r.error for r in results if r.error != ""],
+    }
+
+
+def client_stream(args: Parameters, port: int, res: Result) -> None:
+    """一方向に流し続けるクライアント（エコーなら戻りも数える）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        port (int): gw2 のジョブ用ポート番号
+        res (Result): 結果
+    """
+
+    payload = os.urandom(args.size)
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+    except OSError as e:
+        res.error = str(e)
+        return
+
+    def reader() -> None:
+        try:
+            while True:
+                data = sock.recv(262144)
+                if not data:
+                    break
+                res.received += len(data)
+        except OSError:
+            pass
+
+    th: Optional[threading.Thread] = None
+    if args.job == "echo":
+        sock.settimeout(DRAIN_TIMEOUT)
+        th = threading.Thread(target=reader, daemon=True)
+        th.start()
+
+    deadline = time.monotonic() + args.duration
+    try:
+        while time.monotonic() < deadline:
+            sock.sendall(payload)
+            res.sent += len(payload)
+            res.messages += 1
+    except OSError as e:
+        res.error = str(e)
+    if th is not None:
+        # 送った分が戻り切るまで待つ
+        end = time.monotonic() + DRAIN_TIMEOUT
+        while res.received < res.sent and time.monotonic() < end and th.is_alive():
+            time.sleep(0.01)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        th.join(DRAIN_TIMEOUT)
+    sock.close()
+
+    return
+
+
+def client_rr(args: Parameters, port: int, res: Result) -> None:
+    """要求・応答を繰り返すクライアント（往復時間を測る）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        port (int): gw2 のジョブ用ポート番号
+        res (Result): 結果
+    """
+
+    payload = os.urandom(args.size)
+    buf = bytearray(args.size)
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(DRAIN_TIMEOUT)
+    except OSError as e:
+        res.error = str(e)
+        return
+
+    deadline = time.monotonic() + args.duration
+    try:
+        with memoryview(buf) as mv:
+            while time.monotonic() < deadline:
+                t0 = time.perf_counter()
+                sock.sendall(payload)
+                got = 0
+                while got < args.size:
+                    n = sock.recv_into(mv[got:])
+                    if n == 0:
+                        raise ConnectionError("切断検知")
+                    got += n
+                res.rtts.append(time.perf_counter() - t0)
+                res.sent += args.size
+                res.received += got
+                res.messages += 1
+    except OSError as e:
+        res.error = str(e)
+    sock.close()
+
+    return
+
+
+def free_ports(num: int) -> List[int]:
+    """空いているポート番号を OS に選ばせる（連続して計測しても TIME_WAIT と衝突しない）"""
+    socks = []
+    for _ in range(num):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("0.0.0.0", 0))
+        socks.append(sock)
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """プロセスの CPU 時間（ユーザ＋システム、/proc のない環境では None）"""
+    try:
+        with open("/proc/" + str(pid) + "/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # ")" の後ろの 12, 13 番目が utime, stime
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """百分位数（ミリ秒、values は昇順）"""
+    idx = min(len(values) - 1, int(len(values) * pct / 100))
+    return round(values[idx] * 1000, 3)
+
+
+def parse_args() -> Parameters:
+    """コマンドライン引数解析処理
+
+    Returns:
+        Parameters: 解析結果格納オブジェクト
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=4,
+        help="同時に流すチャネル数",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=65536,
+        help="1回に書き込むデータサイズ（rr では要求・応答のサイズ）",
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        choices=["stream", "rr"],
+        default="stream",
+        help="負荷の形（stream: 流し続ける, rr: 要求・応答を繰り返す）",
+    )
+    parser.add_argument(
+        "--job",
+        type=str,
+        choices=["echo", "sink"],
+        default="echo",
+        help="ジョブ側の代役（echo: 受けたまま返す, sink: 読み捨てる、rr は echo のみ）",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=5.0,
+        help="計測時間（秒）",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=1.0,
+        help="gw1 起動から計測開始までの待ち時間（秒）",
+    )
+    parser.add_argument(
+        "--base_port",
+        type=int,
+        default=0,
+        help="使用するポート番号の先頭（制御用, ジョブ用, 代役サーバの3つ、0 なら空いている番号）",
+    )
+    parser.add_argument(
+        "--gw1_args",
+        type=str,
+        default="",
+        help="gw1 に渡す追加の引数",
+    )
+    parser.add_argument(
+        "--gw2_args",
+        type=str,
+        default="",
+        help="gw2 に渡す追加の引数",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="結果（JSON）の出力先ファイル",
+    )
+
+    args = parser.parse_args()
+
+    if args.pattern == "rr" and args.job != "echo":
+        parser.error("rr は --job echo のみ")
+
+    params = Parameters(
+        clients=args.clients,
+        size=args.size,
+        pattern=args.pattern,
+        job=args.job,
+        duration=args.duration,
+        warmup=args.warmup,
+        base_port=args.base_port,
+        gw1_args=shlex.split(args.gw1_args),
+        gw2_args=shlex.split(args.gw2_args),
+        output=args.output,
+    )
+
+    return params
+
+
+if __name__ == "__main__":
+    main()
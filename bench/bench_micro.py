@@ -0,0 +1,460 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings( 'ignore' )
+
+import os
+import time
+import json
+import socket
+import argparse
+import tempfile
+import threading
+import statistics
+
+from dataclasses import dataclass
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+# メモ
+# 電文1件あたりの処理（TelSocket の送受信、SocketSelect.select、Log.output）を
+# 単独で測り、保存した基準値と比べる
+# 値は 1回あたりのナノ秒（rounds 回のうち最速の回、ばらつきの目安に中央値も残す）
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 基準値の保存先
+BASELINE_DIR = os.path.join(ROOT, "bench", "baseline")
+
+# 電文サイズ
+FRAME_SIZES = [64, 4096, 65536]
+# 監視するソケット数
+SELECT_COUNTS = [10, 100, 1000]
+# ダンプするデータサイズ
+DUMP_SIZES = [16, 256, 4096, 65536]
+
+# 1件あたりの処理量の目安（これを電文サイズで割って繰り返し回数を決める）
+BYTES_PER_ROUND = 16777216
+
+@dataclass
+class Parameters:
+    gw: str
+    rounds: int
+    scale: float
+    filter: str
+    baseline: str
+    save: bool
+    threshold: float
+    output: str
+
+
+# (ケース名, 繰り返し回数, 計測処理（回数と周回数を受けて周回ごとの1回あたりの秒を返す）)
+Case = Tuple[str, int, Callable[[int, int], List[float]]]
+
+def main() -> None:
+
+    args = parse_args()
+    sys.path.insert(0, os.path.join(ROOT, args.gw))
+    raise_nofile()
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, iters, fn in cases(args):
+        if args.filter not in name:
+            continue
+        it_iters = max(1, int(iters * args.scale))
+        try:
+            samples = fn(it_iters, args.rounds)
+        except (OSError, ValueError) as e:
+            print("%-36s 計測不可 %s" % (name, e))
+            continue
+        results[name] = {
+            "ns_per_op": round(min(samples) * 1e9, 1),
+            "median_ns": round(statistics.median(samples) * 1e9, 1),
+            "iters": it_iters,
+        }
+        print("%-36s %12.1f ns" % (name, results[name]["ns_per_op"]))
+
+    doc = {"gw": args.gw, "host": socket.gethostname(), "python": sys.version.split()[0], "results": results}
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump(doc, f, indent=1)
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(doc, f, indent=1)
+        print("基準値を保存 " + args.baseline)
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            base = json.load(f)
+        if report(base["results"], results, args.threshold) > 0:
+            sys.exit(1)
+
+    return
+
+
+def report(base: Dict[str, Dict[str, float]], cur: Dict[str, Dict[str, float]], threshold: float) -> int:
+    """基準値との比較結果の表示
+
+    Args:
+        base (Dict): 基準値
+        cur (Dict): 今回の結果
+        threshold (float): 遅くなったとみなす比率
+
+    Returns:
+        int: 遅くなったケースの数
+    """
+
+    slow = 0
+    print("")
+    print("%-36s %12s %12s %7s" % ("case", "base(ns)", "now(ns)", "ratio"))
+    for name, r in cur.items():
+        b = base.get(name)
+        if b is None:
+            print("%-36s %12s %12.1f %7s" % (name, "-", r["ns_per_op"], "-"))
+            continue
+        ratio = r["ns_per_op"] / b["ns_per_op"] if b["ns_per_op"] > 0 else 0.0
+        mark = ""
+        if ratio > threshold:
+            mark = " SLOW"
+            slow += 1
+        elif ratio < 1 / threshold:
+            mark = " FAST"
+        print("%-36s %12.1f %12.1f %7.2f%s" % (name, b["ns_per_op"], r["ns_per_op"], ratio, mark))
+
+    return slow
+
+
+def cases(args: Parameters) -> List[Case]:
+    """計測するケースの一覧"""
+
+    lst: List[Case] = []
+    for proto in (1, 2):
+        for size in FRAME_SIZES:
+            iters = min(20000, BYTES_PER_ROUND // size)
+            lst.append(("telsocket.send_frame.v%d.%d" % (proto, size), iters, bench_send_frame(proto, size)))
+            lst.append(("telsocket.receive_frame.v%d.%d" % (proto, size), iters, bench_receive_frame(proto, size)))
+    if args.gw == "gw1":
+        # gw1 の send/receive はユニット名付きの v1 電文
+        for size in FRAME_SIZES:
+            iters = min(20000, BYTES_PER_ROUND // size)
+            lst.append(("telsocket.send.%d" % size, iters, bench_send(size)))
+            lst.append(("telsocket.receive.%d" % size, iters, bench_receive(size)))
+    for num in SELECT_COUNTS:
+        lst.append(("select.socketselect.%d" % num, 2000, bench_select(num, False)))
+        lst.append(("select.registry.%d" % num, 2000, bench_select(num, True)))
+    lst.append(("log.output", 20000, bench_log_output(False, True)))
+    lst.append(("log.output.no_caller", 20000, bench_log_output(False, False)))
+    lst.append(("log.output.async", 20000, bench_log_output(True, True)))
+    lst.append(("log.output.dbg_off", 20000, bench_log_debug_off()))
+    for size in DUMP_SIZES:
+        lst.append(("log.output_dump.%d" % size, max(100, min(5000, 262144 // size)), bench_log_dump(size)))
+
+    return lst
+
+
+def measure(op: Callable[[], object], iters: int, rounds: int) -> List[float]:
+    """op を iters 回呼ぶ周回を rounds 回繰り返し、周回ごとの1回あたりの秒を返す"""
+    samples: List[float] = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            op()
+        samples.append((time.perf_counter() - t0) / iters)
+    return samples
+
+
+def drain(sock: socket.socket) -> None:
+    """相手が閉じるまで読み捨てる"""
+    try:
+        while sock.recv(1048576):
+            pass
+    except OSError:
+        pass
+
+
+def feed(sock: socket.socket, data: bytes, count: int) -> None:
+    """同じデータを count 回書き込む"""
+    try:
+        for _ in range(count):
+            sock.sendall(data)
+    except OSError:
+        pass
+
+
+def bench_send_frame(proto: int, size: int) -> Callable[[int, int], List[float]]:
+    """TelSocket.send_frame（socketpair の相手側は別スレッドで読み捨てる）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        from telegram.telegram_common import TelSocket
+        from telegram.telegram_frame import FRAME_DATA
+
+        a, b = socket.socketpair()
+        tx = TelSocket()
+        tx.build(a)
+        tx.set_proto(proto)
+        th = threading.Thread(target=drain, args=(b,), daemon=True)
+        th.start()
+        payload = os.urandom(size)
+        try:
+            return measure(lambda: tx.send_frame(FRAME_DATA, 1, payload), iters, rounds)
+        finally:
+            tx.close()
+            th.join()
+            b.close()
+
+    return run
+
+
+def bench_receive_frame(proto: int, size: int) -> Callable[[int, int], List[float]]:
+    """TelSocket.receive_frame（socketpair の相手側は別スレッドで書き続ける）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        from telegram.telegram_common import TelSocket
+        from telegram.telegram_frame import FRAME_DATA
+        from telegram.telegram_frame import pack_v1
+        from telegram.telegram_frame import pack_v2
+        from telegram.telegram_frame import unit_name
+
+        a, b = socket.socketpair()
+        rx = TelSocket()
+        rx.build(a)
+        rx.set_proto(proto)
+        payload = os.urandom(size)
+        head = pack_v2(FRAME_DATA, 1, size) if proto == 2 else pack_v1(unit_name(1), size)
+        th = threading.Thread(target=feed, args=(b, head + payload, iters * rounds), daemon=True)
+        th.start()
+        try:
+            return measure(rx.receive_frame, iters, rounds)
+        finally:
+            th.join()
+            b.close()
+            rx.close()
+
+    return run
+
+
+def bench_send(size: int) -> Callable[[int, int], List[float]]:
+    """TelSocket.send（gw1 のユニット名付き送信）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        from telegram.telegram_common import TelSocket
+
+        a, b = socket.socketpair()
+        tx = TelSocket()
+        tx.build(a)
+        th = threading.Thread(target=drain, args=(b,), daemon=True)
+        th.start()
+        payload = os.urandom(size)
+        try:
+            return measure(lambda: tx.send("0001", payload), iters, rounds)
+        finally:
+            tx.close()
+            th.join()
+            b.close()
+
+    return run
+
+
+def bench_receive(size: int) -> Callable[[int, int], List[float]]:
+    """TelSocket.receive（gw1 のユニット名付き受信）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        from telegram.telegram_common import TelSocket
+        from telegram.telegram_frame import pack_v1
+
+        a, b = socket.socketpair()
+        rx = TelSocket()
+        rx.build(a)
+        payload = os.urandom(size)
+        th = threading.Thread(target=feed, args=(b, pack_v1("0001", size) + payload, iters * rounds), daemon=True)
+        th.start()
+        try:
+            return measure(rx.receive, iters, rounds)
+        finally:
+            th.join()
+            b.close()
+            rx.close()
+
+    return run
+
+
+def bench_select(num: int, registry: bool) -> Callable[[int, int], List[float]]:
+    """num 個のソケットのうち1個だけ受信可能な状態での待ち合わせ（待ち時間 0）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        from telegram.telegram_common import TelSocket
+        from telegram.telegram_common import SocketSelect
+        from telegram.telegram_common import SocketRegistry
+
+        clts: List[TelSocket] = []
+        for _ in range(num // 2):
+            for s in socket.socketpair():
+                t = TelSocket()
+                t.build(s)
+                clts.append(t)
+        clts[1].sock.send(b"x")
+        reg = SocketRegistry()
+        try:
+            if registry:
+                for t in clts:
+                    reg.register(t)
+                return measure(lambda: reg.select(0), iters, rounds)
+            return measure(lambda: SocketSelect.select(None, clts, 0), iters, rounds)
+        finally:
+            for t in clts:
+                t.close()
+            reg.close()
+
+    return run
+
+
+def open_log(tmp: str, async_mode: bool, caller: bool) -> "Log":
+    """計測用のログ（一時ディレクトリへ書く）"""
+    from log.log import Log
+
+    lg = Log(0, "bench", tmp)
+    if async_mode:
+        lg.async_on()
+    if not caller:
+        lg.caller_off()
+    return lg
+
+
+def bench_log_output(async_mode: bool, caller: bool) -> Callable[[int, int], List[float]]:
+    """Log.output（書式の組み立てを含む）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        with tempfile.TemporaryDirectory() as tmp:
+            lg = open_log(tmp, async_mode, caller)
+            try:
+                return measure(lambda: lg.output("INF", "制御ソケットに送信 name=%s size=%s", "0001", 4096), iters, rounds)
+            finally:
+                lg.async_off()
+
+    return run
+
+
+def bench_log_debug_off() -> Callable[[int, int], List[float]]:
+    """Log.output（デバッグ無効時に DBG を捨てるだけの経路）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        with tempfile.TemporaryDirectory() as tmp:
+            lg = open_log(tmp, False, True)
+            lg.debug_off()
+            return measure(lambda: lg.output("DBG", "受信 name=%s size=%s", "0001", 4096), iters, rounds)
+
+    return run
+
+
+def bench_log_dump(size: int) -> Callable[[int, int], List[float]]:
+    """Log.output_dump（既定のダンプ上限のまま）"""
+
+    def run(iters: int, rounds: int) -> List[float]:
+        with tempfile.TemporaryDirectory() as tmp:
+            lg = open_log(tmp, False, True)
+            lg.debug_on()
+            data = os.urandom(size)
+            return measure(lambda: lg.output_dump("DBG", data), iters, rounds)
+
+    return run
+
+
+def raise_nofile() -> None:
+    """ファイルディスクリプタ数の上限を引き上げる（1000 ソケットの計測用）"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > 4096:
+            hard = 4096
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def parse_args() -> Parameters:
+    """コマンドライン引数解析処理
+
+    Returns:
+        Parameters: 解析結果格納オブジェクト
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--gw",
+        type=str,
+        choices=["gw1", "gw2"],
+        default="gw1",
+        help="計測する telegram / log の置き場所",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=5,
+        help="ケースごとの周回数（最速の周回を結果とする）",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="繰り返し回数の倍率（ラズベリーパイでは小さくする）",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        default="",
+        help="ケース名にこの文字列を含むものだけ計測",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default="",
+        help="基準値のファイル（既定は bench/baseline/micro-<gw>-<ホスト名>.json）",
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="結果を基準値として保存（指定しなければ基準値と比較）",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.10,
+        help="基準値に対してこの比率を超えたら遅くなったとみなす（終了コード 1）",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="結果（JSON）の出力先ファイル",
+    )
+
+    args = parser.parse_args()
+
+    baseline = args.baseline
+    if baseline == "":
+        baseline = os.path.join(BASELINE_DIR, "micro-" + args.gw + "-" + socket.gethostname() + ".json")
+
+    params = Parameters(
+        gw=args.gw,
+        rounds=args.rounds,
+        scale=args.scale,
+        filter=args.filter,
+        baseline=baseline,
+        save=args.save,
+        threshold=args.threshold,
+        output=args.output,
+    )
+
+    return params
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+cd bench
+python3 bench_e2e.py --pattern stream --clients 4 --size 65536 --output result_stream.json
+python3 bench_e2e.py --pattern rr --clients 4 --size 1024 --output result_rr.json
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+cd gw1
+python gw1.py --ctrl_ip 43.206.161.224 --ctrl_port 10001 --config gw1_maps.json
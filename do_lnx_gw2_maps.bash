@@ -0,0 +1,8 @@
+#!/bin/bash
+
+cd gw2
+while [ 1 ]
+do
+    python3 gw2.py --ctrl_port 10001 --config gw2_maps.json
+    sleep 5
+done
@@ -0,0 +1,8 @@
+#!/bin/bash
+
+cd gw2
+while [ 1 ]
+do
+    python3 gw2.py --supervise gw2_tunnels.json
+    sleep 5
+done
@@ -4,27 +4,117 @@ import warnings
 sys.dont_write_bytecode = True
 warnings.filterwarnings( 'ignore' )
 
+import os
 import time
+import random
 import argparse
+import asyncio
+import json
+import zlib
 
 from dataclasses import dataclass
+from dataclasses import field
 from typing import Optional
+from typing import Dict
+from typing import Set
+from typing import Tuple
+from typing import List
+from typing import Iterable
 
 from log.log import Log
+from log.log import LOG_DUMP_MAX
 from telegram.telegram_common import TelSocket
 from telegram.telegram_common import AcpSocket
+from telegram.telegram_common import SocketRegistry
 from telegram.telegram_common import SocketSelect
+from telegram.telegram_common import EVENT_READ
+from telegram.telegram_common import EVENT_WRITE
+from telegram.telegram_async import AsyncTelSocket
+from telegram.telegram_frame import PROTO_V1
+from telegram.telegram_frame import PROTO_V2
+from telegram.telegram_frame import FRAME_DATA
+from telegram.telegram_frame import FRAME_CREDIT
+from telegram.telegram_frame import FRAME_OPEN
+from telegram.telegram_frame import FRAME_CLOSE
+from telegram.telegram_frame import FRAME_PING
+from telegram.telegram_frame import FRAME_ACK
+from telegram.telegram_frame import FRAME_RESUME
+from telegram.telegram_frame import LINK_FRAMES
+from telegram.telegram_frame import FRAME_FLAG_Z
+from telegram.telegram_frame import CREDIT_BODY
+from telegram.telegram_frame import CAPABILITIES
+from telegram.telegram_frame import unit_name
+from telegram.telegram_frame import is_close
+from telegram.telegram_frame import parse_links
+from telegram.telegram_frame import MAX_LINKS
+from telegram.telegram_frame import chan_map
+from telegram.telegram_frame import MAX_MAP_ID
+from telegram.telegram_flow import FlowControl
+from telegram.telegram_compress import StreamCompressor
+from telegram.telegram_capture import FrameCapture
+from telegram.telegram_metrics import Metrics
+from telegram.telegram_metrics import start_metrics_server
+from telegram.telegram_prof import Profiler
+from telegram.telegram_pool import ConnPool
+from telegram.telegram_pool import POOL_MAX_AGE
+from telegram.telegram_hello import Handshake
+from telegram.telegram_session import Heartbeat
+from telegram.telegram_session import Session
+from telegram.telegram_session import HEARTBEAT_INTERVAL
+from telegram.telegram_session import HEARTBEAT_TIMEOUT
+from telegram.telegram_session import RESUME_TIMEOUT
+from telegram.telegram_sched import FrameScheduler
+from telegram.telegram_sched import PRIO_HIGH
+from telegram.telegram_sched import SCHED_CHAN_LIMIT
+from telegram.telegram_sched import SCHED_BUDGET
 
 # メモ
 # ラズベリーパイの中で稼働する
 
+# 制御ソケットの接続待ちの上限（秒）
+CONNECT_TIMEOUT = 5.0
+
+# 制御ソケットの再接続の待ち時間の初期値（秒、失敗するたびに倍にして --reconnect_max まで延ばす）
+RECONNECT_MIN = 0.5
+
+# asyncio版でチャネルごとに溜めるジョブソケットへの送信待ち電文数の上限
+ASYNC_QUEUE_HIGH = 256
+
+@dataclass
+class Mapping:
+    """ポート対応付け（チャネル番号の上位8ビットと転送先ポートの対応）"""
+    map_id: int
+    job_port: int
+    prio: bool = False
+    # 接続済みで用意しておくジョブソケットの本数（None なら --pool_min）
+    pool: Optional[int] = None
+
+
 @dataclass
 class Parameters:
     ctrl_ip: str
     ctrl_port: int
-    job_port: int
+    mappings: Dict[int, Mapping]
     debug: bool
+    log_async: bool
+    log_no_caller: bool
+    log_dump_max: int
     logfile: str
+    engine: str
+    proto: int
+    prio_ports: List[int]
+    links: int
+    compress: str
+    metrics_port: int
+    capture: str
+    capture_size: int
+    capture_snap: int
+    pool_min: int
+    pool_max_age: float
+    hb_interval: float
+    hb_timeout: float
+    resume_timeout: float
+    reconnect_max: float
 
 lg: Log = None
 
@@ -37,113 +127,1219 @@ def main() -> None:
     lg.debug_off()
     if args.debug:
         lg.debug_on()
-    main_proc(args)
+    if args.log_async:
+        lg.async_on()
+    if args.log_no_caller:
+        lg.caller_off()
+    lg.dump_limit(args.log_dump_max)
+    open_profiler(args)
+    cap = open_capture(args, args.capture)
+    if args.engine == "asyncio":
+        asyncio.run(main_proc_async(args))
+    else:
+        main_proc(args)
+    if cap is not None:
+        cap.close()
 
     return
 
 
+def open_profiler(args: Parameters) -> Profiler:
+    """稼働中に切り替える計測の準備
+
+    SIGUSR1 で主な処理の処理時間の計測、SIGUSR2 で標本採取を開始し、
+    もう一度送ると終了してログと同じ場所へ結果を書き出す（prof-*.timers / prof-*.folded）。
+    処理時間の計測は select 版の処理が対象。
+
+    Args:
+        args (Parameters): 起動パラメータ
+
+    Returns:
+        Profiler: 計測器
+    """
+
+    prof = Profiler(args.logfile)
+    prof.add_timer(SocketSelect, "select")
+    prof.add_timer(SocketRegistry, "select_events")
+    prof.add_timer(TelSocket, "receive")
+    prof.add_timer(TelSocket, "send")
+    prof.add_timer(TelSocket, "fill")
+    prof.add_timer(TelSocket, "receive_raw")
+    prof.add_timer(TelSocket, "send_raw")
+    prof.add_timer(TelSocket, "flush")
+    prof.add_timer(TelSocket, "write_pending")
+    prof.add_timer(TelSocket, "connect")
+    prof.add_timer(TelSocket, "connect_nb")
+    prof.add_timer(Log, "output")
+    prof.add_timer(Log, "output_dump")
+    # 包んだ分だけログの呼び出し元が1段深くなる
+    prof.add_hook(lambda on: setattr(lg, "caller_depth", 3 if on else 2))
+    if prof.install():
+        lg.output("INF", "計測の切り替え SIGUSR1: 処理時間 SIGUSR2: 標本採取 pid=%s", os.getpid())
+
+    return prof
+
+
+def open_capture(args: Parameters, path: str) -> Optional[FrameCapture]:
+    """電文記録の開始
+
+    以降に送受信する電文をすべてのソケットで記録する。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        path (str): 記録ファイルのパス（空なら記録しない）
+
+    Returns:
+        None: 記録しない
+        FrameCapture: 記録器
+    """
+
+    if path == "":
+        return None
+    cap = FrameCapture(path, args.capture_size * 1048576, args.capture_snap)
+    TelSocket.capture = cap
+    AsyncTelSocket.capture = cap
+    lg.output("INF", "電文記録開始 file=%s size=%sMB snap=%s", path, args.capture_size, args.capture_snap)
+    return cap
+
+
+@dataclass
+class LinkDial:
+    """制御ソケットの接続・再接続の状態"""
+    # 張った制御ソケット（番号順、最後の1本が接続中または交渉中）
+    links: List[TelSocket] = field(default_factory=list)
+    # 最後の1本のバージョン交渉（接続完了まで None）
+    hello: Optional[Handshake] = None
+    # 0 番で合意した機能一覧・交渉中に受信した通常電文・本数
+    caps: Dict[str, str] = field(default_factory=dict)
+    pending: Optional[Tuple[int, int, bytes]] = None
+    num: int = 1
+    # 最後の1本の接続開始時刻
+    started: float = 0.0
+    # 次に接続を始める時刻と、失敗したときの待ち時間
+    next_at: float = 0.0
+    wait: float = RECONNECT_MIN
+
+
+@dataclass
+class RelayState:
+    """中継処理の状態"""
+    reg: SocketRegistry
+    # 制御ソケットの心拍（送信は "hb" 合意時のみ、"resume" 合意時は ACK の送信時期にも使う）
+    hb: Heartbeat
+    # 制御ソケット（チャネル番号を本数で割った余りの番号のものを使う）
+    links: List[TelSocket] = field(default_factory=list)
+    # 制御ソケットが接続中か
+    links_up: bool = False
+    # 制御ソケットの接続・再接続（links_up でない間のみ使う）
+    dial: LinkDial = field(default_factory=LinkDial)
+    # 制御ソケットごとの送信電文の順番決め
+    scheds: List[FrameScheduler] = field(default_factory=list)
+    # ジョブソケットはチャネル番号で引く
+    job_soks: Dict[int, TelSocket] = field(default_factory=dict)
+    # 送信待ちが上限を超えているジョブソケットのチャネル番号
+    blocked: Set[int] = field(default_factory=set)
+    # 制御ソケットの詰まりでジョブソケットからの受信を止めているか
+    jobs_paused: bool = False
+    # 交渉で合意した機能（feats は値を除いた名前のみ）
+    caps: Dict[str, str] = field(default_factory=dict)
+    feats: Set[str] = field(default_factory=set)
+    # 制御ソケットが切れてもチャネルを保つセッション（"resume" 合意時のみ）
+    sess: Optional[Session] = None
+    # チャネルごとのクレジット管理（"credit" 合意時のみ）
+    flow: Optional[FlowControl] = None
+    # チャネルごとの圧縮（"zlib" 合意時のみ）
+    comp: Optional[StreamCompressor] = None
+    # チャネルの開始・終了を OPEN/CLOSE 電文で伝えるか（"open" 合意時のみ）
+    opens: bool = False
+    # 統計（--metrics_port 指定時のみ）
+    metrics: Optional[Metrics] = None
+    # ポート対応付けの番号ごとの接続済みジョブソケットの置き場（用意する本数が 1 以上のみ）
+    pools: Dict[int, ConnPool] = field(default_factory=dict)
+
+    def ctl_of(self, it_chan: int) -> TelSocket:
+        """チャネルが使う制御ソケット（同じチャネルは常に同じ制御ソケットを使う）"""
+        return self.links[it_chan % len(self.links)]
+
+    def sched_of(self, it_chan: int) -> FrameScheduler:
+        """チャネルが使うスケジューラ"""
+        return self.scheds[it_chan % len(self.scheds)]
+
+    def ready(self, it_idx: int) -> bool:
+        """制御ソケットへ連番付きの電文（DATA など）を送ってよいか（再開時は相手の RESUME 処理後）"""
+        return self.links_up and (self.sess is None or self.sess.seqs[it_idx].ready)
+
+    def push_close(self, it_chan: int) -> None:
+        """相手側へのチャネル終了の通知（未合意なら空の DATA 電文）"""
+        if self.opens:
+            self.sched_of(it_chan).push(it_chan, FRAME_CLOSE, b"")
+        else:
+            self.sched_of(it_chan).push(it_chan, FRAME_DATA, b"")
+
+
+def link_caps(args: Parameters, it_idx: int, it_num: int) -> Dict[str, str]:
+    """バージョン交渉で示す自側の機能一覧
+
+    Args:
+        args (Parameters): 起動パラメータ
+        it_idx (int): 制御ソケットの番号
+        it_num (int): 制御ソケットの本数
+
+    Returns:
+        Dict[str, str]: 機能一覧
+    """
+
+    my_caps = dict(CAPABILITIES)
+    my_caps["links"] = str(it_idx) + "/" + str(it_num)
+    if args.compress == "none":
+        my_caps.pop("zlib", None)
+    if args.hb_interval <= 0:
+        my_caps.pop("hb", None)
+    if args.resume_timeout <= 0:
+        my_caps.pop("resume", None)
+
+    return my_caps
+
+
 def main_proc(args: Parameters) -> None:
 
-    # 制御用のソケットを開く
-    not_stb: bool = True
-    while not_stb:
-        ctl: TelSocket = TelSocket()
-        res = ctl.connect(args.ctrl_ip, args.ctrl_port)
-        if res == False:
-            lg.output("ERR", "制御ソケット接続失敗")
-            time.sleep(5)
-            continue
+    st = RelayState(reg=SocketRegistry(), hb=Heartbeat(args.hb_interval or HEARTBEAT_INTERVAL, args.hb_timeout))
+    st.metrics = open_metrics(args, st)
+    for mp in args.mappings.values():
+        if mp.pool is not None and mp.pool > 0:
+            st.pools[mp.map_id] = ConnPool("127.0.0.1", mp.job_port, mp.pool, args.pool_max_age)
+
+    relay_loop(args, st)
+
+    return
+
+
+def proc_dial(args: Parameters, st: RelayState) -> float:
+    """制御ソケットの接続・再接続の時間管理（制御ソケットがない間、周回ごとに呼ぶ）
+
+    接続と交渉は非ブロッキングで進めるため、その間も再開を待つチャネルの
+    ジョブソケットの送受信・切断検知は止まらない。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+
+    Returns:
+        float: 次に時間を確かめるまでの待ち時間（秒）
+    """
+
+    d = st.dial
+    now = time.monotonic()
+    if len(d.links) == 0:
+        if now < d.next_at:
+            return d.next_at - now
+        if not dial_link(args, st):
+            dial_failed(args, st)
+            return d.next_at - now
+        return CONNECT_TIMEOUT
+
+    if d.hello is None:
+        it_left = d.started + CONNECT_TIMEOUT - now
+        if it_left <= 0:
+            lg.output("ERR", "制御ソケット接続時間切れ link=%s", len(d.links) - 1)
+            dial_failed(args, st)
+            return d.next_at - now
+        return it_left
+
+    if d.hello.expired(now):
+        # 応答がなければ v1 の相手として扱う
+        proc_dial_hello(args, st, d.hello.agreed, d.hello.pending)
+        return 0
+    return d.hello.deadline - now
+
+
+def dial_link(args: Parameters, st: RelayState) -> bool:
+    """制御ソケット1本の接続開始（番号は張った本数）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+
+    Returns:
+        True: 接続中または接続済み
+        False: 接続失敗
+    """
+
+    ctl: TelSocket = TelSocket()
+    if not ctl.connect_nb(args.ctrl_ip, args.ctrl_port):
+        lg.output("ERR", "制御ソケット接続失敗")
+        return False
+    ctl.set_name("dial")
+    st.dial.links.append(ctl)
+    st.dial.hello = None
+    st.dial.started = time.monotonic()
+    st.reg.register(ctl)
+    if not ctl.connecting:
+        start_hello(args, st)
+
+    return True
+
+
+def start_hello(args: Parameters, st: RelayState) -> None:
+    """接続できた制御ソケットのバージョン交渉の開始
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+    """
+
+    d = st.dial
+    it_idx = len(d.links) - 1
+    lg.output("INF", "制御ソケット接続成功 link=%s", it_idx)
+    if args.proto < PROTO_V2:
+        proc_dial_hello(args, st, {}, None)
+        return
+    d.hello = Handshake(d.links[-1], link_caps(args, it_idx, args.links if it_idx == 0 else d.num), False)
+
+    return
+
+
+def proc_dial_event(args: Parameters, st: RelayState, sck: TelSocket, ev: int) -> None:
+    """接続中・交渉中の制御ソケットの事象処理
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+        sck (TelSocket): 制御ソケット
+        ev (int): 発生した事象
+    """
+
+    d = st.dial
+    if ev & EVENT_WRITE:
+        if sck.connecting:
+            if not sck.finish_connect():
+                lg.output("ERR", "制御ソケット接続失敗")
+                dial_failed(args, st)
+                return
+            start_hello(args, st)
+        else:
+            sck.write_pending()
+    if not (ev & EVENT_READ) or sck.sock is None:
+        return
+
+    if d.hello is None or d.hello.sck is not sck:
+        # 残りの制御ソケットを張る間に届いた電文は切り替えまで復号器に溜めておく
+        if not sck.fill():
+            lg.output("ERR", "制御ソケット切断検知（追加中）")
+            dial_failed(args, st)
+        return
+    if not d.hello.on_readable():
+        lg.output("ERR", "制御ソケット切断検知（バージョン交渉中、または不正な電文）")
+        dial_failed(args, st)
+        return
+    if d.hello.done:
+        proc_dial_hello(args, st, d.hello.agreed, d.hello.pending)
+
+    return
+
+
+def proc_dial_hello(args: Parameters, st: RelayState, caps: Dict[str, str], pending: Optional[Tuple[int, int, bytes]]) -> None:
+    """バージョン交渉を終えた制御ソケットの処理
+
+    相手が対応していれば残りの制御ソケットも張り、本数分揃ったら切り替える。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+        caps (Dict[str, str]): 合意した機能一覧
+        pending (Optional[Tuple[int, int, bytes]]): 交渉中に受信した通常電文
+    """
+
+    d = st.dial
+    d.hello = None
+    ctl = d.links[-1]
+    it_idx = len(d.links) - 1
+    lg.output("INF", "バージョン交渉 proto=%s caps=%s", ctl.proto, caps)
+    if it_idx == 0:
+        if st.sess is not None and ctl.proto != PROTO_V2:
+            # 再開待ちの間の交渉の時間切れは v1 の相手とみなさず、次の接続で再開を試みる
+            lg.output("ERR", "バージョン交渉失敗（再開待ち）")
+            dial_failed(args, st)
+            return
+        d.caps = caps
+        d.pending = pending
+        _, d.num = parse_links(caps)
+    elif parse_links(caps) != (it_idx, d.num):
+        lg.output("ERR", "制御ソケットの追加失敗 link=%s", it_idx)
+        dial_failed(args, st)
+        return
+
+    if len(d.links) < d.num:
+        if not dial_link(args, st):
+            dial_failed(args, st)
+        return
 
-        lg.output("INF", "制御ソケット接続成功")
-        ctl.set_name( "ctrl" )
-        not_stb = False
+    # 次に切れたときはすぐに張り直す
+    st.dial = LinkDial()
+    attach_links(st, d.links[0].proto, d.caps, d.links)
 
-    job_soks: list[TelSocket] = []
-    job_soks.append(ctl)
+    if d.pending is not None:
+        proc_link_frames(args, st, d.links[0], [d.pending])
+    # 交渉中にまとめて受信した電文の処理
+    for link in d.links:
+        proc_link_frames(args, st, link, link.frames())
+
+    return
+
+
+def dial_failed(args: Parameters, st: RelayState) -> None:
+    """接続失敗（張った分を閉じ、待ち時間をおいて次の接続を予約する）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+    """
+
+    d = st.dial
+    for link in d.links:
+        link.close()
+    d.links = []
+    d.hello = None
+    # 多数の装置が同時に再接続しないよう待ち時間をばらつかせる
+    d.next_at = time.monotonic() + random.uniform(d.wait / 2, d.wait)
+    d.wait = min(d.wait * 2, args.reconnect_max)
+
+    return
+
+
+def attach_links(st: RelayState, it_proto: int, caps: Dict[str, str], links: List[TelSocket]) -> None:
+    """張った制御ソケットへの切り替え
+
+    セッションを再開する場合はチャネルの状態（クレジット・圧縮）を引き継ぎ、
+    各制御ソケットへ RESUME 電文を送る。合意した機能や本数が前回と違えば
+    再開せずにチャネルを破棄する。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_proto (int): 電文形式
+        caps (Dict[str, str]): 合意した機能一覧
+        links (List[TelSocket]): 制御ソケット
+    """
+
+    feats = {k for k in caps if k != "links"} if it_proto == PROTO_V2 else set()
+    if st.sess is not None and (feats != st.feats or len(links) != len(st.links)):
+        lg.output("WRN", "合意内容の変更によりセッション破棄 caps=%s", caps)
+        drop_chans(st)
+        st.sess = None
+    st.caps = caps
+    st.feats = feats
+    if "credit" not in feats:
+        st.flow = None
+    elif st.flow is None:
+        st.flow = FlowControl()
+    if "zlib" not in feats:
+        st.comp = None
+    elif st.comp is None:
+        st.comp = StreamCompressor()
+    st.opens = "open" in feats
+    if "resume" not in feats:
+        st.sess = None
+    elif st.sess is None:
+        st.sess = Session(len(links))
+
+    st.links[:] = links
+    for link in links:
+        link.set_name("ctrl")
+    if len(st.scheds) != len(links):
+        st.scheds[:] = [FrameScheduler() for _ in links]
+        if st.metrics is not None:
+            st.metrics.attach(st.links, st.scheds, st.job_soks)
+    for link in links:
+        link.set_nonblocking()
+        st.reg.register(link)
+    st.links_up = True
+    st.hb.start(len(links))
+
+    if st.sess is not None:
+        # 受信済み数を伝え、相手の RESUME を受けるまで連番付きの電文は送らない
+        st.sess.begin()
+        for it_idx, link in enumerate(links):
+            link.queue_frame(FRAME_RESUME, 0, st.sess.resume_body(it_idx))
+            link.flush()
+
+    return
+
+
+def relay_loop(args: Parameters, st: RelayState) -> None:
+    """中継処理（制御ソケットの接続・再接続もこの周回の中で進める）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+    """
 
     while True:
+        it_wait = st.hb.interval / 2
+        if not st.links_up:
+            it_wait = min(it_wait, proc_dial(args, st))
         lg.output("DBG", "同期待ち開始")
-        s = SocketSelect.select(None, job_soks)
+        s = st.reg.select_events(it_wait)
+        # 使ったもの・古くなったものの補充
+        for pool in st.pools.values():
+            pool.refill()
+        if not proc_heartbeat(st):
+            proc_link_down(st)
+        proc_resume_timeout(args, st)
 
         if len(s) == 0:
             continue
         lg.output("DBG", "検知")
+        fl_start = time.monotonic() if st.metrics is not None else 0.0
+
+        for i, ev in s:
+            if not isinstance(i, TelSocket) or i.sock is None:
+                # 同じ周回で切断済み
+                continue
+            lg.output("DBG", "name = %s", i.name)
+
+            if i.name == "dial":
+                # 接続中・交渉中の制御ソケット
+                proc_dial_event(args, st, i, ev)
+                continue
+
+            if ev & EVENT_WRITE:
+                if i.connecting and not proc_job_connect(st, i):
+                    continue
+                # 送信待ちの書き出し
+                i.write_pending()
+                if i.name != "ctrl":
+                    proc_grant_credit(st, int(i.name), i)
+
+            if not (ev & EVENT_READ):
+                continue
 
-        for i in s:
-            lg.output("DBG", "name = " + i.name)
-            
             if i.name == "ctrl":
                 lg.output("INF", "制御ソケットからの受信")
 
                 # 制御ソケットからの受信
-                rcv = i.receive()
-                if rcv[0] == "":
+                if not i.fill():
                     lg.output("ERR", "制御ソケット切断検知")
-                    i.close()
-                    return
-                
-                st_jnum = rcv[0]
-                it_size = rcv[1]
-                bt_data = rcv[2]
+                    proc_link_down(st)
+                    continue
 
-                lg.output("INF", "unit=[" + st_jnum + "] size=[" + str(it_size) + "]")
-                lg.output_dump("DBG", bt_data)
-
-                if it_size > 0:
-                    # ジョブソケットに送信
-                    sck: Optional[TelSocket] = None
-                    for job_sock in job_soks:
-                        if job_sock.name == st_jnum:
-                            sck = job_sock
-                            lg.output("INF", "既存ジョブソケット [" + st_jnum + "]")
-                            break
-                    if sck is None:
-                        sck = TelSocket()
-                        res = sck.connect("127.0.0.1", args.job_port)
-                        if res == False:
-                            # 処理異常
-                            lg.output("ERR", "ジョブソケット接続失敗")
-                            continue
-                        lg.output("INF", "ジョブソケット接続成功 [" + st_jnum + "]")
-                        sck.set_name(st_jnum)
-                        job_soks.append(sck)
-
-                    sck.send_raw(bt_data)
-                    lg.output("INF", "ジョブソケットに送信 [" + st_jnum + "]")
-                    lg.output_dump("DBG", bt_data)
-                else:
-                    # ジョブソケットを切断
-                    for job_sock in job_soks:
-                        if job_sock.name == st_jnum:
-                            job_sock.close()
-                            lg.output("INF", "ジョブソケット切断 [" + st_jnum + "]")
-                            job_soks.remove(job_sock)
-                            break
+                # 受信済みの電文をまとめて処理
+                proc_link_frames(args, st, i, i.frames())
             else:
-                lg.output("INF", "ジョブソケットからの受信 [" + i.name + "]")
+                lg.output("INF", "ジョブソケットからの受信 [%s]", i.name)
 
-                # ジョブソケットからの受信
+                # ジョブソケットからの受信（クレジットの範囲内）
                 st_jnum = i.name
+                it_chan = int(st_jnum)
+
+                it_limit = 4096
+                if st.flow is not None:
+                    it_limit = min(it_limit, st.flow.credit(it_chan))
+                    if it_limit <= 0:
+                        refresh_job_read(st, it_chan, i)
+                        continue
 
-                bt_data = i.receive_raw(4096)
+                bt_data = i.receive_raw(it_limit)
                 if bt_data is None:
                     bt_data = b""
+                elif len(bt_data) == 0:
+                    continue
                 lg.output_dump("DBG", bt_data)
 
+                if len(bt_data) > 0:
+                    if st.flow is not None:
+                        st.flow.on_sent(it_chan, len(bt_data))
+                    if st.metrics is not None:
+                        st.metrics.on_up(it_chan, len(bt_data))
+                    refresh_job_read(st, it_chan, i)
 
-                lg.output("INF", "制御ソケットに送信")
-                ctl.send(st_jnum, bt_data)
-                lg.output("INF", "unit=[" + st_jnum + "] size=[" + str(len(bt_data)) + "]")
+
+                lg.output("INF", "制御ソケットへの送信待ち")
+                if len(bt_data) > 0:
+                    push_data(st, it_chan, bt_data)
+                lg.output("INF", "unit=[%s] size=[%s]", st_jnum, len(bt_data))
                 lg.output_dump("DBG", bt_data)
 
                 if len(bt_data) <= 0:
+                    st.push_close(it_chan)
                     i.close()
-                    job_soks.remove(i)
-                    lg.output("INF", "ジョブソケット切断 [" + st_jnum + "]")
+                    st.job_soks.pop(it_chan, None)
+                    st.blocked.discard(it_chan)
+                    if st.flow is not None:
+                        st.flow.close(it_chan)
+                    if st.comp is not None:
+                        st.comp.close(it_chan)
+                    if st.metrics is not None:
+                        st.metrics.close(it_chan)
+                    lg.output("INF", "ジョブソケット切断 [%s]", st_jnum)
+
+        # 今回の受信分をまとめて制御ソケットへ送信（CREDIT なども同じ書き出しに載せる）
+        proc_schedule(st)
+
+        proc_backpressure(st)
+        if st.metrics is not None:
+            st.metrics.loop.observe(time.monotonic() - fl_start)
     
     return
 
 
+def proc_link_down(st: RelayState) -> None:
+    """制御ソケットの切断（セッションを再開できる間はチャネルを保つ）
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    for link in st.links:
+        link.close()
+    st.links_up = False
+    if st.sess is not None:
+        st.sess.down()
+        lg.output("WRN", "制御ソケット再接続待ち chans=%s", len(st.job_soks))
+    else:
+        drop_chans(st)
+
+    return
+
+
+def proc_resume_timeout(args: Parameters, st: RelayState) -> None:
+    """再接続待ちの期限切れの処理（次の接続では相手側も新しいセッションとしてチャネルを破棄する）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+    """
+
+    if st.sess is None or st.links_up or st.sess.down_at == 0:
+        return
+    if time.monotonic() - st.sess.down_at <= args.resume_timeout:
+        return
+    lg.output("WRN", "セッション再開待ち期限切れ chans=%s", len(st.job_soks))
+    drop_chans(st)
+    st.sess = None
+
+    return
+
+
+def drop_chans(st: RelayState) -> None:
+    """全チャネルの破棄（セッションを再開できない場合）
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    for it_chan, job_sock in list(st.job_soks.items()):
+        job_sock.close()
+        if st.metrics is not None:
+            st.metrics.close(it_chan)
+        lg.output("INF", "ジョブソケット切断 [%s]", job_sock.name)
+    st.job_soks.clear()
+    st.blocked.clear()
+    st.jobs_paused = False
+    for sched in st.scheds:
+        sched.clear()
+    if st.flow is not None:
+        st.flow = FlowControl()
+    if st.comp is not None:
+        st.comp = StreamCompressor()
+
+    return
+
+
+def proc_link_frames(args: Parameters, st: RelayState, link: TelSocket, frames: Iterable[Tuple[int, int, bytes]]) -> None:
+    """制御ソケットから受信した電文の振り分け
+
+    制御ソケット自体の電文（PING/ACK/RESUME）はここで処理し、
+    それ以外は受信数を数えてから proc_ctrl_frame へ渡す。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+        link (TelSocket): 受信した制御ソケット
+        frames (Iterable): 受信電文（電文種別, チャネル番号, データ）
+    """
+
+    it_idx = st.links.index(link)
+    st.hb.on_recv(it_idx)
+    for rcv in frames:
+        it_type = rcv[0]
+        if it_type in LINK_FRAMES:
+            if it_type == FRAME_ACK and st.sess is not None:
+                for it_chan in st.sess.on_ack(it_idx, rcv[2]):
+                    job_sock = st.job_soks.get(it_chan)
+                    if job_sock is not None:
+                        refresh_job_read(st, it_chan, job_sock)
+            elif it_type == FRAME_RESUME and st.sess is not None:
+                proc_resume(st, it_idx, rcv[2])
+            continue
+        if st.sess is not None and st.sess.received(it_idx, len(rcv[2])):
+            link.queue_frame(FRAME_ACK, 0, st.sess.ack_body(it_idx))
+        proc_ctrl_frame(args, st, rcv)
+
+    return
+
+
+def proc_resume(st: RelayState, it_idx: int, bt_data: bytes) -> None:
+    """相手の RESUME 電文の処理（未受信の分の再送、または全チャネルの破棄）
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_idx (int): 制御ソケットの番号
+        bt_data (bytes): RESUME 電文のデータ部
+    """
+
+    if st.sess is None:
+        return
+    frames = st.sess.on_resume(it_idx, bt_data)
+    if frames is None:
+        if len(st.job_soks) == 0:
+            lg.output("INF", "セッション開始")
+        else:
+            lg.output("WRN", "セッション再開不可（相手が別のセッション） chans=%s", len(st.job_soks))
+        drop_chans(st)
+        return
+
+    link = st.links[it_idx]
+    for it_type, it_chan, bt_frame in frames:
+        link.queue_frame(it_type, it_chan, bt_frame)
+    link.flush()
+    lg.output("INF", "セッション再開 link=%s resend=%s chans=%s", it_idx, len(frames), len(st.job_soks))
+
+    # 切断中に返せなかったクレジットの返却と受信可否の反映
+    for it_chan, job_sock in st.job_soks.items():
+        if it_chan % len(st.links) == it_idx:
+            proc_grant_credit(st, it_chan, job_sock)
+            refresh_job_read(st, it_chan, job_sock)
+
+    return
+
+
+def proc_heartbeat(st: RelayState) -> bool:
+    """心拍・未報告の ACK の送信と無受信の検知
+
+    Args:
+        st (RelayState): 中継処理の状態
+
+    Returns:
+        True: 正常
+        False: 無受信が続く制御ソケットあり（切断とみなす）
+    """
+
+    if not st.links_up:
+        return True
+    now = time.monotonic()
+    if st.hb.due(now):
+        for it_idx, link in enumerate(st.links):
+            if "hb" in st.feats:
+                link.queue_frame(FRAME_PING, 0, b"")
+            if st.sess is not None and st.sess.ack_due(it_idx):
+                link.queue_frame(FRAME_ACK, 0, st.sess.ack_body(it_idx))
+            link.flush()
+    if "hb" in st.feats:
+        it_idx = st.hb.dead(now)
+        if it_idx is not None:
+            lg.output("ERR", "制御ソケット無応答 link=%s", it_idx)
+            return False
+
+    return True
+
+
+def queue_seq(st: RelayState, it_idx: int, it_type: int, it_chan: int, bt_data: bytes) -> None:
+    """連番付き電文の送信待ち登録（"resume" 合意時は相手の ACK まで保持）
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_idx (int): 制御ソケットの番号
+        it_type (int): 電文種別
+        it_chan (int): チャネル番号
+        bt_data (bytes): 送信データ
+    """
+
+    st.links[it_idx].queue_frame(it_type, it_chan, bt_data)
+    if st.sess is not None:
+        st.sess.sent(it_idx, it_type, it_chan, bt_data)
+
+    return
+
+
+def open_metrics(args: Parameters, st: RelayState) -> Optional[Metrics]:
+    """統計の公開開始（--metrics_port 指定時のみ）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+
+    Returns:
+        None: 公開しない
+        Metrics: 統計
+    """
+
+    if args.metrics_port <= 0:
+        return None
+    metrics = Metrics()
+    metrics.attach(st.links, st.scheds, st.job_soks)
+    try:
+        start_metrics_server(metrics, args.metrics_port)
+    except OSError as e:
+        lg.output("ERR", "統計の公開失敗 port=%s %s", args.metrics_port, e)
+        return None
+    lg.output("INF", "統計の公開開始 http://127.0.0.1:%s/metrics", args.metrics_port)
+    return metrics
+
+
+def open_job(args: Parameters, st: RelayState, it_chan: int) -> Optional[TelSocket]:
+    """チャネルのジョブソケットの接続開始
+
+    用意したものがあれば使い、なければ接続を開始する。
+    どちらも接続の完了を待たずに登録し、完了までの電文は送信待ちに積む。
+    接続できないチャネルは相手側へ終了を返す。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+
+    Returns:
+        None: 接続失敗
+        TelSocket: ジョブソケット
+    """
+
+    st_jnum = unit_name(it_chan)
+    mp = args.mappings.get(chan_map(it_chan))
+    if mp is None:
+        # 対応付けのないチャネルは相手側へ切断を返す
+        lg.output("ERR", "未定義のポート対応付け map=%s", chan_map(it_chan))
+        st.push_close(it_chan)
+        return None
+    pool = st.pools.get(mp.map_id)
+    sck = pool.claim() if pool is not None else None
+    if sck is not None:
+        lg.output("INF", "用意したジョブソケット使用 [%s]", st_jnum)
+    else:
+        sck = TelSocket()
+        if not sck.connect_nb("127.0.0.1", mp.job_port):
+            # 相手側へ切断を返す
+            lg.output("ERR", "ジョブソケット接続失敗 [%s]", st_jnum)
+            st.push_close(it_chan)
+            return None
+        lg.output("INF", "ジョブソケット接続開始 [%s]", st_jnum)
+    sck.set_name(st_jnum)
+    if st.jobs_paused:
+        sck.want_read = False
+    if st.flow is not None:
+        st.flow.open(it_chan)
+    if mp.prio or mp.job_port in args.prio_ports:
+        st.sched_of(it_chan).set_priority(it_chan, PRIO_HIGH)
+    st.job_soks[it_chan] = sck
+    st.reg.register(sck)
+    if st.metrics is not None:
+        st.metrics.open(it_chan)
+
+    return sck
+
+
+def proc_job_connect(st: RelayState, job_sock: TelSocket) -> bool:
+    """ジョブソケットの接続完了の処理
+
+    接続に失敗したチャネルは送信待ちを捨てて相手側へ切断を返す。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        job_sock (TelSocket): 接続中のジョブソケット
+
+    Returns:
+        True: 接続完了
+        False: 接続失敗
+    """
+
+    st_jnum = job_sock.name
+    it_chan = int(st_jnum)
+    if job_sock.finish_connect():
+        lg.output("INF", "ジョブソケット接続成功 [%s]", st_jnum)
+        return True
+
+    lg.output("ERR", "ジョブソケット接続失敗 [%s]", st_jnum)
+    job_sock.close()
+    if st.job_soks.get(it_chan) is not job_sock:
+        # 相手側から切断済み
+        return False
+    del st.job_soks[it_chan]
+    st.blocked.discard(it_chan)
+    if st.flow is not None:
+        st.flow.close(it_chan)
+    if st.comp is not None:
+        st.comp.close(it_chan)
+    if st.metrics is not None:
+        st.metrics.close(it_chan)
+    st.push_close(it_chan)
+
+    return False
+
+
+def proc_backpressure(st: RelayState) -> None:
+    """送信待ちの溜まり具合に応じた受信の停止・再開
+
+    制御ソケットが詰まっている間はジョブソケットから読まず、
+    いずれかのジョブソケットが詰まっている間は制御ソケットから読まない。
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    if not st.jobs_paused and any(link.congested() for link in st.links):
+        lg.output("WRN", "制御ソケット送信待ち超過")
+        st.jobs_paused = True
+        for it_chan, job_sock in st.job_soks.items():
+            refresh_job_read(st, it_chan, job_sock)
+    elif st.jobs_paused and all(link.drained() for link in st.links):
+        st.jobs_paused = False
+        for it_chan, job_sock in st.job_soks.items():
+            refresh_job_read(st, it_chan, job_sock)
+
+    for it_chan in list(st.blocked):
+        job_sock = st.job_soks.get(it_chan)
+        if job_sock is None or job_sock.drained():
+            st.blocked.discard(it_chan)
+
+    for link in st.links:
+        if len(st.blocked) > 0:
+            link.pause_read()
+        else:
+            link.resume_read()
+
+    return
+
+
+def proc_schedule(st: RelayState) -> None:
+    """スケジューラに溜まった電文の制御ソケットへの送り出し
+
+    制御ソケットごとに送信待ちを SCHED_BUDGET までに抑え、
+    どのチャネルの電文を先に送るかはスケジューラに決めさせる。
+    周回中に積んだ電文（CREDIT・ACK など）は最初の書き出しにまとめて載せる。
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    for it_idx, (link, sched) in enumerate(zip(st.links, st.scheds)):
+        while st.ready(it_idx) and not sched.empty() and link.wq_bytes < SCHED_BUDGET:
+            for it_type, it_chan, bt_data in sched.pop_batch(SCHED_BUDGET - link.wq_bytes):
+                queue_seq(st, it_idx, it_type, it_chan, bt_data)
+                if is_close(it_type, bt_data):
+                    # 切断通知を送ったチャネルは片付ける
+                    sched.discard(it_chan)
+                    continue
+                job_sock = st.job_soks.get(it_chan)
+                if job_sock is not None:
+                    refresh_job_read(st, it_chan, job_sock)
+            link.flush()
+        # 送る DATA がなくても積んだ電文は送る
+        link.flush()
+
+    return
+
+
+def push_data(st: RelayState, it_chan: int, bt_data: bytes) -> None:
+    """ジョブソケットから受信したデータのスケジューラへの登録
+
+    "zlib" 合意時は圧縮する。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+        bt_data (bytes): 受信データ
+    """
+
+    it_type = FRAME_DATA
+    if st.comp is not None and len(bt_data) > 0:
+        it_type, bt_data = st.comp.pack(it_chan, bt_data)
+    st.sched_of(it_chan).push(it_chan, it_type, bt_data)
+
+    return
+
+
+
+def refresh_job_read(st: RelayState, it_chan: int, job_sock: TelSocket) -> None:
+    """ジョブソケットの受信可否の反映
+
+    制御ソケットが詰まっている間、クレジットを使い切った間、
+    スケジューラの送信待ち・再送用の保持が溜まっている間は受信しない。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+        job_sock (TelSocket): ジョブソケット
+    """
+
+    if (st.jobs_paused
+            or (st.flow is not None and st.flow.credit(it_chan) <= 0)
+            or st.sched_of(it_chan).pending(it_chan) >= SCHED_CHAN_LIMIT
+            or (st.sess is not None and st.sess.congested(it_chan))):
+        job_sock.pause_read()
+    else:
+        job_sock.resume_read()
+
+    return
+
+
+def proc_grant_credit(st: RelayState, it_chan: int, job_sock: TelSocket) -> None:
+    """ジョブソケットへ書き出し済みの量に応じたクレジットの返却
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+        job_sock (TelSocket): ジョブソケット
+    """
+
+    # 制御ソケットの再接続中は返さず、再開後にまとめて返す
+    it_idx = it_chan % len(st.links)
+    if st.flow is None or not st.ready(it_idx):
+        return
+    it_grant = st.flow.on_delivered(it_chan, job_sock.sent_total)
+    if it_grant > 0:
+        queue_seq(st, it_idx, FRAME_CREDIT, it_chan, CREDIT_BODY.pack(it_grant))
+
+    return
+
+
+def proc_ctrl_frame(args: Parameters, st: RelayState, rcv: Tuple[int, int, bytes]) -> None:
+    """制御ソケットから受信した電文の処理
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+        rcv (Tuple[int, int, bytes]): 受信電文（電文種別, チャネル番号, データ）
+    """
+
+    it_type = rcv[0]
+    it_chan = rcv[1]
+    bt_data = rcv[2]
+    if it_type == FRAME_DATA | FRAME_FLAG_Z and st.comp is not None:
+        try:
+            bt_data = st.comp.unpack(it_chan, bt_data)
+        except zlib.error:
+            # 伸張できないチャネルは両側で切断する
+            lg.output("ERR", "伸張失敗 unit=%s", unit_name(it_chan))
+            proc_ctrl_frame(args, st, (FRAME_CLOSE, it_chan, b""))
+            st.push_close(it_chan)
+            return
+        it_type = FRAME_DATA
+    it_size = len(bt_data)
+    st_jnum = unit_name(it_chan)
+
+    lg.output("INF", "unit=[%s] size=[%s]", st_jnum, it_size)
+    lg.output_dump("DBG", bt_data)
+
+    if it_type == FRAME_CREDIT and st.flow is not None:
+        # 相手からの送信許可
+        if st.flow.on_credit(it_chan, CREDIT_BODY.unpack(bt_data)[0]):
+            job_sock = st.job_soks.get(it_chan)
+            if job_sock is not None:
+                refresh_job_read(st, it_chan, job_sock)
+        return
+
+    if it_type == FRAME_OPEN:
+        # 最初のデータを待たずに接続を始める
+        if it_chan not in st.job_soks:
+            open_job(args, st, it_chan)
+        return
+
+    if it_type == FRAME_CLOSE:
+        it_size = 0
+    elif it_type != FRAME_DATA:
+        lg.output("WRN", "未対応の電文種別 type=%s", it_type)
+        return
+    elif it_size == 0 and st.opens:
+        # 終了は CLOSE 電文で伝わるため空データは何もしない
+        return
+
+    if it_size > 0:
+        # ジョブソケットに送信
+        sck: Optional[TelSocket] = st.job_soks.get(it_chan)
+        if sck is not None:
+            lg.output("INF", "既存ジョブソケット [%s]", st_jnum)
+        elif st.opens:
+            # 接続失敗などで終了を返したチャネルの残り
+            lg.output("WRN", "終了済みチャネル宛てのデータを破棄 [%s]", st_jnum)
+            return
+        else:
+            sck = open_job(args, st, it_chan)
+            if sck is None:
+                return
+
+        sck.send_raw(bt_data)
+        if st.metrics is not None:
+            st.metrics.on_down(it_chan, it_size)
+        if sck.congested():
+            st.blocked.add(it_chan)
+        proc_grant_credit(st, it_chan, sck)
+        lg.output("INF", "ジョブソケットに送信 [%s]", st_jnum)
+        lg.output_dump("DBG", bt_data)
+    else:
+        # ジョブソケットを切断（送信待ちを書き切ってから）
+        job_sock = st.job_soks.pop(it_chan, None)
+        st.blocked.discard(it_chan)
+        st.sched_of(it_chan).discard(it_chan)
+        if st.flow is not None:
+            st.flow.close(it_chan)
+        if st.comp is not None:
+            st.comp.close(it_chan)
+        if st.metrics is not None:
+            st.metrics.close(it_chan)
+        if job_sock is not None:
+            job_sock.close_after_flush()
+            lg.output("INF", "ジョブソケット切断 [%s]", st_jnum)
+
+    return
+
+
+async def main_proc_async(args: Parameters) -> None:
+    """asyncio版の中継処理
+
+    チャネルごとに送受信タスクを分けるため、遅い相手先が他のチャネルを止めない。
+    制御ソケットの受信を止めると全チャネルが止まるため、ジョブソケットへの
+    送信待ちが ASYNC_QUEUE_HIGH 件を超えたチャネルは処理タスクを打ち切り、
+    相手側へ切断を通知する。
+    """
+
+    if len(args.mappings) > 1:
+        lg.output("WRN", "asyncio版はポート対応付け1件のみ対応 port=%s", next(iter(args.mappings.values())).job_port)
+
+    # 制御用のソケットを開く
+    ctl: AsyncTelSocket = AsyncTelSocket()
+    while True:
+        res = await ctl.connect(args.ctrl_ip, args.ctrl_port)
+        if res:
+            break
+        lg.output("ERR", "制御ソケット接続失敗")
+        await asyncio.sleep(5)
+
+    lg.output("INF", "制御ソケット接続成功")
+    ctl.set_name("ctrl")
+
+    jobs: Dict[str, "asyncio.Queue[bytes]"] = {}
+    # チャネルのキューと処理タスクの対応（ユニット名は再利用されるためキューで引く）
+    tasks: Dict["asyncio.Queue[bytes]", "asyncio.Task[None]"] = {}
+
+    def open_job(st_jnum: str) -> "asyncio.Queue[bytes]":
+        # 新しいチャネルの処理タスクを起動
+        q: "asyncio.Queue[bytes]" = asyncio.Queue()
+        jobs[st_jnum] = q
+        task = asyncio.create_task(job_proc_async(args, ctl, st_jnum, q, jobs))
+        tasks[q] = task
+        task.add_done_callback(lambda _: tasks.pop(q, None))
+        return q
+
+    while True:
+        # 制御ソケットからの受信
+        rcv = await ctl.receive()
+        if rcv[0] == "":
+            lg.output("ERR", "制御ソケット切断検知")
+            break
+
+        st_jnum = rcv[0]
+        it_size = rcv[1]
+        bt_data = rcv[2]
+
+        lg.output("INF", "unit=[%s] size=[%s]", st_jnum, it_size)
+        lg.output_dump("DBG", bt_data)
+
+        if it_size > 0:
+            q = jobs.get(st_jnum)
+            if q is not None and q.qsize() >= ASYNC_QUEUE_HIGH:
+                lg.output("WRN", "ジョブソケットの送信待ち超過のため切断 [%s] queued=%s", st_jnum, q.qsize())
+                del jobs[st_jnum]
+                task = tasks.get(q)
+                if task is not None:
+                    task.cancel()
+                ctl.send(st_jnum, b"")
+                await ctl.drain()
+                continue
+            if q is None:
+                q = open_job(st_jnum)
+            q.put_nowait(bt_data)
+        else:
+            # ジョブソケットを切断
+            q = jobs.pop(st_jnum, None)
+            if q is not None:
+                q.put_nowait(b"")
+
+    ctl.close()
+    for task in list(tasks.values()):
+        task.cancel()
+
+    return
+
+
+async def job_proc_async(args: Parameters, ctl: AsyncTelSocket, st_jnum: str, q: "asyncio.Queue[bytes]", jobs: Dict[str, "asyncio.Queue[bytes]"]) -> None:
+    """ジョブチャネル処理（asyncio版）
+
+    接続後、キューの内容をジョブソケットへ書き出しつつ、
+    ジョブソケットからの受信を制御ソケットへ転送する。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        ctl (AsyncTelSocket): 制御ソケット
+        st_jnum (str): ユニット名
+        q (asyncio.Queue): ジョブソケットへの送信待ちデータ（空データは切断指示、
+            データは ASYNC_QUEUE_HIGH 件まで）
+        jobs (Dict): ユニット名とキューの対応表
+    """
+
+    # 従来形式の電文ではポート対応付けの番号を運べないため最初の1件のみ使う
+    mp = next(iter(args.mappings.values()))
+    sck: AsyncTelSocket = AsyncTelSocket()
+    res = await sck.connect("127.0.0.1", mp.job_port)
+    if res == False:
+        # 処理異常（相手側へ切断を返す）
+        lg.output("ERR", "ジョブソケット接続失敗 [%s]", st_jnum)
+        if jobs.get(st_jnum) is q:
+            del jobs[st_jnum]
+            ctl.send(st_jnum, b"")
+            await ctl.drain()
+        return
+    lg.output("INF", "ジョブソケット接続成功 [%s]", st_jnum)
+    sck.set_name(st_jnum)
+
+    async def upstream() -> None:
+        # ジョブソケットからの受信
+        while True:
+            bt_data = await sck.receive_raw(-1)
+            if bt_data is None:
+                break
+            lg.output_dump("DBG", bt_data)
+            ctl.send(st_jnum, bt_data)
+            lg.output("INF", "制御ソケットに送信 unit=[%s] size=[%s]", st_jnum, len(bt_data))
+            await ctl.drain()
+
+        if jobs.get(st_jnum) is q:
+            # 相手側へ切断を通知
+            del jobs[st_jnum]
+            ctl.send(st_jnum, b"")
+            await ctl.drain()
+        q.put_nowait(b"")
+
+    up = asyncio.create_task(upstream())
+    try:
+        while True:
+            bt_data = await q.get()
+            if len(bt_data) == 0:
+                break
+            sck.send_raw(bt_data)
+            if not await sck.drain():
+                break
+            lg.output("INF", "ジョブソケットに送信 [%s]", st_jnum)
+    except asyncio.CancelledError:
+        # 送信待ち超過などで打ち切られた場合は書き切りを待たない
+        sck.abort()
+        raise
+    finally:
+        sck.close()
+        up.cancel()
+        lg.output("INF", "ジョブソケット切断 [%s]", st_jnum)
+
+    return
+
+
 def parse_args() -> Parameters:
     """コマンドライン引数解析処理
 
@@ -165,37 +1361,221 @@ def parse_args() -> Parameters:
         required=True,
         help="コントロール用ポート番号",
     )
-    parser.add_argument(
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
         "--job_port",
         type=int,
-        required=True,
         help="ジョブ用ポート番号",
     )
+    group.add_argument(
+        "--config",
+        type=str,
+        help="ポート対応付けの設定ファイル（JSON）",
+    )
     parser.add_argument(
         "--debug",
         type=bool,
         default=False,
         help="デバッグモード有効化",
     )
+    parser.add_argument(
+        "--log_async",
+        action="store_true",
+        help="ログを別スレッドでまとめて書き出す（ERR と終了時のみ即時）",
+    )
+    parser.add_argument(
+        "--log_no_caller",
+        action="store_true",
+        help="ログに呼び出し元のファイル名:行番号を出さない（記録ごとの負荷を下げる）",
+    )
+    parser.add_argument(
+        "--log_dump_max",
+        type=int,
+        default=LOG_DUMP_MAX,
+        help="ダンプ出力の最大バイト数（超えた分は先頭と末尾のみ、0 は無制限）",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=0,
+        help="統計を Prometheus 形式で公開するループバックのポート番号（0: 公開しない、select 版のみ）",
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        default="",
+        help="送受信した電文を記録するファイル",
+    )
+    parser.add_argument(
+        "--capture_size",
+        type=int,
+        default=64,
+        help="電文記録の上限（MB、超えたら古い記録から上書き）",
+    )
+    parser.add_argument(
+        "--capture_snap",
+        type=int,
+        default=0,
+        help="電文ごとに記録するデータの最大バイト数（0: ヘッダのみ, -1: すべて）",
+    )
     parser.add_argument(
         "--logfile",
         type=str,
         default="gw1",
         help="ログファイル名",
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["select", "asyncio"],
+        default="select",
+        help="中継エンジン（select: 従来方式, asyncio: 非同期方式）",
+    )
+    parser.add_argument(
+        "--proto",
+        type=int,
+        choices=[PROTO_V1, PROTO_V2],
+        default=PROTO_V2,
+        help="電文形式の上限（1: 従来形式のみ, 2: 接続時に交渉）",
+    )
+    parser.add_argument(
+        "--prio_ports",
+        type=int,
+        nargs="*",
+        default=[],
+        help="遅延を優先するジョブ用ポート番号（VNC など）",
+    )
+    parser.add_argument(
+        "--links",
+        type=int,
+        choices=range(1, MAX_LINKS + 1),
+        default=1,
+        metavar="N",
+        help="並列に張る制御ソケット数（相手が対応している場合のみ）",
+    )
+    parser.add_argument(
+        "--compress",
+        type=str,
+        choices=["zlib", "none"],
+        default="zlib",
+        help="チャネルごとの圧縮（相手が対応している場合のみ、効かないデータは自動で非圧縮）",
+    )
+    parser.add_argument(
+        "--hb_interval",
+        type=float,
+        default=HEARTBEAT_INTERVAL,
+        help="制御ソケットの心拍の間隔（秒、0: 送らない、相手が対応している場合のみ）",
+    )
+    parser.add_argument(
+        "--hb_timeout",
+        type=float,
+        default=HEARTBEAT_TIMEOUT,
+        help="制御ソケットからの無受信で切断とみなす時間（秒、相手の心拍の間隔より長くする）",
+    )
+    parser.add_argument(
+        "--resume_timeout",
+        type=float,
+        default=RESUME_TIMEOUT,
+        help="制御ソケットの切断後、再接続を待ってチャネルを保つ時間（秒、0: 保たない、相手が対応している場合のみ）",
+    )
+    parser.add_argument(
+        "--reconnect_max",
+        type=float,
+        default=5.0,
+        help="制御ソケットの再接続の待ち時間の上限（秒）",
+    )
+    parser.add_argument(
+        "--pool_min",
+        type=int,
+        default=0,
+        help="ポート対応付けごとに接続済みで用意しておくジョブソケットの本数（0: 用意しない、select 版のみ）",
+    )
+    parser.add_argument(
+        "--pool_max_age",
+        type=float,
+        default=POOL_MAX_AGE,
+        help="用意したジョブソケットを使わずに置いておく時間の上限（秒、ジョブ側の無通信切断より短くする）",
+    )
 
     args = parser.parse_args()
 
+    if args.capture_size <= 0:
+        parser.error("--capture_size は 1 以上を指定する")
+    if args.config is not None:
+        try:
+            mappings = load_mappings(args.config)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error("設定ファイル読込失敗 " + args.config + ": " + str(e))
+    else:
+        mappings = {0: Mapping(map_id=0, job_port=args.job_port)}
+    for mp in mappings.values():
+        if mp.pool is None:
+            mp.pool = args.pool_min
+
     params = Parameters(
         ctrl_ip=args.ctrl_ip,
         ctrl_port=args.ctrl_port,
-        job_port=args.job_port,
+        mappings=mappings,
         debug=args.debug,
+        log_async=args.log_async,
+        log_no_caller=args.log_no_caller,
+        log_dump_max=args.log_dump_max,
+        metrics_port=args.metrics_port,
+        capture=args.capture,
+        capture_size=args.capture_size,
+        capture_snap=args.capture_snap,
         logfile=args.logfile,
+        engine=args.engine,
+        proto=args.proto,
+        prio_ports=args.prio_ports,
+        links=args.links,
+        compress=args.compress,
+        pool_min=args.pool_min,
+        pool_max_age=args.pool_max_age,
+        hb_interval=args.hb_interval,
+        hb_timeout=args.hb_timeout,
+        resume_timeout=args.resume_timeout,
+        reconnect_max=args.reconnect_max,
     )
 
     return params
 
 
+def load_mappings(path: str) -> Dict[int, Mapping]:
+    """ポート対応付けの設定ファイルの読込
+
+    形式: {"mappings": [{"id": 1, "job_port": 5901}, {"id": 2, "job_port": 8082, "pool": 4}]}
+    （"prio": true で遅延を優先、"pool" で接続済みで用意しておく本数を個別に指定）
+
+    Args:
+        path (str): 設定ファイルのパス
+
+    Returns:
+        Dict[int, Mapping]: 番号とポート対応付けの対応表
+    """
+
+    with open(path, encoding="utf-8") as f:
+        conf = json.load(f)
+
+    mappings: Dict[int, Mapping] = {}
+    for ent in conf.get("mappings", []):
+        mp = Mapping(
+            map_id=int(ent["id"]),
+            job_port=int(ent["job_port"]),
+            prio=bool(ent.get("prio", False)),
+            pool=int(ent["pool"]) if "pool" in ent else None,
+        )
+        if mp.map_id < 0 or mp.map_id > MAX_MAP_ID:
+            raise ValueError("id は 0～" + str(MAX_MAP_ID) + " id=" + str(mp.map_id))
+        if mp.map_id in mappings:
+            raise ValueError("id の重複 id=" + str(mp.map_id))
+        mappings[mp.map_id] = mp
+
+    if len(mappings) == 0:
+        raise ValueError("mappings が空")
+
+    return mappings
+
+
 if __name__ == "__main__":
     main()
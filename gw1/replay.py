@@ -0,0 +1,317 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings( 'ignore' )
+
+import time
+import socket
+import argparse
+import threading
+import zlib
+
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from telegram.telegram_common import TelSocket
+from telegram.telegram_common import AcpSocket
+from telegram.telegram_frame import PROTO_V2
+from telegram.telegram_frame import FRAME_DATA
+from telegram.telegram_frame import FRAME_FLAG_Z
+from telegram.telegram_frame import FrameDecoder
+from telegram.telegram_capture import CaptureRecord
+from telegram.telegram_capture import DIR_SEND
+from telegram.telegram_capture import DIR_RECV
+from telegram.telegram_capture import read_capture
+
+# メモ
+# --capture で記録した電文を制御ソケットへ送り直し、ゲートウェイの負荷を再現する
+# 圧縮・クレジット・複数制御ソケットは交渉しない（"v2" と "maps" のみ）
+
+# 交渉する機能
+REPLAY_CAPS: Dict[str, str] = {"v2": "", "maps": ""}
+
+@dataclass
+class Parameters:
+    file: str
+    list: bool
+    role: str
+    host: str
+    port: int
+    direction: int
+    speed: float
+    linger: float
+
+
+@dataclass
+class Counter:
+    """相手から受信した量"""
+    frames: int = 0
+    nbytes: int = 0
+
+
+def main() -> None:
+
+    args = parse_args()
+    records = list(read_capture(args.file))
+    if args.list:
+        proc_list(records)
+        return
+
+    frames = [r for r in records if r.direction == args.direction and r.ftype & ~FRAME_FLAG_Z == FRAME_DATA]
+    if len(frames) == 0:
+        print("再生する電文なし file=" + args.file)
+        return
+
+    ctl = open_ctrl(args)
+    if ctl is None:
+        return
+    main_proc(args, ctl, frames)
+
+    return
+
+
+def proc_list(records: List[CaptureRecord]) -> None:
+    """記録の一覧表示
+
+    Args:
+        records (List[CaptureRecord]): 記録
+    """
+
+    if len(records) == 0:
+        return
+    t0 = records[0].ts
+    for r in records:
+        print("%12.6f %s type=0x%02X chan=%d len=%d cap=%d" % (
+            r.ts - t0, "S" if r.direction == DIR_SEND else "R", r.ftype, r.chan, r.length, len(r.data)))
+
+    return
+
+
+def open_ctrl(args: Parameters) -> Optional[TelSocket]:
+    """制御ソケットの接続とバージョン交渉
+
+    Args:
+        args (Parameters): 起動パラメータ
+
+    Returns:
+        None: 接続失敗
+        TelSocket: 制御ソケット
+    """
+
+    if args.role == "server":
+        # gw2 の代わりに gw1 からの接続を受ける
+        acp = AcpSocket()
+        acp.open(args.host, args.port, 1)
+        print("接続待ち port=" + str(args.port))
+        ctl = acp.accept()
+        acp.close()
+        if ctl is None:
+            return None
+        caps, _ = ctl.hello_server(REPLAY_CAPS)
+    else:
+        # gw1 の代わりに gw2 へ接続する
+        ctl = TelSocket()
+        if not ctl.connect(args.host, args.port):
+            print("接続失敗 " + args.host + ":" + str(args.port))
+            return None
+        caps, _ = ctl.hello_client(REPLAY_CAPS)
+
+    if "v2" not in caps:
+        print("v2 の交渉失敗")
+        ctl.close()
+        return None
+    ctl.set_name("ctrl")
+    ctl.set_proto(PROTO_V2)
+
+    return ctl
+
+
+def main_proc(args: Parameters, ctl: TelSocket, frames: List[CaptureRecord]) -> None:
+    """再生処理
+
+    記録時の間隔を speed 倍に縮めて送る（0 なら待たない）。
+    相手からの電文は別スレッドで読み捨てて数える。
+
+    Args:
+        args (Parameters): 起動パラメータ
+        ctl (TelSocket): 制御ソケット
+        frames (List[CaptureRecord]): 再生する電文
+    """
+
+    cnt = Counter()
+    th = threading.Thread(target=drain_proc, args=(ctl, cnt), daemon=True)
+    th.start()
+
+    decomp: Dict[int, "zlib._Decompress"] = {}
+    sent_frames = 0
+    sent_bytes = 0
+    t0 = frames[0].ts
+    start = time.monotonic()
+    try:
+        for r in frames:
+            if args.speed > 0:
+                wait = start + (r.ts - t0) / args.speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            bt_data = make_payload(r, decomp)
+            ctl.send_frame(FRAME_DATA, r.chan, bt_data)
+            sent_frames += 1
+            sent_bytes += len(bt_data)
+    except (ConnectionError, OSError):
+        print("制御ソケット切断検知")
+    elapsed = time.monotonic() - start
+
+    time.sleep(args.linger)
+    if ctl.sock is not None:
+        try:
+            ctl.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    th.join(1.0)
+    ctl.close()
+
+    print("sent_frames=%d sent_bytes=%d elapsed=%.3f mbps=%.2f fps=%.0f recv_frames=%d recv_bytes=%d" % (
+        sent_frames, sent_bytes, elapsed,
+        sent_bytes / 1048576 / elapsed if elapsed > 0 else 0.0,
+        sent_frames / elapsed if elapsed > 0 else 0.0,
+        cnt.frames, cnt.nbytes))
+
+    return
+
+
+def make_payload(r: CaptureRecord, decomp: Dict[int, "zlib._Decompress"]) -> bytes:
+    """送り直すデータの作成
+
+    データをすべて記録していればそのまま（圧縮済みなら伸張して）使い、
+    記録していなければ同じサイズの 0 で埋める（圧縮済みの電文は圧縮後のサイズ）。
+
+    Args:
+        r (CaptureRecord): 記録
+        decomp (Dict): チャネルごとの伸張器
+
+    Returns:
+        bytes: 送信データ
+    """
+
+    if len(r.data) == r.length:
+        if not r.ftype & FRAME_FLAG_Z:
+            return r.data
+        d = decomp.get(r.chan)
+        if d is None:
+            d = zlib.decompressobj()
+            decomp[r.chan] = d
+        try:
+            return d.decompress(r.data)
+        except zlib.error:
+            # ストリームの途中から記録されている
+            decomp.pop(r.chan, None)
+    return bytes(r.length)
+
+
+def drain_proc(ctl: TelSocket, cnt: Counter) -> None:
+    """相手からの電文の読み捨て
+
+    Args:
+        ctl (TelSocket): 制御ソケット
+        cnt (Counter): 受信量
+    """
+
+    sock = ctl.sock
+    if sock is None:
+        return
+    decoder = FrameDecoder(PROTO_V2)
+    while True:
+        try:
+            data = sock.recv(262144)
+        except OSError:
+            break
+        if not data:
+            break
+        cnt.nbytes += len(data)
+        decoder.feed(data)
+        for _ in decoder.frames():
+            cnt.frames += 1
+
+    return
+
+
+def parse_args() -> Parameters:
+    """コマンドライン引数解析処理
+
+    Returns:
+        Parameters: 解析結果格納オブジェクト
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--file",
+        type=str,
+        required=True,
+        help="--capture で記録したファイル",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="記録の一覧を表示して終了",
+    )
+    parser.add_argument(
+        "--role",
+        type=str,
+        choices=["server", "client"],
+        default="server",
+        help="再生する側（server: gw2 の代わりに gw1 の接続を受ける, client: gw1 の代わりに gw2 へ接続する）",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="接続先（client）または接続受付（server）のIPアドレス",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=10001,
+        help="コントロール用ポート番号",
+    )
+    parser.add_argument(
+        "--dir",
+        type=str,
+        choices=["recv", "send"],
+        default="recv",
+        help="再生する電文（recv: 記録したゲートウェイが受信した電文, send: 送信した電文）",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="再生速度の倍率（0: 間隔を空けずに送る）",
+    )
+    parser.add_argument(
+        "--linger",
+        type=float,
+        default=1.0,
+        help="送り終えた後に相手からの電文を待つ時間（秒）",
+    )
+
+    args = parser.parse_args()
+
+    params = Parameters(
+        file=args.file,
+        list=args.list,
+        role=args.role,
+        host=args.host,
+        port=args.port,
+        direction=DIR_RECV if args.dir == "recv" else DIR_SEND,
+        speed=args.speed,
+        linger=args.linger,
+    )
+
+    return params
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import zlib
+
+from typing import Dict
+from typing import Tuple
+
+from telegram.telegram_frame import FRAME_DATA
+from telegram.telegram_frame import FRAME_FLAG_Z
+
+# 圧縮レベル（ラズベリーパイでも負荷にならないよう最速）
+COMPRESS_LEVEL = 1
+
+# これより短いデータは圧縮しない
+COMPRESS_MIN = 64
+
+# 圧縮後のサイズが元のこの割合を超えたら圧縮の効かないデータとみなす
+COMPRESS_RATIO = 0.9
+
+# 圧縮の効かないデータと判定した後、圧縮せずに送る量（その後もう一度試す）
+COMPRESS_SKIP = 1048576
+
+
+class StreamCompressor:
+    """チャネルごとの zlib ストリーム圧縮
+
+    チャネルごとに圧縮器・伸張器を持ち、圧縮した電文は種別に FRAME_FLAG_Z を立てる。
+    電文ごとに Z_SYNC_FLUSH するため、受信側は電文単位で伸張できる。
+    圧縮しなかった電文はストリームに含めないので、送受信の状態はずれない。
+    圧縮後のサイズを見て効かないチャネルは COMPRESS_SKIP バイトの間圧縮を止める。
+    """
+
+    def __init__(self, level: int = COMPRESS_LEVEL) -> None:
+        """コンストラクタ
+
+        Args:
+            level (int): 圧縮レベル
+        """
+        self.level: int = level
+        self.comp: Dict[int, "zlib._Compress"] = {}
+        self.decomp: Dict[int, "zlib._Decompress"] = {}
+        self.skip: Dict[int, int] = {}
+        # 統計（圧縮を試みた量と圧縮後の量）
+        self.raw_bytes: int = 0
+        self.packed_bytes: int = 0
+
+    def pack(self, chan: int, data: bytes) -> Tuple[int, bytes]:
+        """送信データの圧縮
+
+        Args:
+            chan (int): チャネル番号
+            data (bytes): 送信データ
+
+        Returns:
+            (電文種別, 送信データ)
+        """
+        if len(data) < COMPRESS_MIN:
+            return (FRAME_DATA, data)
+        skip = self.skip.get(chan, 0)
+        if skip > 0:
+            self.skip[chan] = skip - len(data)
+            return (FRAME_DATA, data)
+
+        comp = self.comp.get(chan)
+        if comp is None:
+            comp = zlib.compressobj(self.level)
+            self.comp[chan] = comp
+        packed = comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+        self.raw_bytes += len(data)
+        self.packed_bytes += len(packed)
+
+        if len(packed) > len(data) * COMPRESS_RATIO:
+            # ストリームに入れた分は圧縮したまま送り、以降しばらく圧縮しない
+            self.skip[chan] = COMPRESS_SKIP
+        return (FRAME_DATA | FRAME_FLAG_Z, packed)
+
+    def unpack(self, chan: int, data: bytes) -> bytes:
+        """受信データの伸張
+
+        Args:
+            chan (int): チャネル番号
+            data (bytes): FRAME_FLAG_Z 付きの電文のデータ
+
+        Returns:
+            bytes: 伸張したデータ
+
+        Raises:
+            zlib.error: 伸張失敗
+        """
+        decomp = self.decomp.get(chan)
+        if decomp is None:
+            decomp = zlib.decompressobj()
+            self.decomp[chan] = decomp
+        return decomp.decompress(data)
+
+    def close(self, chan: int) -> None:
+        """チャネルの終了"""
+        self.comp.pop(chan, None)
+        self.decomp.pop(chan, None)
+        self.skip.pop(chan, None)
@@ -0,0 +1,83 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+from typing import Dict
+
+# チャネルごとの初期クレジット（相手の許可なしに送れる量）
+INITIAL_WINDOW = 262144
+
+
+class FlowControl:
+    """チャネルごとのクレジット（送信可能量）管理
+
+    送信側は相手から許可された量までしか送らない。
+    受信側はジョブソケットへ書き出し終えた量を溜め、窓の半分に達したら
+    CREDIT 電文で送信側へ追加の許可を返す。
+    """
+
+    def __init__(self, window: int = INITIAL_WINDOW) -> None:
+        """コンストラクタ
+
+        Args:
+            window (int): チャネルごとの窓の大きさ
+        """
+        self.window: int = window
+        self.send_credit: Dict[int, int] = {}
+        self.delivered: Dict[int, int] = {}
+        self.unreported: Dict[int, int] = {}
+
+    def open(self, chan: int) -> None:
+        """チャネルの開始"""
+        self.send_credit[chan] = self.window
+        self.delivered[chan] = 0
+        self.unreported[chan] = 0
+
+    def close(self, chan: int) -> None:
+        """チャネルの終了"""
+        self.send_credit.pop(chan, None)
+        self.delivered.pop(chan, None)
+        self.unreported.pop(chan, None)
+
+    def credit(self, chan: int) -> int:
+        """送信可能量"""
+        return self.send_credit.get(chan, 0)
+
+    def on_sent(self, chan: int, size: int) -> None:
+        """送信した量を差し引く"""
+        if chan in self.send_credit:
+            self.send_credit[chan] -= size
+
+    def on_credit(self, chan: int, size: int) -> bool:
+        """相手からの許可を加える
+
+        Returns:
+            True: 送信可能量が 0 から回復した
+        """
+        if chan not in self.send_credit:
+            return False
+        before = self.send_credit[chan]
+        self.send_credit[chan] = before + size
+        return before <= 0 and self.send_credit[chan] > 0
+
+    def on_delivered(self, chan: int, total: int) -> int:
+        """ジョブソケットへの書き出し済み総量の反映
+
+        Args:
+            chan (int): チャネル番号
+            total (int): これまでに書き出した総バイト数
+
+        Returns:
+            int: 相手へ返す許可量（返さない場合は 0）
+        """
+        if chan not in self.delivered:
+            return 0
+        self.unreported[chan] += total - self.delivered[chan]
+        self.delivered[chan] = total
+        if self.unreported[chan] < self.window // 2:
+            return 0
+        grant = self.unreported[chan]
+        self.unreported[chan] = 0
+        return grant
@@ -0,0 +1,233 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import struct
+
+from typing import Dict
+from typing import Tuple
+from typing import Optional
+from typing import Iterator
+from typing import Union
+
+# 電文形式
+#   v1: ユニット名(ASCII 4バイト) + サイズ(10進8桁) + データ
+#   v2: 種別(1バイト) + チャネル番号(32bit) + サイズ(32bit) + データ（ネットワークバイトオーダ）
+PROTO_V1 = 1
+PROTO_V2 = 2
+
+V1_NAMSIZ = 4
+V1_MSGSIZ = 8
+V1_HEADER_SIZE = V1_NAMSIZ + V1_MSGSIZ
+
+V2_HEADER = struct.Struct("!BII")
+V2_HEADER_SIZE = V2_HEADER.size
+
+# CREDIT 電文のデータ部（追加で送信を許可するバイト数）
+CREDIT_BODY = struct.Struct("!I")
+
+# 電文種別
+FRAME_DATA = 0x01
+FRAME_CREDIT = 0x02
+# チャネルの開始・終了（"open" 合意時のみ、未合意なら空の DATA 電文が終了）
+FRAME_OPEN = 0x03
+FRAME_CLOSE = 0x04
+# 制御ソケット自体の電文（チャネル番号は 0、再送の対象外）
+#   PING: 心拍（"hb" 合意時のみ）
+#   ACK: 受信済みの連番付き電文数（"resume" 合意時のみ）
+#   RESUME: 接続直後の受信済み数とセッションID（"resume" 合意時のみ）
+FRAME_PING = 0x05
+FRAME_ACK = 0x06
+FRAME_RESUME = 0x07
+LINK_FRAMES = (FRAME_PING, FRAME_ACK, FRAME_RESUME)
+FRAME_HELLO = 0x7F
+FRAME_UNKNOWN = 0xFF
+
+# 電文種別に立てるフラグ（データ部を zlib で圧縮済み、"zlib" 合意時のみ）
+FRAME_FLAG_Z = 0x80
+
+# 接続直後のバージョン交渉用ユニット名（v1形式で送受信する）
+HELLO_UNIT = "HELO"
+HELLO_TIMEOUT = 3.0
+
+# 自側が対応する機能
+CAPABILITIES: Dict[str, str] = {"v2": "", "credit": "", "links": "", "maps": "", "zlib": "", "open": "", "hb": "", "resume": ""}
+
+# 並列に張る制御ソケット数の上限
+MAX_LINKS = 16
+
+# チャネル番号の上位8ビットはポート対応付けの番号（"maps" 合意時のみ 0 以外を使う）
+MAP_SHIFT = 24
+MAX_MAP_ID = 0xFF
+CHAN_SEQ_MAX = (1 << MAP_SHIFT) - 1
+
+
+def unit_name(chan: int) -> str:
+    """チャネル番号からv1のユニット名を求める"""
+    return str(chan).zfill(V1_NAMSIZ)
+
+
+def is_close(ftype: int, data: bytes) -> bool:
+    """チャネルの終了を表す電文か（CLOSE 電文、または従来の空の DATA 電文）"""
+    return ftype == FRAME_CLOSE or (ftype == FRAME_DATA and len(data) == 0)
+
+
+def make_chan(map_id: int, seq: int) -> int:
+    """ポート対応付けの番号と通し番号からチャネル番号を求める"""
+    return (map_id << MAP_SHIFT) | seq
+
+
+def chan_map(chan: int) -> int:
+    """チャネル番号からポート対応付けの番号を求める"""
+    return chan >> MAP_SHIFT
+
+
+def pack_v1(unit: str, length: int) -> bytes:
+    """v1ヘッダの作成
+
+    Args:
+        unit (str): ユニット名
+        length (int): データサイズ
+
+    Returns:
+        bytes: ヘッダ
+    """
+    return (unit.ljust(V1_NAMSIZ) + str(length).zfill(V1_MSGSIZ)).encode()
+
+
+def pack_v2(ftype: int, chan: int, length: int) -> bytes:
+    """v2ヘッダの作成
+
+    Args:
+        ftype (int): 電文種別
+        chan (int): チャネル番号
+        length (int): データサイズ
+
+    Returns:
+        bytes: ヘッダ
+    """
+    return V2_HEADER.pack(ftype, chan, length)
+
+
+def parse_unit(unit: str) -> Tuple[int, int]:
+    """v1のユニット名から電文種別とチャネル番号を求める
+
+    Args:
+        unit (str): ユニット名
+
+    Returns:
+        (電文種別, チャネル番号)
+    """
+    if unit == HELLO_UNIT:
+        return (FRAME_HELLO, 0)
+    if unit.isdigit():
+        return (FRAME_DATA, int(unit))
+    return (FRAME_UNKNOWN, 0)
+
+
+def encode_caps(caps: Dict[str, str]) -> bytes:
+    """機能一覧の符号化（"名前" または "名前=値" を空白区切り）"""
+    tokens = []
+    for k, v in caps.items():
+        tokens.append(k if v == "" else k + "=" + v)
+    return " ".join(tokens).encode()
+
+
+def parse_links(caps: Dict[str, str]) -> Tuple[int, int]:
+    """合意した機能一覧から制御ソケットの番号と本数を求める
+
+    "links=番号/本数" がなければ 1 本だけの接続とみなす。
+
+    Returns:
+        (制御ソケットの番号, 制御ソケットの本数)
+    """
+    idx, _, num = caps.get("links", "").partition("/")
+    if not idx.isdigit() or not num.isdigit():
+        return (0, 1)
+    it_num = min(max(int(num), 1), MAX_LINKS)
+    it_idx = int(idx)
+    if it_idx >= it_num:
+        return (0, 1)
+    return (it_idx, it_num)
+
+
+def decode_caps(data: bytes) -> Dict[str, str]:
+    """機能一覧の復号"""
+    caps: Dict[str, str] = {}
+    for token in data.decode(errors="replace").split():
+        k, _, v = token.partition("=")
+        caps[k] = v
+    return caps
+
+
+class FrameDecoder:
+    """電文の逐次復号器
+
+    受信済みのバイト列を溜めておき、完結した電文を順に取り出す。
+    未完の電文は次の受信まで持ち越す。電文ごとに取り出すため、
+    途中で形式（v1/v2）を切り替えても後続の電文は新しい形式で解釈される。
+    """
+
+    def __init__(self, proto: int = PROTO_V1) -> None:
+        """コンストラクタ"""
+        self.proto: int = proto
+        self.buf: bytearray = bytearray()
+        self.pos: int = 0
+        # 取り出した電文数
+        self.count: int = 0
+
+    def feed(self, data: Union[bytes, memoryview]) -> None:
+        """受信データの追加"""
+        if self.pos > 0:
+            # 取り出し済みの部分を捨てる
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data
+
+    def pending(self) -> int:
+        """未取り出しのバイト数"""
+        return len(self.buf) - self.pos
+
+    def next_frame(self) -> Optional[Tuple[int, int, bytes]]:
+        """完結した電文を1つ取り出す
+
+        Returns:
+            None: 完結した電文がない
+            (電文種別, チャネル番号, データ)
+        """
+        avail = len(self.buf) - self.pos
+        if self.proto == PROTO_V2:
+            if avail < V2_HEADER_SIZE:
+                return None
+            ftype, chan, size = V2_HEADER.unpack_from(self.buf, self.pos)
+            head = V2_HEADER_SIZE
+        else:
+            if avail < V1_HEADER_SIZE:
+                return None
+            unit = self.buf[self.pos:self.pos + V1_NAMSIZ].decode(errors="replace")
+            size = int(self.buf[self.pos + V1_NAMSIZ:self.pos + V1_HEADER_SIZE])
+            ftype, chan = parse_unit(unit)
+            head = V1_HEADER_SIZE
+
+        if avail < head + size:
+            return None
+
+        start = self.pos + head
+        with memoryview(self.buf) as mv:
+            data = bytes(mv[start:start + size])
+        self.pos = start + size
+        if self.pos == len(self.buf):
+            self.buf.clear()
+            self.pos = 0
+        self.count += 1
+        return (ftype, chan, data)
+
+    def frames(self) -> Iterator[Tuple[int, int, bytes]]:
+        """完結した電文をすべて取り出す"""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
@@ -0,0 +1,119 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import time
+import socket
+
+from collections import deque
+
+from typing import Deque
+from typing import Optional
+from typing import Tuple
+
+from telegram.telegram_common import TelSocket
+
+# 接続を使わずに置いておく時間の既定値（秒）
+POOL_MAX_AGE = 30.0
+
+
+class ConnPool:
+    """接続先ごとの接続済みソケットの置き場
+
+    新しいチャネルが接続の確立を待たずに使えるよう、非ブロッキング接続を
+    開始したソケットを min_idle 本まで用意しておく。置いてから max_age 秒を
+    過ぎたもの、相手が切断したものは使わずに閉じる。
+    置いている間は監視しない（SocketRegistry に登録しない）。
+    """
+
+    def __init__(self, ip: str, port: int, min_idle: int, max_age: float = POOL_MAX_AGE) -> None:
+        """コンストラクタ
+
+        Args:
+            ip (str): 接続先IPアドレス
+            port (int): 接続先ポート番号
+            min_idle (int): 用意しておく本数
+            max_age (float): 置いておく時間の上限（秒）
+        """
+        self.ip: str = ip
+        self.port: int = port
+        self.min_idle: int = min_idle
+        self.max_age: float = max_age
+        # (ソケット, 接続開始時刻)、古い順
+        self.idle: Deque[Tuple[TelSocket, float]] = deque()
+        # 統計（用意したものを使えた回数、使えずに新規接続させた回数）
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def claim(self) -> Optional[TelSocket]:
+        """用意したソケットを1本取り出す（接続中のこともある）
+
+        Returns:
+            None: 使えるものがない
+            TelSocket: ソケット
+        """
+        now = time.monotonic()
+        while self.idle:
+            sck, ts = self.idle.popleft()
+            if now - ts < self.max_age and alive(sck):
+                if sck.connecting and connected(sck):
+                    # 置いている間に接続済み（すぐに書き出せる）
+                    sck.finish_connect()
+                self.hits += 1
+                return sck
+            sck.close()
+        self.misses += 1
+        return None
+
+    def refill(self) -> int:
+        """古いものを閉じ、min_idle 本まで接続を開始する
+
+        Returns:
+            int: 接続を開始した本数
+        """
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][1] >= self.max_age:
+            self.idle.popleft()[0].close()
+
+        started = 0
+        while len(self.idle) < self.min_idle:
+            sck = TelSocket()
+            if not sck.connect_nb(self.ip, self.port):
+                # 接続先が受け付けない間は次の機会に回す
+                break
+            self.idle.append((sck, now))
+            started += 1
+        return started
+
+    def close(self) -> None:
+        """終了処理"""
+        while self.idle:
+            self.idle.popleft()[0].close()
+
+
+def alive(sck: TelSocket) -> bool:
+    """置いている間に切断・接続失敗していないか（受信データは読まずに残す）"""
+    if sck.sock is None:
+        return False
+    try:
+        data = sck.sock.recv(1, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        # 接続中、または接続済みで受信データなし
+        return True
+    except OSError:
+        return False
+    # 相手が先に送ってきたデータは使い始めてから中継する
+    return len(data) > 0
+
+
+def connected(sck: TelSocket) -> bool:
+    """接続が完了しているか"""
+    if sck.sock is None:
+        return False
+    try:
+        sck.sock.getpeername()
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,219 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import os
+import time
+import signal
+import threading
+
+from types import FrameType
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+# 標本採取の間隔（秒）
+SAMPLE_INTERVAL = 0.005
+
+# 標本の最大の深さ（これより深い部分は呼び出し元側を捨てる）
+SAMPLE_DEPTH = 64
+
+
+class Profiler:
+    """稼働中に切り替える計測（処理時間の計測と標本採取）
+
+    処理時間の計測は有効にした間だけ対象のメソッドを計測用の関数に差し替え、
+    無効にすると元に戻す。標本採取は有効にした間だけ別スレッドで
+    主スレッドの呼び出し履歴を一定間隔で集め、flame graph 用の
+    collapsed stack 形式（"関数;関数;... 回数"）で書き出す。
+    どちらも無効の間は何も差し込まないため負荷はない。
+    """
+
+    def __init__(self, name: str, path: str = "") -> None:
+        """コンストラクタ
+
+        Args:
+            name (str): 出力ファイル名に使う名前
+            path (str): 出力先ディレクトリ
+        """
+        if len(path) == 0:
+            path = os.extsep
+        self.name: str = name
+        self.path: str = path
+        # (クラス, 属性名, 表示名)
+        self.targets: List[Tuple[type, str, str]] = []
+        # 表示名 → [回数, 合計秒, 最大秒]
+        self.stats: Dict[str, List[float]] = {}
+        self.saved: Dict[str, object] = {}
+        # 処理時間の計測の開始・終了時に呼ぶ関数（引数は計測中か）
+        self.hooks: List[Callable[[bool], None]] = []
+        self.timing: bool = False
+        self.timing_at: float = 0.0
+        self.sampler: Optional[threading.Thread] = None
+        self.stop: threading.Event = threading.Event()
+
+    def add_timer(self, owner: type, attr: str, label: str = "") -> None:
+        """処理時間の計測対象の登録
+
+        Args:
+            owner (type): メソッドを持つクラス
+            attr (str): メソッド名
+            label (str): 表示名（省略時は クラス名.メソッド名）
+        """
+        self.targets.append((owner, attr, label or owner.__name__ + "." + attr))
+
+    def add_hook(self, fn: Callable[[bool], None]) -> None:
+        """処理時間の計測の開始・終了時に呼ぶ関数の登録（呼び出し履歴の深さに頼る処理の補正用）"""
+        self.hooks.append(fn)
+
+    def install(self) -> bool:
+        """SIGUSR1 で処理時間の計測、SIGUSR2 で標本採取を切り替える
+
+        Returns:
+            True: 登録した
+            False: シグナルのない環境（Windows）
+        """
+        if not hasattr(signal, "SIGUSR1"):
+            return False
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_timers())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_sampler())
+        return True
+
+    def file_name(self, kind: str) -> str:
+        """出力ファイルのパス"""
+        return (self.path + os.sep + "prof-" + self.name + "-" + str(os.getpid())
+            + "-" + time.strftime("%Y%m%d%H%M%S") + os.extsep + kind)
+
+    def toggle_timers(self) -> None:
+        """処理時間の計測の切り替え（終了時に結果を書き出す）"""
+        if self.timing:
+            self.timers_off()
+        else:
+            self.timers_on()
+
+    def timers_on(self) -> None:
+        """処理時間の計測開始"""
+        if self.timing:
+            return
+        self.stats = {}
+        for owner, attr, label in self.targets:
+            raw = owner.__dict__.get(attr)
+            if raw is None:
+                continue
+            stat = [0, 0.0, 0.0]
+            self.stats[label] = stat
+            self.saved[label] = raw
+            if isinstance(raw, classmethod):
+                setattr(owner, attr, classmethod(timed(raw.__func__, stat)))
+            elif isinstance(raw, staticmethod):
+                setattr(owner, attr, staticmethod(timed(raw.__func__, stat)))
+            else:
+                setattr(owner, attr, timed(raw, stat))
+        self.timing = True
+        self.timing_at = time.monotonic()
+        for fn in self.hooks:
+            fn(True)
+
+    def timers_off(self) -> Optional[str]:
+        """処理時間の計測終了
+
+        Returns:
+            None: 計測していない
+            str: 結果を書き出したファイルのパス
+        """
+        if not self.timing:
+            return None
+        for owner, attr, label in self.targets:
+            raw = self.saved.pop(label, None)
+            if raw is not None:
+                setattr(owner, attr, raw)
+        self.timing = False
+        for fn in self.hooks:
+            fn(False)
+
+        elapsed = time.monotonic() - self.timing_at
+        lines = ["# elapsed=%.3fs" % elapsed, "%-32s %10s %12s %10s %10s" % ("name", "count", "total_ms", "avg_us", "max_us")]
+        for label, (count, total, peak) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+            lines.append("%-32s %10d %12.3f %10.1f %10.1f" % (
+                label, count, total * 1000, total / count * 1e6 if count > 0 else 0.0, peak * 1e6))
+        path = self.file_name("timers")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def toggle_sampler(self) -> None:
+        """標本採取の切り替え（終了時に採取スレッドが結果を書き出す）"""
+        if self.sampler is not None and self.sampler.is_alive():
+            self.stop.set()
+        else:
+            self.sampler_on()
+
+    def sampler_on(self, interval: float = SAMPLE_INTERVAL) -> None:
+        """標本採取開始
+
+        Args:
+            interval (float): 採取間隔（秒）
+        """
+        if self.sampler is not None and self.sampler.is_alive():
+            return
+        self.stop = threading.Event()
+        target = threading.main_thread().ident
+        self.sampler = threading.Thread(target=self.sample_loop, args=(target, interval, self.stop), daemon=True)
+        self.sampler.start()
+
+    def sampler_off(self) -> None:
+        """標本採取終了（書き出しを待つ）"""
+        if self.sampler is None:
+            return
+        self.stop.set()
+        self.sampler.join()
+        self.sampler = None
+
+    def sample_loop(self, target: Optional[int], interval: float, stop: threading.Event) -> None:
+        """標本採取スレッド"""
+        counts: Dict[str, int] = {}
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(target) if target is not None else None
+            if frame is None:
+                continue
+            key = collapse(frame)
+            counts[key] = counts.get(key, 0) + 1
+
+        path = self.file_name("folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for key, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+                f.write(key + " " + str(n) + "\n")
+
+
+def timed(fn: Callable[..., object], stat: List[float]) -> Callable[..., object]:
+    """処理時間を stat（回数, 合計秒, 最大秒）へ積む関数で包む"""
+
+    def wrapper(*args: object, **kwargs: object) -> object:
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            dt = time.perf_counter() - t0
+            stat[0] += 1
+            stat[1] += dt
+            if dt > stat[2]:
+                stat[2] = dt
+
+    wrapper.__name__ = getattr(fn, "__name__", "wrapper")
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+
+def collapse(frame: Optional[FrameType]) -> str:
+    """呼び出し履歴を "ファイル:関数;..."（呼び出し元が先）にまとめる"""
+    names: List[str] = []
+    while frame is not None and len(names) < SAMPLE_DEPTH:
+        code = frame.f_code
+        names.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
@@ -0,0 +1,139 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import time
+
+from collections import deque
+
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Deque
+from typing import Optional
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from telegram.telegram_metrics import Histogram
+
+# 優先度（値が小さいほど先に送る）
+PRIO_HIGH = 0
+PRIO_NORMAL = 1
+
+# 1巡で各チャネルに割り当てる送信量
+SCHED_QUANTUM = 16384
+
+# チャネルごとの送信待ちの上限（超えたらジョブソケットからの受信を止める）
+SCHED_CHAN_LIMIT = 262144
+
+# 制御ソケットの送信待ちをこの量までに抑え、残りはスケジューラで順番を決める
+SCHED_BUDGET = 65536
+
+
+class FrameScheduler:
+    """制御ソケットへ送る電文の公平スケジューラ
+
+    チャネルごとに送信待ちを持ち、優先度の高い組から順に
+    Deficit Round Robin で取り出す。同じチャネルの電文の順序は保たれる。
+    """
+
+    def __init__(self, quantum: int = SCHED_QUANTUM) -> None:
+        """コンストラクタ
+
+        Args:
+            quantum (int): 1巡で各チャネルに割り当てる送信量
+        """
+        self.quantum: int = quantum
+        self.queues: Dict[int, Deque[Tuple[int, bytes, float]]] = {}
+        self.backlog: Dict[int, int] = {}
+        self.deficit: Dict[int, int] = {}
+        self.prio: Dict[int, int] = {}
+        self.active: List[Deque[int]] = [deque(), deque()]
+        # 登録から取り出しまでの待ち時間の記録先（統計有効時のみ）
+        self.delays: Optional["Histogram"] = None
+
+    def set_priority(self, chan: int, prio: int) -> None:
+        """チャネルの優先度の設定"""
+        self.prio[chan] = prio
+
+    def push(self, chan: int, ftype: int, data: bytes) -> None:
+        """電文の登録
+
+        Args:
+            chan (int): チャネル番号
+            ftype (int): 電文種別
+            data (bytes): 送信データ
+        """
+        q = self.queues.get(chan)
+        if q is None:
+            q = deque()
+            self.queues[chan] = q
+            self.backlog[chan] = 0
+            self.deficit[chan] = 0
+        if len(q) == 0:
+            self.active[self.prio.get(chan, PRIO_NORMAL)].append(chan)
+        q.append((ftype, data, time.monotonic() if self.delays is not None else 0.0))
+        self.backlog[chan] += len(data)
+
+    def pending(self, chan: int) -> int:
+        """チャネルの送信待ちバイト数"""
+        return self.backlog.get(chan, 0)
+
+    def empty(self) -> bool:
+        """送信待ちがないか"""
+        return len(self.active[PRIO_HIGH]) == 0 and len(self.active[PRIO_NORMAL]) == 0
+
+    def discard(self, chan: int) -> None:
+        """チャネルの送信待ちの破棄（チャネル終了時）"""
+        q = self.queues.pop(chan, None)
+        self.backlog.pop(chan, None)
+        self.deficit.pop(chan, None)
+        self.prio.pop(chan, None)
+        if q is not None and len(q) > 0:
+            for act in self.active:
+                if chan in act:
+                    act.remove(chan)
+
+    def clear(self) -> None:
+        """全チャネルの送信待ちの破棄"""
+        for chan in list(self.queues):
+            self.discard(chan)
+        self.prio.clear()
+
+    def pop_batch(self, budget: int) -> List[Tuple[int, int, bytes]]:
+        """送信する電文の取り出し
+
+        Args:
+            budget (int): 今回取り出す量の目安（バイト）
+
+        Returns:
+            (電文種別, チャネル番号, データ) の並び
+        """
+        out: List[Tuple[int, int, bytes]] = []
+        now = time.monotonic() if self.delays is not None else 0.0
+        for act in self.active:
+            while len(act) > 0 and budget > 0:
+                chan = act.popleft()
+                q = self.queues[chan]
+                self.deficit[chan] += self.quantum
+                while len(q) > 0:
+                    # 空の電文（切断通知）も 1 バイト分として数える
+                    size = max(len(q[0][1]), 1)
+                    if size > self.deficit[chan]:
+                        break
+                    ftype, data, queued = q.popleft()
+                    if self.delays is not None and queued > 0.0:
+                        self.delays.observe(now - queued)
+                    self.deficit[chan] -= size
+                    self.backlog[chan] -= len(data)
+                    budget -= size
+                    out.append((ftype, chan, data))
+                if len(q) == 0:
+                    self.deficit[chan] = 0
+                else:
+                    act.append(chan)
+            if budget <= 0:
+                break
+        return out
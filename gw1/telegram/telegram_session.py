@@ -0,0 +1,226 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import os
+import time
+import struct
+
+from collections import deque
+
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+# 心拍の間隔・無受信で切断とみなす時間の既定値（秒）
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 15.0
+
+# 制御ソケットの再接続を待ってチャネルを保持する時間の既定値（秒）
+RESUME_TIMEOUT = 60.0
+
+# チャネルごとの再送用に保持する量の上限（超えたらジョブソケットからの受信を止める）
+RESUME_CHAN_LIMIT = 524288
+
+# 連番付き電文をこの量・数だけ受信するごとに ACK を返す（心拍の間隔ごとにも返す）
+RESUME_ACK_BYTES = 65536
+RESUME_ACK_FRAMES = 256
+
+# ACK 電文のデータ部（受信済みの連番付き電文数）
+SEQ_BODY = struct.Struct("!Q")
+
+# RESUME 電文のデータ部（受信済み数, 自側のセッションID, 相手のものと認識しているセッションID）
+SESSION_ID_SIZE = 16
+RESUME_BODY = struct.Struct("!Q" + str(SESSION_ID_SIZE) + "s" + str(SESSION_ID_SIZE) + "s")
+NO_SESSION = bytes(SESSION_ID_SIZE)
+
+
+class Heartbeat:
+    """制御ソケットの心拍（一定間隔の送信時期と無受信の検知）"""
+
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, timeout: float = HEARTBEAT_TIMEOUT) -> None:
+        """コンストラクタ
+
+        Args:
+            interval (float): 送信間隔（秒）
+            timeout (float): 無受信で切断とみなす時間（秒）
+        """
+        self.interval: float = interval
+        self.timeout: float = timeout
+        self.sent_at: float = 0.0
+        self.recv_at: List[float] = []
+
+    def start(self, links: int) -> None:
+        """制御ソケットの接続完了"""
+        now = time.monotonic()
+        self.sent_at = now
+        self.recv_at = [now] * links
+
+    def on_recv(self, idx: int) -> None:
+        """制御ソケットからの受信"""
+        self.recv_at[idx] = time.monotonic()
+
+    def due(self, now: float) -> bool:
+        """送信時期か（True を返したら次の間隔まで False）"""
+        if now - self.sent_at < self.interval:
+            return False
+        self.sent_at = now
+        return True
+
+    def dead(self, now: float) -> Optional[int]:
+        """無受信が続いている制御ソケットの番号（なければ None）"""
+        for idx, at in enumerate(self.recv_at):
+            if now - at > self.timeout:
+                return idx
+        return None
+
+
+class LinkSeq:
+    """制御ソケット1本分の連番と再送用の電文"""
+
+    def __init__(self) -> None:
+        # 送信した連番付き電文数と、相手が受信を確認した数
+        self.sent: int = 0
+        self.acked: int = 0
+        # 未確認の電文 (電文種別, チャネル番号, データ)、acked + 1 番目から順に
+        self.buf: Deque[Tuple[int, int, bytes]] = deque()
+        # 受信した連番付き電文数と、ACK で返した数
+        self.recv: int = 0
+        self.reported: int = 0
+        self.recv_bytes: int = 0
+        # 相手の RESUME を処理し、連番付き電文を送ってよいか
+        self.ready: bool = False
+
+
+class Session:
+    """制御ソケットが切れてもチャネルを保つためのセッション
+
+    DATA・CREDIT・OPEN・CLOSE 電文に制御ソケットごとの連番を振り
+    （電文には載せず、送受信した数で数える）、相手の ACK までは再送用に保持する。
+    再接続すると双方が RESUME 電文で受信済み数とセッションIDを伝え、
+    同じセッションなら未受信の分から送り直す。
+    どちらかが別のセッション（再起動など）なら、双方ともチャネルを破棄してやり直す。
+    """
+
+    def __init__(self, links: int) -> None:
+        """コンストラクタ
+
+        Args:
+            links (int): 制御ソケットの本数
+        """
+        self.sid: bytes = os.urandom(SESSION_ID_SIZE)
+        self.peer_sid: bytes = NO_SESSION
+        self.seqs: List[LinkSeq] = [LinkSeq() for _ in range(links)]
+        # チャネルごとの再送用に保持している量
+        self.unacked: Dict[int, int] = {}
+        # 今回の接続で再開できるか（最初の RESUME で決める、未処理なら None）
+        self.resumed: Optional[bool] = None
+        # 制御ソケットが切れた時刻（接続中は 0）
+        self.down_at: float = 0.0
+
+    def begin(self) -> None:
+        """制御ソケットの接続完了（相手の RESUME を待つ）"""
+        self.resumed = None
+        self.down_at = 0.0
+        for ls in self.seqs:
+            ls.ready = False
+
+    def down(self) -> None:
+        """制御ソケットの切断"""
+        self.down_at = time.monotonic()
+        for ls in self.seqs:
+            ls.ready = False
+
+    def reset(self) -> None:
+        """連番と再送用の電文の破棄"""
+        self.seqs = [LinkSeq() for _ in self.seqs]
+        self.unacked.clear()
+
+    def sent(self, idx: int, ftype: int, chan: int, data: bytes) -> None:
+        """連番付き電文の送信"""
+        ls = self.seqs[idx]
+        ls.sent += 1
+        ls.buf.append((ftype, chan, data))
+        self.unacked[chan] = self.unacked.get(chan, 0) + len(data)
+
+    def congested(self, chan: int) -> bool:
+        """チャネルの再送用の保持量が上限を超えているか"""
+        return self.unacked.get(chan, 0) >= RESUME_CHAN_LIMIT
+
+    def received(self, idx: int, size: int) -> bool:
+        """連番付き電文の受信
+
+        Returns:
+            True: ACK を返す時期
+        """
+        ls = self.seqs[idx]
+        ls.recv += 1
+        ls.recv_bytes += size
+        return ls.recv_bytes >= RESUME_ACK_BYTES or ls.recv - ls.reported >= RESUME_ACK_FRAMES
+
+    def ack_due(self, idx: int) -> bool:
+        """前回の ACK 以降に受信があるか"""
+        ls = self.seqs[idx]
+        return ls.recv != ls.reported
+
+    def ack_body(self, idx: int) -> bytes:
+        """ACK 電文のデータ部"""
+        ls = self.seqs[idx]
+        ls.reported = ls.recv
+        ls.recv_bytes = 0
+        return SEQ_BODY.pack(ls.recv)
+
+    def on_ack(self, idx: int, body: bytes) -> Set[int]:
+        """相手の ACK の処理
+
+        Returns:
+            Set[int]: 保持量が減ったチャネル
+        """
+        return self.trim(idx, SEQ_BODY.unpack(body)[0])
+
+    def trim(self, idx: int, count: int) -> Set[int]:
+        """相手が受信済みの電文を再送用から外す"""
+        ls = self.seqs[idx]
+        chans: Set[int] = set()
+        while ls.acked < count and ls.buf:
+            _, chan, data = ls.buf.popleft()
+            ls.acked += 1
+            left = self.unacked.get(chan, 0) - len(data)
+            if left > 0:
+                self.unacked[chan] = left
+            else:
+                self.unacked.pop(chan, None)
+            chans.add(chan)
+        return chans
+
+    def resume_body(self, idx: int) -> bytes:
+        """RESUME 電文のデータ部"""
+        return RESUME_BODY.pack(self.seqs[idx].recv, self.sid, self.peer_sid)
+
+    def on_resume(self, idx: int, body: bytes) -> Optional[List[Tuple[int, int, bytes]]]:
+        """相手の RESUME の処理（以降この制御ソケットへ連番付き電文を送ってよい）
+
+        双方が同じ条件（互いのセッションIDを覚えているか）で判断するため、
+        再開するかどうかは両側で一致する。
+
+        Returns:
+            None: 再開できない（連番は破棄済み。呼び出し側で全チャネルを破棄する）
+            List: 再送する電文 (電文種別, チャネル番号, データ)
+        """
+        count, peer_sid, seen_sid = RESUME_BODY.unpack(body)
+        first = self.resumed is None
+        if first:
+            self.resumed = peer_sid == self.peer_sid and seen_sid == self.sid and self.peer_sid != NO_SESSION
+            if not self.resumed:
+                self.peer_sid = peer_sid
+                self.reset()
+        self.seqs[idx].ready = True
+        if not self.resumed:
+            return None if first else []
+        self.trim(idx, count)
+        return list(self.seqs[idx].buf)
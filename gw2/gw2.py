@@ -4,16 +4,72 @@ import warnings
 sys.dont_write_bytecode = True
 warnings.filterwarnings( 'ignore' )
 
+import os
+import time
+import json
+import zlib
+import signal
 import argparse
+import asyncio
+import selectors
+import traceback
 
 from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
 from typing import Optional
 from typing import List
+from typing import Dict
+from typing import Set
+from typing import Tuple
+from typing import Iterable
+from typing import Callable
 
 from log.log import Log
+from log.log import LOG_DUMP_MAX
 from telegram.telegram_common import TelSocket
 from telegram.telegram_common import AcpSocket
+from telegram.telegram_common import SocketRegistry
 from telegram.telegram_common import SocketSelect
+from telegram.telegram_common import EVENT_READ
+from telegram.telegram_common import EVENT_WRITE
+from telegram.telegram_async import AsyncTelSocket
+from telegram.telegram_frame import PROTO_V1
+from telegram.telegram_frame import PROTO_V2
+from telegram.telegram_frame import FRAME_DATA
+from telegram.telegram_frame import FRAME_CREDIT
+from telegram.telegram_frame import FRAME_OPEN
+from telegram.telegram_frame import FRAME_CLOSE
+from telegram.telegram_frame import FRAME_PING
+from telegram.telegram_frame import FRAME_ACK
+from telegram.telegram_frame import FRAME_RESUME
+from telegram.telegram_frame import LINK_FRAMES
+from telegram.telegram_frame import HELLO_TIMEOUT
+from telegram.telegram_frame import FRAME_FLAG_Z
+from telegram.telegram_frame import CREDIT_BODY
+from telegram.telegram_frame import CAPABILITIES
+from telegram.telegram_frame import unit_name
+from telegram.telegram_frame import is_close
+from telegram.telegram_frame import parse_links
+from telegram.telegram_frame import make_chan
+from telegram.telegram_frame import MAX_MAP_ID
+from telegram.telegram_frame import CHAN_SEQ_MAX
+from telegram.telegram_flow import FlowControl
+from telegram.telegram_compress import StreamCompressor
+from telegram.telegram_capture import FrameCapture
+from telegram.telegram_metrics import Metrics
+from telegram.telegram_metrics import start_metrics_server
+from telegram.telegram_prof import Profiler
+from telegram.telegram_sched import FrameScheduler
+from telegram.telegram_sched import PRIO_HIGH
+from telegram.telegram_sched import SCHED_CHAN_LIMIT
+from telegram.telegram_sched import SCHED_BUDGET
+from telegram.telegram_hello import Handshake
+from telegram.telegram_session import Heartbeat
+from telegram.telegram_session import Session
+from telegram.telegram_session import HEARTBEAT_INTERVAL
+from telegram.telegram_session import HEARTBEAT_TIMEOUT
+from telegram.telegram_session import RESUME_TIMEOUT
 
 # メモ
 # インターネット上で参照可能なサーバに配置されるプログラム
@@ -21,12 +77,69 @@ from telegram.telegram_common import SocketSelect
 lg: Log = None
 nm: int = 0
 
+# 監視プロセスへの統計報告用パイプ（ワーカとして動くときのみ）
+stats_fd: int = -1
+stats_at: float = 0.0
+
+# 統計の報告・集計間隔（秒）
+STATS_INTERVAL = 10.0
+# ワーカの再起動間隔の下限（秒、起動直後に落ち続ける場合の空回り防止）
+RESTART_INTERVAL = 1.0
+# asyncio版でチャネルごとに溜めるジョブソケットへの送信待ち電文数の上限
+ASYNC_QUEUE_HIGH = 256
+# v1のユニット名は4桁まで
+UNIT_SEQ_MAX = 9999
+
+@dataclass
+class Mapping:
+    """ポート対応付け（ジョブ用ポートとチャネル番号の上位8ビットの対応）"""
+    map_id: int
+    job_port: int
+    prio: bool = False
+
+@dataclass
+class Tunnel:
+    """監視モードでワーカ1つが受け持つ中継（制御用ポートとポート対応付け）"""
+    ctrl_port: int
+    mappings: Dict[int, Mapping]
+
 @dataclass
 class Parameters:
     ctrl_port: int
-    job_port: int
+    mappings: Dict[int, Mapping]
     debug: bool
+    log_async: bool
+    log_no_caller: bool
+    log_dump_max: int
     logfile: str
+    engine: str
+    proto: int
+    prio_ports: List[int]
+    metrics_port: int
+    capture: str
+    capture_size: int
+    capture_snap: int
+    hb_interval: float
+    hb_timeout: float
+    resume_timeout: float
+    # 監視モードで起動するワーカごとの中継（空なら監視モードではない）
+    tunnels: List[Tunnel] = field(default_factory=list)
+
+@dataclass
+class Worker:
+    """監視プロセスから見たワーカの状態"""
+    idx: int
+    tunnel: Tunnel
+    ctl: AcpSocket
+    acps: List[AcpSocket]
+    pid: int = 0
+    # 統計報告用パイプの読み出し側
+    rfd: int = -1
+    started: float = 0.0
+    # 再起動予定の時刻（0: 予定なし）
+    restart_at: float = 0.0
+    buf: bytes = b""
+    stats: Dict[str, int] = field(default_factory=dict)
 
 def main() -> None:
 
@@ -38,118 +151,1329 @@ def main() -> None:
 
     if args.debug:
         lg.debug_on()
-    main_proc(args)
+    if args.log_async:
+        lg.async_on()
+    if args.log_no_caller:
+        lg.caller_off()
+    lg.dump_limit(args.log_dump_max)
+    open_profiler(args)
+    # 監視モードではワーカごとに別ファイルへ記録する
+    cap = open_capture(args, args.capture if len(args.tunnels) == 0 else "")
+    if len(args.tunnels) > 0:
+        supervise(args)
+    elif args.engine == "asyncio":
+        asyncio.run(main_proc_async(args))
+    else:
+        main_proc(args)
+    if cap is not None:
+        cap.close()
     return
 
-def main_proc(args: Parameters) -> None:
+def open_profiler(args: Parameters) -> Profiler:
+    """稼働中に切り替える計測の準備
 
-    global nm
+    SIGUSR1 で主な処理の処理時間の計測、SIGUSR2 で標本採取を開始し、
+    もう一度送ると終了してログと同じ場所へ結果を書き出す（prof-*.timers / prof-*.folded）。
+    処理時間の計測は select 版の処理が対象。
 
-    ctl: AcpSocket = None
-    ctl_sock: TelSocket = None
+    Args:
+        args (Parameters): 起動パラメータ
 
-    job: AcpSocket = None
+    Returns:
+        Profiler: 計測器
+    """
+
+    prof = Profiler(args.logfile)
+    prof.add_timer(SocketSelect, "select")
+    prof.add_timer(SocketRegistry, "select_events")
+    prof.add_timer(TelSocket, "receive")
+    prof.add_timer(TelSocket, "send")
+    prof.add_timer(TelSocket, "fill")
+    prof.add_timer(TelSocket, "receive_raw")
+    prof.add_timer(TelSocket, "send_raw")
+    prof.add_timer(TelSocket, "flush")
+    prof.add_timer(TelSocket, "write_pending")
+    prof.add_timer(TelSocket, "connect")
+    prof.add_timer(Log, "output")
+    prof.add_timer(Log, "output_dump")
+    # 包んだ分だけログの呼び出し元が1段深くなる
+    prof.add_hook(lambda on: setattr(lg, "caller_depth", 3 if on else 2))
+    if prof.install():
+        lg.output("INF", "計測の切り替え SIGUSR1: 処理時間 SIGUSR2: 標本採取 pid=%s", os.getpid())
+
+    return prof
+
+def open_capture(args: Parameters, path: str) -> Optional[FrameCapture]:
+    """電文記録の開始
+
+    以降に送受信する電文をすべてのソケットで記録する。
 
-    job_soks: List[TelSocket] = []
+    Args:
+        args (Parameters): 起動パラメータ
+        path (str): 記録ファイルのパス（空なら記録しない）
 
+    Returns:
+        None: 記録しない
+        FrameCapture: 記録器
+    """
+
+    if path == "":
+        return None
+    cap = FrameCapture(path, args.capture_size * 1048576, args.capture_snap)
+    TelSocket.capture = cap
+    AsyncTelSocket.capture = cap
+    lg.output("INF", "電文記録開始 file=%s size=%sMB snap=%s", path, args.capture_size, args.capture_snap)
+    return cap
+
+@dataclass
+class LinkJoin:
+    """交渉を終えて揃うのを待つ制御ソケット（相手が複数本張る場合）"""
+    # 番号順（未着は None）
+    links: List[Optional[TelSocket]]
+    # 0 番で合意した機能一覧と交渉中に受信した通常電文
+    caps: Dict[str, str]
+    pending: Optional[Tuple[int, int, bytes]]
+    # 0 番の交渉を終えた時刻
+    started: float
+
+@dataclass
+class RelayState:
+    """中継処理の状態"""
+    reg: SocketRegistry
+    # 制御ソケットの心拍（送信は "hb" 合意時のみ、"resume" 合意時は ACK の送信時期にも使う）
+    hb: Heartbeat
+    # 制御ソケット（チャネル番号を本数で割った余りの番号のものを使う）
+    links: List[TelSocket] = field(default_factory=list)
+    # 制御ソケットが接続中か
+    links_up: bool = False
+    # バージョン交渉中の制御ソケットと、交渉を終えて揃うのを待つもの
+    hellos: List[Handshake] = field(default_factory=list)
+    join: Optional[LinkJoin] = None
+    # ジョブ用の受付ソケットと、それを監視しているか
+    acps: List[AcpSocket] = field(default_factory=list)
+    acps_on: bool = False
+    # 制御ソケットごとの送信電文の順番決め
+    scheds: List[FrameScheduler] = field(default_factory=list)
+    # ジョブソケットはチャネル番号で引く
+    job_soks: Dict[int, TelSocket] = field(default_factory=dict)
+    # 送信待ちが上限を超えているジョブソケットのチャネル番号
+    blocked: Set[int] = field(default_factory=set)
+    # 制御ソケットの詰まりでジョブソケットからの受信を止めているか
+    jobs_paused: bool = False
+    # 交渉で合意した機能（feats は値を除いた名前のみ）
+    caps: Dict[str, str] = field(default_factory=dict)
+    feats: Set[str] = field(default_factory=set)
+    # 制御ソケットが切れてもチャネルを保つセッション（"resume" 合意時のみ）
+    sess: Optional[Session] = None
+    # チャネルごとのクレジット管理（"credit" 合意時のみ）
+    flow: Optional[FlowControl] = None
+    # チャネルごとの圧縮（"zlib" 合意時のみ）
+    comp: Optional[StreamCompressor] = None
+    # チャネルの開始・終了を OPEN/CLOSE 電文で伝えるか（"open" 合意時のみ）
+    opens: bool = False
+    # 統計（受け付けたチャネル数, ジョブソケットからの受信量, ジョブソケットへの送信量）
+    stat_chans: int = 0
+    stat_up: int = 0
+    stat_down: int = 0
+    # チャネル・制御ソケットごとの統計（--metrics_port 指定時のみ）
+    metrics: Optional[Metrics] = None
+
+    def ctl_of(self, it_chan: int) -> TelSocket:
+        """チャネルが使う制御ソケット（同じチャネルは常に同じ制御ソケットを使う）"""
+        return self.links[it_chan % len(self.links)]
+
+    def sched_of(self, it_chan: int) -> FrameScheduler:
+        """チャネルが使うスケジューラ"""
+        return self.scheds[it_chan % len(self.scheds)]
+
+    def ready(self, it_idx: int) -> bool:
+        """制御ソケットへ連番付きの電文（DATA など）を送ってよいか（再開時は相手の RESUME 処理後）"""
+        return self.links_up and (self.sess is None or self.sess.seqs[it_idx].ready)
+
+    def push_close(self, it_chan: int) -> None:
+        """相手側へのチャネル終了の通知（未合意なら空の DATA 電文）"""
+        if self.opens:
+            self.sched_of(it_chan).push(it_chan, FRAME_CLOSE, b"")
+        else:
+            self.sched_of(it_chan).push(it_chan, FRAME_DATA, b"")
+
+def accept_link(args: Parameters, st: RelayState, ctl: AcpSocket) -> None:
+    """制御ソケットの接続受付（バージョン交渉は中継処理の周回の中で進める）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+        ctl (AcpSocket): 制御用の受付ソケット
+    """
+
+    ctl_sock = ctl.accept()
+    if ctl_sock is None:
+        return
+    ctl_sock.set_name("hello")
+    ctl_sock.set_nonblocking()
+    st.reg.register(ctl_sock)
+    lg.output("INF", "制御用ソケット受付接続成功")
+
+    if args.proto < PROTO_V2:
+        proc_hello_done(st, ctl_sock, {}, None)
+        return
+
+    # バージョン交渉
+    offered = dict(CAPABILITIES)
+    if args.hb_interval <= 0:
+        offered.pop("hb", None)
+    if args.resume_timeout <= 0:
+        offered.pop("resume", None)
+    st.hellos.append(Handshake(ctl_sock, offered, True))
+
+    return
+
+def proc_hello(st: RelayState, sck: TelSocket, ev: int) -> None:
+    """交渉中・揃うのを待つ制御ソケットの事象処理
+
+    Args:
+        st (RelayState): 中継処理の状態
+        sck (TelSocket): 制御ソケット
+        ev (int): 発生した事象
+    """
+
+    if ev & EVENT_WRITE:
+        sck.write_pending()
+    if not (ev & EVENT_READ):
+        return
+
+    hs = next((h for h in st.hellos if h.sck is sck), None)
+    if hs is None:
+        # 揃うのを待つ間に届いた電文は切り替えまで復号器に溜めておく
+        if not sck.fill():
+            lg.output("ERR", "制御ソケット切断検知（追加待ち）")
+            drop_join(st)
+        return
+
+    if not hs.on_readable():
+        lg.output("ERR", "制御ソケット切断検知（バージョン交渉中、または不正な電文）")
+        st.hellos.remove(hs)
+        sck.close()
+        return
+    if hs.done:
+        st.hellos.remove(hs)
+        proc_hello_done(st, sck, hs.agreed, hs.pending)
+
+    return
+
+def proc_hello_timeout(st: RelayState, it_wait: float) -> float:
+    """バージョン交渉・追加待ちの時間切れの処理
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_wait (float): 次の周回までの待ち時間（秒）
+
+    Returns:
+        float: 次の時間切れまでを考慮した待ち時間（秒）
+    """
+
+    now = time.monotonic()
+    for hs in list(st.hellos):
+        if hs.expired(now):
+            # 応答がなければ v1 の相手として扱う
+            st.hellos.remove(hs)
+            proc_hello_done(st, hs.sck, hs.agreed, hs.pending)
+        else:
+            it_wait = min(it_wait, hs.deadline - now)
+
+    if st.join is not None:
+        it_left = st.join.started + HELLO_TIMEOUT - now
+        if it_left <= 0:
+            lg.output("ERR", "制御ソケットの追加待ち時間切れ")
+            drop_join(st)
+        else:
+            it_wait = min(it_wait, it_left)
+
+    return it_wait
+
+def proc_hello_done(st: RelayState, sck: TelSocket, caps: Dict[str, str], pending: Optional[Tuple[int, int, bytes]]) -> None:
+    """バージョン交渉を終えた制御ソケットの処理
+
+    相手が複数の制御ソケットを張る場合は本数分揃うまで待ってから切り替える。
+    接続中の制御ソケットがあれば新しい接続を優先して古い方を閉じる
+    （相手が先に切断を検知して張り直した場合）。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        sck (TelSocket): 制御ソケット
+        caps (Dict[str, str]): 合意した機能一覧
+        pending (Optional[Tuple[int, int, bytes]]): 交渉中に受信した通常電文
+    """
+
+    lg.output("INF", "バージョン交渉 proto=%s caps=%s", sck.proto, caps)
+    if sck.proto != PROTO_V2 and (st.sess is not None or (st.links_up and st.links[0].proto == PROTO_V2)):
+        # 再開待ち・v2 の相手と接続中に交渉しない接続（時間切れ・ポートスキャンなど）は v1 の相手とみなさない
+        lg.output("ERR", "バージョン交渉失敗（v1 として受け付けない）")
+        sck.close()
+        return
+
+    it_idx, it_num = parse_links(caps)
+    if it_idx == 0:
+        if st.join is not None:
+            lg.output("WRN", "制御ソケットの追加待ちを破棄（新しい接続）")
+            drop_join(st)
+        st.join = LinkJoin(links=[None] * it_num, caps=caps, pending=pending, started=time.monotonic())
+    elif st.join is None or len(st.join.links) != it_num or st.join.links[it_idx] is not None:
+        lg.output("ERR", "制御ソケットの追加失敗 caps=%s", caps)
+        sck.close()
+        return
+    join = st.join
+    join.links[it_idx] = sck
+    links = [link for link in join.links if link is not None]
+    if len(links) < it_num:
+        return
+    st.join = None
+
+    if st.links_up:
+        lg.output("WRN", "制御ソケットの張り直し（古い接続を閉じる）")
+        proc_link_down(st)
+    attach_links(st, links[0].proto, join.caps, links)
+
+    if join.pending is not None:
+        proc_link_frames(st, links[0], [join.pending])
+    # 交渉中にまとめて受信した電文の処理
+    for link in links:
+        proc_link_frames(st, link, link.frames())
+
+    return
+
+def drop_join(st: RelayState) -> None:
+    """揃うのを待つ制御ソケットの破棄
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    if st.join is None:
+        return
+    for link in st.join.links:
+        if link is not None:
+            link.close()
+    st.join = None
+
+    return
+
+def proc_acceptors(st: RelayState) -> None:
+    """ジョブ用の受付ソケットの監視の切り替え
+
+    制御ソケットがなく、再開できるセッションもない間は受け付けない
+    （来た接続は受付キューで待たせる）。
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    want = st.links_up or st.sess is not None
+    if want == st.acps_on:
+        return
+    for acp in st.acps:
+        if want:
+            st.reg.register(acp)
+        else:
+            st.reg.unregister(acp)
+    st.acps_on = want
+    lg.output("INF", "ジョブ用ソケット受付%s", "開始" if want else "停止")
+
+    return
+
+def attach_links(st: RelayState, it_proto: int, caps: Dict[str, str], links: List[TelSocket]) -> None:
+    """受け付けた制御ソケットへの切り替え
+
+    セッションを再開する場合はチャネルの状態（クレジット・圧縮）を引き継ぎ、
+    各制御ソケットへ RESUME 電文を送る。合意した機能や本数が前回と違えば
+    再開せずにチャネルを破棄する。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_proto (int): 電文形式
+        caps (Dict[str, str]): 合意した機能一覧
+        links (List[TelSocket]): 制御ソケット
+    """
+
+    feats = {k for k in caps if k != "links"} if it_proto == PROTO_V2 else set()
+    if st.sess is not None and (feats != st.feats or len(links) != len(st.links)):
+        lg.output("WRN", "合意内容の変更によりセッション破棄 caps=%s", caps)
+        drop_chans(st)
+        st.sess = None
+    st.caps = caps
+    st.feats = feats
+    if "credit" not in feats:
+        st.flow = None
+    elif st.flow is None:
+        st.flow = FlowControl()
+    if "zlib" not in feats:
+        st.comp = None
+    elif st.comp is None:
+        st.comp = StreamCompressor()
+    st.opens = "open" in feats
+    if "resume" not in feats:
+        st.sess = None
+    elif st.sess is None:
+        st.sess = Session(len(links))
+
+    st.links[:] = links
+    for link in links:
+        link.set_name("ctrl")
+    if len(st.scheds) != len(links):
+        st.scheds[:] = [FrameScheduler() for _ in links]
+        if st.metrics is not None:
+            st.metrics.attach(st.links, st.scheds, st.job_soks)
+    for link in links:
+        link.set_nonblocking()
+        st.reg.register(link)
+    st.links_up = True
+    st.hb.start(len(links))
+
+    if st.sess is not None:
+        # 受信済み数を伝え、相手の RESUME を受けるまで連番付きの電文は送らない
+        st.sess.begin()
+        for it_idx, link in enumerate(links):
+            link.queue_frame(FRAME_RESUME, 0, st.sess.resume_body(it_idx))
+            link.flush()
+
+    return
+
+def open_listeners(args: Parameters) -> Tuple[AcpSocket, List[AcpSocket]]:
+    """制御用・ジョブ用の受付ソケットを開く
+
+    Args:
+        args (Parameters): 起動パラメータ
+
+    Returns:
+        (制御用の受付ソケット, ジョブ用の受付ソケットの一覧)
+    """
 
     # 制御用のソケットを開く
     ctl = AcpSocket()
     ctl.open("0.0.0.0", args.ctrl_port)
-    lg.output("INF", "制御用ソケット受付開始")
+    lg.output("INF", "制御用ソケット受付開始 port=%s", args.ctrl_port)
 
-    not_stb: bool = True
-    while not_stb:
-        s = SocketSelect.select(ctl, [])
-        if len(s) == 0:
-            continue
-        for i in s:
-            if isinstance(i, AcpSocket):
-                ctl_sock = ctl.accept()
-                ctl_sock.set_name("ctrl")
-                ctl.close()
-                lg.output("INF", "制御用ソケット受付接続成功")
-                not_stb = False
-                break
+    # 交渉中に来たジョブ接続は受付キューで待たせる
+    acps: List[AcpSocket] = []
+    for mp in args.mappings.values():
+        job = AcpSocket()
+        job.open("0.0.0.0", mp.job_port)
+        lg.output("INF", "ジョブ用ソケット受付開始 port=%s map=%s", mp.job_port, mp.map_id)
+        acps.append(job)
+
+    return (ctl, acps)
 
-    job = AcpSocket()
-    job.open("0.0.0.0", args.job_port)
-    lg.output("INF", "ジョブ用ソケット受付開始 port=" + str(args.job_port))
+def main_proc(args: Parameters, ctl: Optional[AcpSocket] = None, acps: Optional[List[AcpSocket]] = None) -> None:
+    """中継処理
 
-    job_soks.append(ctl_sock)
+    Args:
+        args (Parameters): 起動パラメータ
+        ctl (AcpSocket): 開いておいた制御用の受付ソケット（監視モードのワーカのみ）
+        acps (List[AcpSocket]): 開いておいたジョブ用の受付ソケット（同上）
+    """
+
+    if ctl is None or acps is None:
+        ctl, acps = open_listeners(args)
+
+    jobs: Dict[int, Mapping] = {mp.job_port: mp for mp in args.mappings.values()}
+
+    reg: SocketRegistry = SocketRegistry()
+    reg.register(ctl)
+    st = RelayState(reg=reg, hb=Heartbeat(args.hb_interval or HEARTBEAT_INTERVAL, args.hb_timeout), acps=acps)
+    st.metrics = open_metrics(args, st)
 
     while True:
-        s = SocketSelect.select(job, job_soks)
+        it_wait = proc_hello_timeout(st, st.hb.interval / 2)
+        proc_acceptors(st)
+        s = reg.select_events(it_wait)
+        proc_report(st)
+        if not proc_heartbeat(st):
+            proc_link_down(st)
+        proc_resume_timeout(args, st)
         if len(s) == 0:
             continue
+        fl_start = time.monotonic() if st.metrics is not None else 0.0
+
+        for i, ev in s:
 
-        for i in s:
+            # 制御ソケットの接続受付（再接続を含む）
+            if i is ctl:
+                accept_link(args, st, ctl)
 
             # ジョブソケットからの接続受付
-            if isinstance(i, AcpSocket):
-                job_sock = job.accept()
-                nm += 1
-                name: str = str(nm).zfill(4)
+            elif isinstance(i, AcpSocket):
+                job_sock = i.accept()
+                mp = jobs[i.port]
+                if mp.map_id != 0 and "maps" not in st.caps:
+                    # 相手がポート対応付けに未対応の場合は番号 0 のみ中継する
+                    lg.output("ERR", "ポート対応付け未対応の相手 port=%s map=%s", mp.job_port, mp.map_id)
+                    job_sock.close()
+                    continue
+                it_chan = alloc_chan(st, mp.map_id)
+                if it_chan is None:
+                    lg.output("ERR", "空きチャネルなし port=%s chans=%s", mp.job_port, len(st.job_soks))
+                    job_sock.close()
+                    continue
+                name: str = unit_name(it_chan)
                 job_sock.set_name( name )
-                job_soks.append(job_sock)
-                lg.output("INF", "ジョブ用ソケット受付接続成功 name=" + name)
+                job_sock.set_nonblocking()
+                if st.jobs_paused:
+                    job_sock.want_read = False
+                if st.flow is not None:
+                    st.flow.open(it_chan)
+                if mp.prio or mp.job_port in args.prio_ports:
+                    st.sched_of(it_chan).set_priority(it_chan, PRIO_HIGH)
+                st.job_soks[it_chan] = job_sock
+                st.stat_chans += 1
+                if st.metrics is not None:
+                    st.metrics.open(it_chan)
+                reg.register(job_sock)
+                if st.opens:
+                    # 最初のデータを待たずに相手側で接続を始めさせる
+                    st.sched_of(it_chan).push(it_chan, FRAME_OPEN, b"")
+                lg.output("INF", "ジョブ用ソケット受付接続成功 name=%s port=%s", name, mp.job_port)
             
             # メッセージ受信
             elif isinstance(i, TelSocket):
-                job_sock = i
+                if i.sock is None:
+                    # 同じ周回で切断済み
+                    continue
+
+                if i.name == "hello":
+                    # 交渉中・追加待ちの制御ソケット
+                    proc_hello(st, i, ev)
+                    continue
+
+                if ev & EVENT_WRITE:
+                    # 送信待ちの書き出し
+                    i.write_pending()
+                    if i.name != "ctrl":
+                        proc_grant_credit(st, int(i.name), i)
+
+                if not (ev & EVENT_READ):
+                    continue
 
                 if i.name == "ctrl":
-                    lg.output("INF", "制御ソケットからの受信 name=" + i.name)
+                    lg.output("INF", "制御ソケットからの受信 name=%s", i.name)
 
                     # 制御ソケットからの受信
-                    bt_jnum = i.receive_raw(4)
-                    lg.output_dump("INF", bt_jnum)
-                    st_jnum = bt_jnum.decode()
-
-                    bt_size = i.receive_raw(8)
-                    lg.output_dump("INF", bt_size)
-                    st_size = bt_size.decode()
-                    it_size = int(st_size)
-
-                    # job_soksの中のTelSocketをチェックし、nameがst_jnumと一致するものを取得
-                    for job_sock in job_soks:
-                        if job_sock.name == st_jnum:
-                            if it_size > 0:
-                                bt_data = i.receive_raw(it_size)
-                                lg.output_dump("DBG", bt_data)
-                                lg.output("INF", "ジョブソケットに送信 name=" + i.name)
-                                job_sock.send_raw(bt_data)
-                                lg.output_dump("DBG", bt_data)
-                            else:
-                                # job_sockを切断
-                                job_sock.close()
-                                job_soks.remove(job_sock)
-                                lg.output("INF", "ジョブソケット切断 name=" + i.name)
-                            break
+                    if not i.fill():
+                        lg.output("ERR", "制御ソケット切断検知")
+                        proc_link_down(st)
+                        continue
+
+                    # 受信済みの電文をまとめて処理
+                    proc_link_frames(st, i, i.frames())
 
                 else:
                     # ジョブソケットからの受信
-                    lg.output("INF", "ジョブソケットからの受信 name=" + i.name)
+                    lg.output("INF", "ジョブソケットからの受信 name=%s", i.name)
 
                     st_jnum = i.name
-                    bt_jnum = st_jnum.encode()
-                    bt_data = i.receive_raw(-1)
+                    it_chan = int(st_jnum)
+
+                    # クレジットの範囲内で受信
+                    it_limit = -1
+                    if st.flow is not None:
+                        it_limit = min(4096, st.flow.credit(it_chan))
+                        if it_limit <= 0:
+                            refresh_job_read(st, it_chan, i)
+                            continue
+                    bt_data = i.receive_raw(it_limit)
 
                     lg.output_dump("DBG", bt_data)
-                    it_size = 0
-                    if bt_data is not None:
-                        it_size = len(bt_data)
-                    st_size = str(it_size).zfill(8)
-                    bt_size = st_size.encode()
-
-                    lg.output("INF", "制御ソケットに送信 name=" + job_sock.name)
-                    ctl_sock.send_raw(bt_jnum)
-                    lg.output_dump("INF", bt_jnum)
-                    ctl_sock.send_raw(bt_size)
-                    lg.output_dump("INF", bt_size)
+                    if bt_data is None:
+                        bt_data = b""
+                    elif len(bt_data) == 0:
+                        continue
+                    it_size = len(bt_data)
+
                     if it_size > 0:
-                        ctl_sock.send_raw(bt_data)
+                        st.stat_up += it_size
+                        if st.flow is not None:
+                            st.flow.on_sent(it_chan, it_size)
+                        if st.metrics is not None:
+                            st.metrics.on_up(it_chan, it_size)
+                        refresh_job_read(st, it_chan, i)
+
+                    lg.output("INF", "制御ソケットへの送信待ち name=%s size=%s", st_jnum, it_size)
+                    if it_size > 0:
+                        push_data(st, it_chan, bt_data)
                         lg.output_dump("DBG", bt_data)
+                    else:
+                        # 切断されたジョブソケットを登録簿から外す
+                        st.push_close(it_chan)
+                        i.close()
+                        st.job_soks.pop(it_chan, None)
+                        st.blocked.discard(it_chan)
+                        if st.flow is not None:
+                            st.flow.close(it_chan)
+                        if st.comp is not None:
+                            st.comp.close(it_chan)
+                        if st.metrics is not None:
+                            st.metrics.close(it_chan)
+                        lg.output("INF", "ジョブソケット切断 name=%s", st_jnum)
+
+        # 今回の受信分をまとめて制御ソケットへ送信（CREDIT なども同じ書き出しに載せる）
+        proc_schedule(st)
+
+        proc_backpressure(st)
+        if st.metrics is not None:
+            st.metrics.loop.observe(time.monotonic() - fl_start)
+
+    return
+
+def alloc_chan(st: RelayState, it_map: int) -> Optional[int]:
+    """新しいチャネル番号の払い出し（通し番号が一周した後は使用中の番号を飛ばす）
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_map (int): ポート対応付けの番号
+
+    Returns:
+        None: 空きなし
+        int: チャネル番号
+    """
+
+    it_max = UNIT_SEQ_MAX if st.links[0].proto == PROTO_V1 else CHAN_SEQ_MAX
+    it_seq = next_seq(it_max, lambda n: make_chan(it_map, n) in st.job_soks)
+    if it_seq is None:
+        return None
+
+    return make_chan(it_map, it_seq)
+
+def next_seq(it_max: int, in_use: Callable[[int], bool]) -> Optional[int]:
+    """通し番号の払い出し（it_max の次は 1 に戻り、使用中の番号は飛ばす）
+
+    Args:
+        it_max (int): 通し番号の上限
+        in_use (Callable[[int], bool]): 通し番号が使用中か
+
+    Returns:
+        None: 空きなし
+        int: 通し番号
+    """
+
+    global nm
+
+    for _ in range(it_max):
+        nm += 1
+        if nm > it_max:
+            nm = 1
+        if not in_use(nm):
+            return nm
+
+    return None
+
+def proc_link_down(st: RelayState) -> None:
+    """制御ソケットの切断（セッションを再開できる間はチャネルを保つ）
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    for link in st.links:
+        link.close()
+    st.links_up = False
+    if st.sess is not None:
+        st.sess.down()
+        lg.output("WRN", "制御ソケット再接続待ち chans=%s", len(st.job_soks))
+    else:
+        drop_chans(st)
+
+    return
+
+def proc_resume_timeout(args: Parameters, st: RelayState) -> None:
+    """再接続待ちの期限切れの処理（次の接続では相手側も新しいセッションとしてチャネルを破棄する）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+    """
+
+    if st.sess is None or st.links_up or st.sess.down_at == 0:
+        return
+    if time.monotonic() - st.sess.down_at <= args.resume_timeout:
+        return
+    lg.output("WRN", "セッション再開待ち期限切れ chans=%s", len(st.job_soks))
+    drop_chans(st)
+    st.sess = None
+
+    return
+
+def drop_chans(st: RelayState) -> None:
+    """全チャネルの破棄（セッションを再開できない場合）
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    for it_chan, job_sock in list(st.job_soks.items()):
+        job_sock.close()
+        if st.metrics is not None:
+            st.metrics.close(it_chan)
+        lg.output("INF", "ジョブソケット切断 name=%s", job_sock.name)
+    st.job_soks.clear()
+    st.blocked.clear()
+    st.jobs_paused = False
+    for sched in st.scheds:
+        sched.clear()
+    if st.flow is not None:
+        st.flow = FlowControl()
+    if st.comp is not None:
+        st.comp = StreamCompressor()
+
+    return
+
+def proc_link_frames(st: RelayState, link: TelSocket, frames: Iterable[Tuple[int, int, bytes]]) -> None:
+    """制御ソケットから受信した電文の振り分け
+
+    制御ソケット自体の電文（PING/ACK/RESUME）はここで処理し、
+    それ以外は受信数を数えてから proc_ctrl_frame へ渡す。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        link (TelSocket): 受信した制御ソケット
+        frames (Iterable): 受信電文（電文種別, チャネル番号, データ）
+    """
+
+    it_idx = st.links.index(link)
+    st.hb.on_recv(it_idx)
+    for rcv in frames:
+        it_type = rcv[0]
+        if it_type in LINK_FRAMES:
+            if it_type == FRAME_ACK and st.sess is not None:
+                for it_chan in st.sess.on_ack(it_idx, rcv[2]):
+                    job_sock = st.job_soks.get(it_chan)
+                    if job_sock is not None:
+                        refresh_job_read(st, it_chan, job_sock)
+            elif it_type == FRAME_RESUME and st.sess is not None:
+                proc_resume(st, it_idx, rcv[2])
+            continue
+        if st.sess is not None and st.sess.received(it_idx, len(rcv[2])):
+            link.queue_frame(FRAME_ACK, 0, st.sess.ack_body(it_idx))
+        proc_ctrl_frame(st, rcv)
+
+    return
+
+def proc_resume(st: RelayState, it_idx: int, bt_data: bytes) -> None:
+    """相手の RESUME 電文の処理（未受信の分の再送、または全チャネルの破棄）
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_idx (int): 制御ソケットの番号
+        bt_data (bytes): RESUME 電文のデータ部
+    """
+
+    if st.sess is None:
+        return
+    frames = st.sess.on_resume(it_idx, bt_data)
+    if frames is None:
+        if len(st.job_soks) == 0:
+            lg.output("INF", "セッション開始")
+        else:
+            lg.output("WRN", "セッション再開不可（相手が別のセッション） chans=%s", len(st.job_soks))
+        drop_chans(st)
+        return
+
+    link = st.links[it_idx]
+    for it_type, it_chan, bt_frame in frames:
+        link.queue_frame(it_type, it_chan, bt_frame)
+    link.flush()
+    lg.output("INF", "セッション再開 link=%s resend=%s chans=%s", it_idx, len(frames), len(st.job_soks))
+
+    # 切断中に返せなかったクレジットの返却と受信可否の反映
+    for it_chan, job_sock in st.job_soks.items():
+        if it_chan % len(st.links) == it_idx:
+            proc_grant_credit(st, it_chan, job_sock)
+            refresh_job_read(st, it_chan, job_sock)
+
+    return
+
+def proc_heartbeat(st: RelayState) -> bool:
+    """心拍・未報告の ACK の送信と無受信の検知
+
+    Args:
+        st (RelayState): 中継処理の状態
+
+    Returns:
+        True: 正常
+        False: 無受信が続く制御ソケットあり（切断とみなす）
+    """
+
+    if not st.links_up:
+        return True
+    now = time.monotonic()
+    if st.hb.due(now):
+        for it_idx, link in enumerate(st.links):
+            if "hb" in st.feats:
+                link.queue_frame(FRAME_PING, 0, b"")
+            if st.sess is not None and st.sess.ack_due(it_idx):
+                link.queue_frame(FRAME_ACK, 0, st.sess.ack_body(it_idx))
+            link.flush()
+    if "hb" in st.feats:
+        it_idx = st.hb.dead(now)
+        if it_idx is not None:
+            lg.output("ERR", "制御ソケット無応答 link=%s", it_idx)
+            return False
+
+    return True
+
+def queue_seq(st: RelayState, it_idx: int, it_type: int, it_chan: int, bt_data: bytes) -> None:
+    """連番付き電文の送信待ち登録（"resume" 合意時は相手の ACK まで保持）
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_idx (int): 制御ソケットの番号
+        it_type (int): 電文種別
+        it_chan (int): チャネル番号
+        bt_data (bytes): 送信データ
+    """
+
+    st.links[it_idx].queue_frame(it_type, it_chan, bt_data)
+    if st.sess is not None:
+        st.sess.sent(it_idx, it_type, it_chan, bt_data)
+
+    return
+
+def open_metrics(args: Parameters, st: RelayState) -> Optional[Metrics]:
+    """統計の公開開始（--metrics_port 指定時のみ）
+
+    Args:
+        args (Parameters): 起動パラメータ
+        st (RelayState): 中継処理の状態
+
+    Returns:
+        None: 公開しない
+        Metrics: 統計
+    """
+
+    if args.metrics_port <= 0:
+        return None
+    metrics = Metrics()
+    metrics.attach(st.links, st.scheds, st.job_soks)
+    try:
+        start_metrics_server(metrics, args.metrics_port)
+    except OSError as e:
+        lg.output("ERR", "統計の公開失敗 port=%s %s", args.metrics_port, e)
+        return None
+    lg.output("INF", "統計の公開開始 http://127.0.0.1:%s/metrics", args.metrics_port)
+    return metrics
+
+def proc_report(st: RelayState) -> None:
+    """監視プロセスへの統計報告（STATS_INTERVAL ごと）
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    global stats_at
+
+    if stats_fd < 0:
+        return
+    now = time.monotonic()
+    if now - stats_at < STATS_INTERVAL:
+        return
+    stats_at = now
+
+    line = json.dumps({
+        "chans": st.stat_chans,
+        "active": len(st.job_soks),
+        "up": st.stat_up,
+        "down": st.stat_down,
+    }) + "\n"
+    try:
+        os.write(stats_fd, line.encode())
+    except OSError:
+        pass
+
+    return
+
+def supervise(args: Parameters) -> None:
+    """監視モード
+
+    中継ごとに受付ソケットを開いてからワーカを fork し、
+    受付ソケットはワーカへ引き継ぐ。ワーカが終了したら直ちに起動し直すため、
+    再起動の間に来た接続も受付キューで待たされるだけで失われない。
+    起動直後に落ちたワーカは RESTART_INTERVAL だけ待ってから起動するが、
+    待つ間も他のワーカの監視は止めない。
+    ログはワーカと同じファイルへ追記され、統計はパイプ経由で集計する。
+
+    Args:
+        args (Parameters): 起動パラメータ
+    """
+
+    workers: List[Worker] = []
+    for idx, tn in enumerate(args.tunnels):
+        ctl, acps = open_listeners(replace(args, ctrl_port=tn.ctrl_port, mappings=tn.mappings))
+        workers.append(Worker(idx=idx + 1, tunnel=tn, ctl=ctl, acps=acps))
+
+    # SIGTERM でもワーカを止めてから終了する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    sel = selectors.DefaultSelector()
+    for wk in workers:
+        spawn_worker(args, wk, workers, sel)
+        sel.register(wk.rfd, selectors.EVENT_READ, wk)
+
+    # 終了済みのワーカの統計（累計値のみ引き継ぐ）
+    totals: Dict[str, int] = {"chans": 0, "up": 0, "down": 0}
+    at = time.monotonic()
+
+    try:
+        while True:
+            timeout = STATS_INTERVAL
+            for wk in workers:
+                if wk.restart_at > 0:
+                    timeout = min(timeout, max(0.0, wk.restart_at - time.monotonic()))
+            for key, _ in sel.select(timeout):
+                wk = key.data
+                data = os.read(wk.rfd, 4096)
+                if len(data) > 0:
+                    lines = (wk.buf + data).split(b"\n")
+                    wk.buf = lines.pop()
+                    for line in lines:
+                        wk.stats = json.loads(line)
+                    continue
+
+                # ワーカの終了
+                sel.unregister(wk.rfd)
+                os.close(wk.rfd)
+                wk.rfd = -1
+                _, status = os.waitpid(wk.pid, 0)
+                lg.output("WRN", "ワーカ終了 idx=%s pid=%s status=%s", wk.idx, wk.pid, status)
+                wk.pid = 0
+                for k in totals:
+                    totals[k] += wk.stats.get(k, 0)
+                wk.stats = {}
+                wk.restart_at = max(time.monotonic(), wk.started + RESTART_INTERVAL)
+
+            # 再起動の時刻になったワーカの起動
+            now = time.monotonic()
+            for wk in workers:
+                if wk.restart_at > 0 and now >= wk.restart_at:
+                    wk.restart_at = 0.0
+                    spawn_worker(args, wk, workers, sel)
+                    sel.register(wk.rfd, selectors.EVENT_READ, wk)
+
+            if time.monotonic() - at >= STATS_INTERVAL:
+                at = time.monotonic()
+                agg = dict(totals)
+                agg["active"] = 0
+                for wk in workers:
+                    for k in agg:
+                        agg[k] += wk.stats.get(k, 0)
+                lg.output("INF", "統計 workers=%s chans=%s active=%s up=%s down=%s",
+                    len(workers), agg["chans"], agg["active"], agg["up"], agg["down"])
+    except KeyboardInterrupt:
+        lg.output("INF", "監視終了")
+    finally:
+        for wk in workers:
+            if wk.pid == 0:
+                continue
+            try:
+                os.kill(wk.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    return
+
+def spawn_worker(args: Parameters, wk: Worker, workers: List[Worker], sel: selectors.BaseSelector) -> None:
+    """ワーカの起動
+
+    Args:
+        args (Parameters): 起動パラメータ
+        wk (Worker): 起動するワーカ
+        workers (List[Worker]): 全ワーカ
+        sel (selectors.BaseSelector): 監視プロセスの統計報告用パイプの監視
+    """
+
+    global stats_fd
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # ワーカ側：ログは同じファイルへ追記し、番号で見分ける
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.close(rfd)
+        # 他の中継の受付ソケット・他のワーカのパイプは引き継がない
+        # （監視プロセスが止めた中継のポートをワーカが開いたままにしない）
+        sel.close()
+        for other in workers:
+            if other is wk:
+                continue
+            other.ctl.close()
+            for acp in other.acps:
+                acp.close()
+            if other.rfd >= 0:
+                os.close(other.rfd)
+        stats_fd = wfd
+        lg.tid = wk.idx
+        code = 1
+        try:
+            if args.capture != "":
+                open_capture(args, args.capture + "." + str(wk.idx))
+            # 統計はワーカごとに続きのポート番号で公開する
+            it_metrics = args.metrics_port + wk.idx - 1 if args.metrics_port > 0 else 0
+            main_proc(replace(args, ctrl_port=wk.tunnel.ctrl_port, mappings=wk.tunnel.mappings, tunnels=[], metrics_port=it_metrics), wk.ctl, wk.acps)
+            code = 0
+        except Exception:
+            lg.output("ERR", "ワーカ異常終了 %s", traceback.format_exc())
+        finally:
+            # 監視プロセス側の処理へ戻らないよう必ずここで終了する
+            lg.async_off()
+            os._exit(code)
+
+    os.close(wfd)
+    wk.pid = pid
+    wk.rfd = rfd
+    wk.started = time.monotonic()
+    wk.buf = b""
+    lg.output("INF", "ワーカ起動 idx=%s pid=%s ctrl_port=%s", wk.idx, pid, wk.tunnel.ctrl_port)
+
+    return
+
+def proc_backpressure(st: RelayState) -> None:
+    """送信待ちの溜まり具合に応じた受信の停止・再開
+
+    制御ソケットが詰まっている間はジョブソケットから読まず、
+    いずれかのジョブソケットが詰まっている間は制御ソケットから読まない。
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    if not st.jobs_paused and any(link.congested() for link in st.links):
+        lg.output("WRN", "制御ソケット送信待ち超過")
+        st.jobs_paused = True
+        for it_chan, job_sock in st.job_soks.items():
+            refresh_job_read(st, it_chan, job_sock)
+    elif st.jobs_paused and all(link.drained() for link in st.links):
+        st.jobs_paused = False
+        for it_chan, job_sock in st.job_soks.items():
+            refresh_job_read(st, it_chan, job_sock)
+
+    for it_chan in list(st.blocked):
+        job_sock = st.job_soks.get(it_chan)
+        if job_sock is None or job_sock.drained():
+            st.blocked.discard(it_chan)
+
+    for link in st.links:
+        if len(st.blocked) > 0:
+            link.pause_read()
+        else:
+            link.resume_read()
+
+    return
+
+def proc_schedule(st: RelayState) -> None:
+    """スケジューラに溜まった電文の制御ソケットへの送り出し
+
+    制御ソケットごとに送信待ちを SCHED_BUDGET までに抑え、
+    どのチャネルの電文を先に送るかはスケジューラに決めさせる。
+    周回中に積んだ電文（CREDIT・ACK など）は最初の書き出しにまとめて載せる。
+
+    Args:
+        st (RelayState): 中継処理の状態
+    """
+
+    for it_idx, (link, sched) in enumerate(zip(st.links, st.scheds)):
+        while st.ready(it_idx) and not sched.empty() and link.wq_bytes < SCHED_BUDGET:
+            for it_type, it_chan, bt_data in sched.pop_batch(SCHED_BUDGET - link.wq_bytes):
+                queue_seq(st, it_idx, it_type, it_chan, bt_data)
+                if is_close(it_type, bt_data):
+                    # 切断通知を送ったチャネルは片付ける
+                    sched.discard(it_chan)
+                    continue
+                job_sock = st.job_soks.get(it_chan)
+                if job_sock is not None:
+                    refresh_job_read(st, it_chan, job_sock)
+            link.flush()
+        # 送る DATA がなくても積んだ電文は送る
+        link.flush()
+
+    return
+
+def push_data(st: RelayState, it_chan: int, bt_data: bytes) -> None:
+    """ジョブソケットから受信したデータのスケジューラへの登録
+
+    "zlib" 合意時は圧縮する。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+        bt_data (bytes): 受信データ
+    """
+
+    it_type = FRAME_DATA
+    if st.comp is not None and len(bt_data) > 0:
+        it_type, bt_data = st.comp.pack(it_chan, bt_data)
+    st.sched_of(it_chan).push(it_chan, it_type, bt_data)
+
+    return
+
+
+def refresh_job_read(st: RelayState, it_chan: int, job_sock: TelSocket) -> None:
+    """ジョブソケットの受信可否の反映
+
+    制御ソケットが詰まっている間、クレジットを使い切った間、
+    スケジューラの送信待ち・再送用の保持が溜まっている間は受信しない。
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+        job_sock (TelSocket): ジョブソケット
+    """
+
+    if (st.jobs_paused
+            or (st.flow is not None and st.flow.credit(it_chan) <= 0)
+            or st.sched_of(it_chan).pending(it_chan) >= SCHED_CHAN_LIMIT
+            or (st.sess is not None and st.sess.congested(it_chan))):
+        job_sock.pause_read()
+    else:
+        job_sock.resume_read()
+
+    return
+
+def proc_grant_credit(st: RelayState, it_chan: int, job_sock: TelSocket) -> None:
+    """ジョブソケットへ書き出し済みの量に応じたクレジットの返却
+
+    Args:
+        st (RelayState): 中継処理の状態
+        it_chan (int): チャネル番号
+        job_sock (TelSocket): ジョブソケット
+    """
+
+    # 制御ソケットの再接続中は返さず、再開後にまとめて返す
+    it_idx = it_chan % len(st.links)
+    if st.flow is None or not st.ready(it_idx):
+        return
+    it_grant = st.flow.on_delivered(it_chan, job_sock.sent_total)
+    if it_grant > 0:
+        queue_seq(st, it_idx, FRAME_CREDIT, it_chan, CREDIT_BODY.pack(it_grant))
+
+    return
+
+def proc_ctrl_frame(st: RelayState, rcv: Tuple[int, int, bytes]) -> None:
+    """制御ソケットから受信した電文の処理
+
+    Args:
+        st (RelayState): 中継処理の状態
+        rcv (Tuple[int, int, bytes]): 受信電文（電文種別, チャネル番号, データ）
+    """
+
+    it_type = rcv[0]
+    it_chan = rcv[1]
+    bt_data = rcv[2]
+    if it_type == FRAME_DATA | FRAME_FLAG_Z and st.comp is not None:
+        try:
+            bt_data = st.comp.unpack(it_chan, bt_data)
+        except zlib.error:
+            # 伸張できないチャネルは両側で切断する
+            lg.output("ERR", "伸張失敗 unit=%s", unit_name(it_chan))
+            proc_ctrl_frame(st, (FRAME_CLOSE, it_chan, b""))
+            st.push_close(it_chan)
+            return
+        it_type = FRAME_DATA
+    it_size = len(bt_data)
+    st_jnum = unit_name(it_chan)
+
+    lg.output("INF", "type=%s unit=%s size=%s", it_type, st_jnum, it_size)
+
+    if it_type == FRAME_CREDIT and st.flow is not None:
+        # 相手からの送信許可
+        if st.flow.on_credit(it_chan, CREDIT_BODY.unpack(bt_data)[0]):
+            job_sock = st.job_soks.get(it_chan)
+            if job_sock is not None:
+                refresh_job_read(st, it_chan, job_sock)
+        return
+
+    if it_type == FRAME_CLOSE:
+        it_size = 0
+    elif it_type != FRAME_DATA:
+        lg.output("WRN", "未対応の電文種別 type=%s", it_type)
+        return
+    elif it_size == 0 and st.opens:
+        # 終了は CLOSE 電文で伝わるため空データは何もしない
+        return
+
+    # job_soksからチャネル番号が一致するTelSocketを取得
+    job_sock = st.job_soks.get(it_chan)
+    if job_sock is not None:
+        if it_size > 0:
+            lg.output_dump("DBG", bt_data)
+            lg.output("INF", "ジョブソケットに送信 name=%s", st_jnum)
+            job_sock.send_raw(bt_data)
+            st.stat_down += it_size
+            if st.metrics is not None:
+                st.metrics.on_down(it_chan, it_size)
+            if job_sock.congested():
+                st.blocked.add(it_chan)
+            proc_grant_credit(st, it_chan, job_sock)
+        else:
+            # job_sockを切断（送信待ちを書き切ってから）
+            job_sock.close_after_flush()
+            del st.job_soks[it_chan]
+            st.blocked.discard(it_chan)
+            st.sched_of(it_chan).discard(it_chan)
+            if st.flow is not None:
+                st.flow.close(it_chan)
+            if st.comp is not None:
+                st.comp.close(it_chan)
+            if st.metrics is not None:
+                st.metrics.close(it_chan)
+            lg.output("INF", "ジョブソケット切断 name=%s", st_jnum)
+
+    return
+
+async def main_proc_async(args: Parameters) -> None:
+    """asyncio版の中継処理
+
+    チャネルごとに送受信タスクを分けるため、遅い相手先が他のチャネルを止めない。
+    制御ソケットの受信を止めると全チャネルが止まるため、ジョブソケットへの
+    送信待ちが ASYNC_QUEUE_HIGH 件を超えたチャネルは処理タスクを打ち切り、
+    相手側へ切断を通知する。
+    """
+
+    jobs: Dict[str, "asyncio.Queue[bytes]"] = {}
+    # チャネルのキューと処理タスクの対応（ユニット名は再利用されるためキューで引く）
+    tasks: Dict["asyncio.Queue[bytes]", "asyncio.Task[None]"] = {}
+
+    # 制御用のソケットを開く
+    ctl_fut: "asyncio.Future[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]" = asyncio.get_running_loop().create_future()
+
+    async def on_ctrl(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if ctl_fut.done():
+            writer.close()
+            return
+        ctl_fut.set_result((reader, writer))
+
+    ctl = await asyncio.start_server(on_ctrl, "0.0.0.0", args.ctrl_port)
+    lg.output("INF", "制御用ソケット受付開始")
+
+    reader, writer = await ctl_fut
+    ctl.close()
+    ctl_sock: AsyncTelSocket = AsyncTelSocket()
+    ctl_sock.build(reader, writer)
+    ctl_sock.set_name("ctrl")
+    lg.output("INF", "制御用ソケット受付接続成功")
+
+    async def on_job(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # ジョブソケットからの接続受付
+        it_seq = next_seq(UNIT_SEQ_MAX, lambda n: str(n).zfill(4) in jobs)
+        if it_seq is None:
+            lg.output("ERR", "空きチャネルなし port=%s chans=%s", mp.job_port, len(jobs))
+            writer.close()
+            return
+        name: str = str(it_seq).zfill(4)
+        job_sock = AsyncTelSocket()
+        job_sock.build(reader, writer)
+        job_sock.set_name(name)
+        q: "asyncio.Queue[bytes]" = asyncio.Queue()
+        jobs[name] = q
+        lg.output("INF", "ジョブ用ソケット受付接続成功 name=%s", name)
+
+        task = asyncio.create_task(job_proc_async(ctl_sock, job_sock, q, jobs))
+        tasks[q] = task
+        task.add_done_callback(lambda _: tasks.pop(q, None))
+
+    # 従来形式の電文ではポート対応付けの番号を運べないため最初の1件のみ使う
+    mp = next(iter(args.mappings.values()))
+    if len(args.mappings) > 1:
+        lg.output("WRN", "asyncio版はポート対応付け1件のみ対応 port=%s", mp.job_port)
+    job = await asyncio.start_server(on_job, "0.0.0.0", mp.job_port, backlog=64)
+    lg.output("INF", "ジョブ用ソケット受付開始 port=%s", mp.job_port)
+
+    while True:
+        # 制御ソケットからの受信
+        rcv = await ctl_sock.receive()
+        if rcv[0] == "":
+            lg.output("ERR", "制御ソケット切断検知")
+            break
+
+        st_jnum = rcv[0]
+        it_size = rcv[1]
+        bt_data = rcv[2]
+        lg.output("INF", "制御ソケットからの受信 unit=%s size=%s", st_jnum, it_size)
+
+        if it_size > 0:
+            q = jobs.get(st_jnum)
+            if q is not None and q.qsize() >= ASYNC_QUEUE_HIGH:
+                lg.output("WRN", "ジョブソケットの送信待ち超過のため切断 name=%s queued=%s", st_jnum, q.qsize())
+                del jobs[st_jnum]
+                task = tasks.get(q)
+                if task is not None:
+                    task.cancel()
+                ctl_sock.send(st_jnum, b"")
+                await ctl_sock.drain()
+            elif q is not None:
+                lg.output_dump("DBG", bt_data)
+                q.put_nowait(bt_data)
+        else:
+            # job_sockを切断
+            q = jobs.pop(st_jnum, None)
+            if q is not None:
+                q.put_nowait(b"")
+
+    job.close()
+    ctl_sock.close()
+    for task in list(tasks.values()):
+        task.cancel()
+
+    return
+
+async def job_proc_async(ctl_sock: AsyncTelSocket, job_sock: AsyncTelSocket, q: "asyncio.Queue[bytes]", jobs: Dict[str, "asyncio.Queue[bytes]"]) -> None:
+    """ジョブチャネル処理（asyncio版）
+
+    キューの内容をジョブソケットへ書き出しつつ、
+    ジョブソケットからの受信を制御ソケットへ転送する。
+
+    Args:
+        ctl_sock (AsyncTelSocket): 制御ソケット
+        job_sock (AsyncTelSocket): ジョブソケット
+        q (asyncio.Queue): ジョブソケットへの送信待ちデータ（空データは切断指示、
+            データは ASYNC_QUEUE_HIGH 件まで）
+        jobs (Dict): ユニット名とキューの対応表
+    """
+
+    st_jnum = job_sock.name
+
+    async def upstream() -> None:
+        # ジョブソケットからの受信
+        while True:
+            bt_data = await job_sock.receive_raw(-1)
+            if bt_data is None:
+                break
+            lg.output_dump("DBG", bt_data)
+            lg.output("INF", "制御ソケットに送信 name=%s", st_jnum)
+            ctl_sock.send(st_jnum, bt_data)
+            await ctl_sock.drain()
+
+        if jobs.get(st_jnum) is q:
+            # 相手側へ切断を通知
+            del jobs[st_jnum]
+            ctl_sock.send(st_jnum, b"")
+            await ctl_sock.drain()
+        q.put_nowait(b"")
+
+    up = asyncio.create_task(upstream())
+    try:
+        while True:
+            bt_data = await q.get()
+            if len(bt_data) == 0:
+                break
+            lg.output("INF", "ジョブソケットに送信 name=%s", st_jnum)
+            job_sock.send_raw(bt_data)
+            if not await job_sock.drain():
+                break
+    except asyncio.CancelledError:
+        # 送信待ち超過などで打ち切られた場合は書き切りを待たない
+        job_sock.abort()
+        raise
+    finally:
+        job_sock.close()
+        up.cancel()
+        lg.output("INF", "ジョブソケット切断 name=%s", st_jnum)
 
     return
 
@@ -165,39 +1489,246 @@ def parse_args() -> Parameters:
     parser.add_argument(
         "--ctrl_port",
         type=int,
-        required=True,
-        help="コントロール用ポート番号",
+        help="コントロール用ポート番号（--supervise 以外では必須）",
     )
-    parser.add_argument(
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
         "--job_port",
         type=int,
-        required=True,
         help="ジョブ用ポート番号",
     )
+    group.add_argument(
+        "--config",
+        type=str,
+        help="ポート対応付けの設定ファイル（JSON）",
+    )
+    group.add_argument(
+        "--supervise",
+        type=str,
+        help="監視モードの設定ファイル（JSON、中継ごとにワーカを起動）",
+    )
     parser.add_argument(
         "--debug",
         type=bool,
         default=False,
         help="デバッグモード",
     )
+    parser.add_argument(
+        "--log_async",
+        action="store_true",
+        help="ログを別スレッドでまとめて書き出す（ERR と終了時のみ即時）",
+    )
+    parser.add_argument(
+        "--log_no_caller",
+        action="store_true",
+        help="ログに呼び出し元のファイル名:行番号を出さない（記録ごとの負荷を下げる）",
+    )
+    parser.add_argument(
+        "--log_dump_max",
+        type=int,
+        default=LOG_DUMP_MAX,
+        help="ダンプ出力の最大バイト数（超えた分は先頭と末尾のみ、0 は無制限）",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=0,
+        help="統計を Prometheus 形式で公開するループバックのポート番号（0: 公開しない、select 版のみ、監視モードではワーカ番号順に続きの番号）",
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        default="",
+        help="送受信した電文を記録するファイル（監視モードでは末尾にワーカ番号を付ける）",
+    )
+    parser.add_argument(
+        "--capture_size",
+        type=int,
+        default=64,
+        help="電文記録の上限（MB、超えたら古い記録から上書き）",
+    )
+    parser.add_argument(
+        "--capture_snap",
+        type=int,
+        default=0,
+        help="電文ごとに記録するデータの最大バイト数（0: ヘッダのみ, -1: すべて）",
+    )
     parser.add_argument(
         "--logfile",
         type=str,
         default="gw2",
         help="ログファイル名",
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["select", "asyncio"],
+        default="select",
+        help="中継エンジン（select: 従来方式, asyncio: 非同期方式）",
+    )
+    parser.add_argument(
+        "--proto",
+        type=int,
+        choices=[PROTO_V1, PROTO_V2],
+        default=PROTO_V2,
+        help="電文形式の上限（1: 従来形式のみ, 2: 接続時に交渉）",
+    )
+    parser.add_argument(
+        "--prio_ports",
+        type=int,
+        nargs="*",
+        default=[],
+        help="遅延を優先するジョブ用ポート番号（VNC など）",
+    )
+    parser.add_argument(
+        "--hb_interval",
+        type=float,
+        default=HEARTBEAT_INTERVAL,
+        help="制御ソケットの心拍の間隔（秒、0: 送らない、相手が対応している場合のみ）",
+    )
+    parser.add_argument(
+        "--hb_timeout",
+        type=float,
+        default=HEARTBEAT_TIMEOUT,
+        help="制御ソケットからの無受信で切断とみなす時間（秒、相手の心拍の間隔より長くする）",
+    )
+    parser.add_argument(
+        "--resume_timeout",
+        type=float,
+        default=RESUME_TIMEOUT,
+        help="制御ソケットの切断後、再接続を待ってチャネルを保つ時間（秒、0: 保たない、相手が対応している場合のみ）",
+    )
 
     args = parser.parse_args()
 
+    if args.capture_size <= 0:
+        parser.error("--capture_size は 1 以上を指定する")
+    tunnels: List[Tunnel] = []
+    mappings: Dict[int, Mapping] = {}
+    if args.supervise is not None:
+        if not hasattr(os, "fork"):
+            parser.error("--supervise はこの OS では使えない")
+        if args.engine != "select":
+            parser.error("--supervise は --engine select のみ対応")
+        try:
+            tunnels = load_tunnels(args.supervise)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error("設定ファイル読込失敗 " + args.supervise + ": " + str(e))
+    else:
+        if args.ctrl_port is None:
+            parser.error("--ctrl_port が必要")
+        if args.config is not None:
+            try:
+                mappings = load_mappings(args.config)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                parser.error("設定ファイル読込失敗 " + args.config + ": " + str(e))
+        else:
+            mappings = {0: Mapping(map_id=0, job_port=args.job_port)}
+
     params = Parameters(
-        ctrl_port=args.ctrl_port,
-        job_port=args.job_port,
+        ctrl_port=args.ctrl_port or 0,
+        mappings=mappings,
         debug=args.debug,
+        log_async=args.log_async,
+        log_no_caller=args.log_no_caller,
+        log_dump_max=args.log_dump_max,
+        metrics_port=args.metrics_port,
+        capture=args.capture,
+        capture_size=args.capture_size,
+        capture_snap=args.capture_snap,
+        hb_interval=args.hb_interval,
+        hb_timeout=args.hb_timeout,
+        resume_timeout=args.resume_timeout,
         logfile=args.logfile,
+        engine=args.engine,
+        proto=args.proto,
+        prio_ports=args.prio_ports,
+        tunnels=tunnels,
     )
 
     return params
 
+def load_mappings(path: str) -> Dict[int, Mapping]:
+    """ポート対応付けの設定ファイルの読込
+
+    形式: {"mappings": [{"id": 1, "job_port": 8082}, {"id": 2, "job_port": 5902, "prio": true}]}
+
+    Args:
+        path (str): 設定ファイルのパス
+
+    Returns:
+        Dict[int, Mapping]: 番号とポート対応付けの対応表
+    """
+
+    with open(path, encoding="utf-8") as f:
+        conf = json.load(f)
+
+    return parse_mappings(conf.get("mappings", []))
+
+def load_tunnels(path: str) -> List[Tunnel]:
+    """監視モードの設定ファイルの読込
+
+    形式: {"tunnels": [{"ctrl_port": 10001, "mappings": [...]}, {"ctrl_port": 10002, "mappings": [...]}]}
+    mappings の形式は load_mappings と同じ。
+
+    Args:
+        path (str): 設定ファイルのパス
+
+    Returns:
+        List[Tunnel]: ワーカごとの中継の一覧
+    """
+
+    with open(path, encoding="utf-8") as f:
+        conf = json.load(f)
+
+    tunnels: List[Tunnel] = []
+    ports: Set[int] = set()
+    for ent in conf.get("tunnels", []):
+        tn = Tunnel(
+            ctrl_port=int(ent["ctrl_port"]),
+            mappings=parse_mappings(ent.get("mappings", [])),
+        )
+        for port in [tn.ctrl_port] + [mp.job_port for mp in tn.mappings.values()]:
+            if port in ports:
+                raise ValueError("ポートの重複 port=" + str(port))
+            ports.add(port)
+        tunnels.append(tn)
+
+    if len(tunnels) == 0:
+        raise ValueError("tunnels が空")
+
+    return tunnels
+
+def parse_mappings(ents: List[Dict]) -> Dict[int, Mapping]:
+    """ポート対応付けの一覧の解析
+
+    Args:
+        ents (List[Dict]): 設定ファイルの mappings の内容
+
+    Returns:
+        Dict[int, Mapping]: 番号とポート対応付けの対応表
+    """
+
+    mappings: Dict[int, Mapping] = {}
+    for ent in ents:
+        mp = Mapping(
+            map_id=int(ent["id"]),
+            job_port=int(ent["job_port"]),
+            prio=bool(ent.get("prio", False)),
+        )
+        if mp.map_id < 0 or mp.map_id > MAX_MAP_ID:
+            raise ValueError("id は 0～" + str(MAX_MAP_ID) + " id=" + str(mp.map_id))
+        if mp.map_id in mappings:
+            raise ValueError("id の重複 id=" + str(mp.map_id))
+        if any(m.job_port == mp.job_port for m in mappings.values()):
+            raise ValueError("job_port の重複 job_port=" + str(mp.job_port))
+        mappings[mp.map_id] = mp
+
+    if len(mappings) == 0:
+        raise ValueError("mappings が空")
+
+    return mappings
+
 
 if __name__ == "__main__":
     main()
@@ -8,13 +8,25 @@ warnings.filterwarnings('ignore')
 
 import os
 import time
+import atexit
+import threading
 import datetime
 import math
-import inspect
 
 from typing import Literal
 from typing import Optional
 
+# 非同期書き出し時、溜まった量がこれを超えるか
+LOG_BATCH_SIZE = 65536
+# 前回の書き出しからこの時間（秒）が経ったらまとめて書き出す
+LOG_FLUSH_INTERVAL = 0.5
+
+# output_dump で表示する最大バイト数（超えた分は先頭と末尾だけ表示、0 は無制限）
+LOG_DUMP_MAX = 1024
+
+# 表示可能な文字はそのまま、それ以外はドットにする変換表
+DUMP_TABLE = bytes( c if 0x20 <= c <= 0x7E else 0x2E for c in range( 256 ) )
+
 class Log:
 
 	def __init__(self, tid: int, name: str, path: str = "") -> None:
@@ -30,6 +42,28 @@ class Log:
 
 		self.ondebug = True
 		self.outflag = False
+		self.oncaller = True
+		# location から見た呼び出し元の深さ（output を包む計測中は 1 つ深くなる）
+		self.caller_depth = 2
+		self.dump_max = LOG_DUMP_MAX
+
+		# 時刻文字列の秒までの部分（1秒ごとに作り直す）
+		self.stamp_sec = -1
+		self.stamp_str = ''
+		# ファイルパスとファイル名の対応
+		self.basenames: dict[str, str] = {}
+
+		# 非同期書き出し（async_on で有効化）
+		self.async_mode = False
+		self.fork_hooked = False
+		self.writer: Optional[threading.Thread] = None
+		self.cond = threading.Condition()
+		self.pending: list[str] = []
+		self.pending_size = 0
+		self.urgent = False
+		self.closing = False
+		self.seq = 0
+		self.done = 0
 
 
 	def __del__(self) -> None:
@@ -37,101 +71,50 @@ class Log:
 			self.f.close()
 
 
-	def output(self, level: Literal["ERR", "INF", "WRN", "DBG"], message: str) -> None:
+	def output(self, level: Literal["ERR", "INF", "WRN", "DBG"], message: str, *args: object) -> None:
+		"""記録の出力
+
+		args を渡した場合は、出力すると決まってから message % args で組み立てる。
+
+		Args:
+			level: 記録の種別
+			message (str): 記録内容（args があれば % 形式の書式）
+			args: 書式に当てはめる値
+		"""
 
 		if ( self.ondebug == False ) and ( level == "DBG" ):
 			return
 
-		filename = ""
-		lineno = 0
-		cframe = inspect.currentframe()
-		if cframe is not None:
-			frame = cframe.f_back
-			if frame is not None:
-				filename = os.path.basename(frame.f_code.co_filename)
-				lineno = frame.f_lineno
+		if args:
+			message = message % args
 
-		tm = time.time()
-		tm_int = math.floor( tm )
-		tm_mil = math.floor( tm * 1000 ) - tm_int * 1000
-		dt = datetime.datetime.fromtimestamp( tm_int )
-		dt_str = '{0:%Y-%m-%d %H:%M:%S}'.format( dt ) + '.' + str( tm_mil ).zfill( 3 )
-
-		msg = ( dt_str
+		msg = ( self.stamp()
 			+ ' [' + level + '] '
 			+ '(' + str(self.tid) + ') '
-			+ filename + ':' + str(lineno) + ' ' + message )
+			+ self.location() + ' ' + message )
 		if self.outflag:
 			print( msg )
 
-		self.f.write( msg + '\n' )
-		self.f.flush()
+		self.write( level, msg + '\n' )
 
 	def output_dump(self, level: Literal["ERR", "INF", "WRN", "DBG"], message: Optional[bytes]) -> None:
 
 		if ( self.ondebug == False ) and ( level == "DBG" ):
 			return
 
-		filename = ""
-		lineno = 0
-		cframe = inspect.currentframe()
-		if cframe is not None:
-			frame = cframe.f_back
-			if frame is not None:
-				filename = os.path.basename(frame.f_code.co_filename)
-				lineno = frame.f_lineno
-
-		tm = time.time()
-		tm_int = math.floor( tm )
-		tm_mil = math.floor( tm * 1000 ) - tm_int * 1000
-		dt = datetime.datetime.fromtimestamp( tm_int )
-		dt_str = '{0:%Y-%m-%d %H:%M:%S}'.format( dt ) + '.' + str( tm_mil ).zfill( 3 )
-
-		msg = ( dt_str
+		msg = ( self.stamp()
 			+ ' [' + level + '] '
 			+ '(' + str(self.tid) + ') '
-			+ filename + ':' + str(lineno) + ' Dump' )
+			+ self.location() + ' Dump' )
 		msg += '\n'
 
-		chs: list[str] = []
-		chs2: list[str] = []
-
-		mlen: int = 0
 		if message is not None:
-			mlen = len(message)
-		# messageを1バイトずつ取得して繰り返し処理する。
-		for i in range(0, mlen):
-			# i を16進数で2桁に変換して、chsに追加
-			chs.append( format(message[i], '02X') )
-			# 文字コードが表示可能な範囲の場合、その文字をchs2に追加。そうでない場合はドットを追加
-			if (message[i] >= 0x20) and (message[i] <= 0x7E):
-				chs2.append( chr(message[i]) )
-			else:
-				chs2.append( '.' )
-		
-		l1: str = ''
-		l2: str = ''
-		for c in range(0, len(chs)):
-			l1 += chs[c]
-			l2 += chs2[c]
-			if (c + 1) % 16 == 0:
-				msg += l1 + '    ' + l2 + '\n'
-				l1 = ''
-				l2 = ''
-			elif (c + 1) % 8 == 0:
-				l1 += '  '
-				l2 += ' '
-			else:
-				l1 += ' '
-				l2 += ' '
-		if len(l1) > 0:
-			msg += l1.ljust(16 * 3 + 2, ' ') + '    ' + l2 + '\n'
+			msg += self.hexdump( message )
 
 		if self.outflag:
 			print( msg )
 
-		self.f.write( msg + '\n' )
-		self.f.flush()		
+		self.write( level, msg + '\n' )
 
 
 	def debug_on(self) -> None:
@@ -145,3 +128,182 @@ class Log:
 
 	def print_off(self) -> None:
 		self.outflag = False
+
+	def dump_limit(self, size: int) -> None:
+		"""output_dump で表示する最大バイト数の設定（0 は無制限）"""
+		self.dump_max = size
+
+	def hexdump(self, data: bytes) -> str:
+		"""16バイトごとの16進・文字表示
+
+		dump_max を超える場合は先頭と末尾を半分ずつ表示し、間を省く。
+		"""
+		size = len( data )
+		if self.dump_max <= 0 or size <= self.dump_max:
+			return self.hexrows( data, 0, size )
+
+		keep = max( ( self.dump_max // 2 ) // 16 * 16, 16 )
+		# 末尾側も16バイト境界から表示する
+		start = max( ( size - keep + 15 ) // 16 * 16, keep )
+		return ( self.hexrows( data, 0, keep )
+			+ '（中略 ' + str( start - keep ) + ' バイト）\n'
+			+ self.hexrows( data, start, size ) )
+
+	def hexrows(self, data: bytes, start: int, end: int) -> str:
+		"""data[start:end] の16進・文字表示（start は16の倍数）"""
+		chunk = bytes( data[start:end] )
+		text = chunk.translate( DUMP_TABLE ).decode( 'ascii' )
+		rows: list[str] = []
+		for i in range( 0, len( chunk ), 16 ):
+			row = chunk[i:i + 16]
+			l1 = row[:8].hex( ' ' ).upper()
+			if len( row ) > 8:
+				l1 += '  ' + row[8:].hex( ' ' ).upper()
+			l2 = ' '.join( text[i:i + 16] )
+			if len( row ) == 16:
+				rows.append( l1 + '    ' + l2 + '\n' )
+			else:
+				# 端数の行は区切りを残したまま桁をそろえる
+				l1 += '  ' if len( row ) == 8 else ' '
+				rows.append( l1.ljust( 16 * 3 + 2, ' ' ) + '    ' + l2 + ' \n' )
+		return ''.join( rows )
+
+	def caller_on(self) -> None:
+		self.oncaller = True
+
+	def caller_off(self) -> None:
+		"""呼び出し元のファイル名:行番号の取得を止める（"-" を出力する）"""
+		self.oncaller = False
+
+	def stamp(self) -> str:
+		"""時刻文字列（ミリ秒まで）"""
+		tm = time.time()
+		tm_int = math.floor( tm )
+		if tm_int != self.stamp_sec:
+			dt = datetime.datetime.fromtimestamp( tm_int )
+			self.stamp_str = '{0:%Y-%m-%d %H:%M:%S}'.format( dt ) + '.'
+			self.stamp_sec = tm_int
+		tm_mil = math.floor( tm * 1000 ) - tm_int * 1000
+		return self.stamp_str + str( tm_mil ).zfill( 3 )
+
+	def location(self) -> str:
+		"""output / output_dump の呼び出し元のファイル名:行番号"""
+		if not self.oncaller:
+			return '-'
+		try:
+			# location <- output <- 呼び出し元
+			frame = sys._getframe( self.caller_depth )
+		except ( AttributeError, ValueError ):
+			return '-'
+		path = frame.f_code.co_filename
+		filename = self.basenames.get( path )
+		if filename is None:
+			filename = os.path.basename( path )
+			self.basenames[path] = filename
+		return filename + ':' + str( frame.f_lineno )
+
+	def async_on(self) -> None:
+		"""非同期書き出しの開始
+
+		以降の記録は書き出し用スレッドへ渡し、LOG_BATCH_SIZE か LOG_FLUSH_INTERVAL ごとに
+		まとめて書き出す。ERR の記録と終了時だけは書き出し完了まで待つ。
+		"""
+		if self.async_mode:
+			return
+		self.async_mode = True
+		self.start_writer()
+		atexit.register( self.async_off )
+		if not self.fork_hooked and hasattr( os, "register_at_fork" ):
+			# fork 前に書き出し待ちを掃き出し、子プロセスでは書き出し用スレッドを作り直す
+			os.register_at_fork( before=self.sync, after_in_child=self.after_fork )
+			self.fork_hooked = True
+
+	def async_off(self) -> None:
+		"""非同期書き出しの終了（書き出し待ちをすべて書き出す）"""
+		writer = self.writer
+		if writer is None:
+			return
+		with self.cond:
+			self.closing = True
+			self.cond.notify_all()
+		writer.join()
+		with self.cond:
+			self.writer = None
+			self.async_mode = False
+			if len( self.pending ) > 0:
+				self.f.write( ''.join( self.pending ) )
+				self.f.flush()
+			self.pending = []
+			self.pending_size = 0
+			self.cond.notify_all()
+
+	def sync(self) -> None:
+		"""書き出し待ちの記録がすべて書き出されるまで待つ"""
+		if self.writer is None:
+			return
+		with self.cond:
+			target = self.seq
+			self.urgent = True
+			self.cond.notify_all()
+			self.cond.wait_for( lambda: self.done >= target or self.writer is None )
+
+	def write(self, level: Literal["ERR", "INF", "WRN", "DBG"], text: str) -> None:
+		"""記録の書き出し（非同期書き出し中は書き出し用スレッドへ渡す）"""
+		if not self.async_mode:
+			self.f.write( text )
+			self.f.flush()
+			return
+
+		with self.cond:
+			self.pending.append( text )
+			self.pending_size += len( text )
+			self.seq += 1
+			if level == "ERR":
+				self.urgent = True
+			if self.urgent or self.pending_size >= LOG_BATCH_SIZE:
+				self.cond.notify_all()
+			if level == "ERR":
+				# ERR は書き出し完了まで待つ
+				target = self.seq
+				self.cond.wait_for( lambda: self.done >= target or self.writer is None )
+
+	def start_writer(self) -> None:
+		"""書き出し用スレッドの起動"""
+		self.closing = False
+		self.writer = threading.Thread( target=self.writer_loop, name="log-writer", daemon=True )
+		self.writer.start()
+
+	def writer_loop(self) -> None:
+		"""書き出し用スレッドの処理"""
+		while True:
+			with self.cond:
+				self.cond.wait_for( lambda: self.urgent or self.closing or self.pending_size >= LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL )
+				batch = self.pending
+				seq = self.seq
+				closing = self.closing
+				self.pending = []
+				self.pending_size = 0
+				self.urgent = False
+
+			# ファイルへの書き出し中は記録を止めない
+			if len( batch ) > 0:
+				self.f.write( ''.join( batch ) )
+				self.f.flush()
+
+			with self.cond:
+				self.done = seq
+				self.cond.notify_all()
+			if closing:
+				return
+
+	def after_fork(self) -> None:
+		"""fork 後の子プロセスでの作り直し（スレッドは引き継がれないため）"""
+		self.cond = threading.Condition()
+		self.pending = []
+		self.pending_size = 0
+		self.urgent = False
+		self.seq = 0
+		self.done = 0
+		self.writer = None
+		if self.async_mode:
+			self.start_writer()
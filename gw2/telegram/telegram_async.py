@@ -0,0 +1,182 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import asyncio
+
+from typing import Optional
+from typing import Tuple
+
+from telegram.telegram_frame import parse_unit
+from telegram.telegram_capture import FrameCapture
+from telegram.telegram_capture import FRAME_RAW
+from telegram.telegram_capture import DIR_SEND
+from telegram.telegram_capture import DIR_RECV
+
+class AsyncTelSocket:
+    """asyncio版の通信ソケットのクラス
+
+    電文形式は TelSocket と同一（ユニット名4バイト＋サイズ10進8桁＋データ）。
+    旧方式のゲートウェイとそのまま接続できる。
+    """
+
+    # 電文の記録器（ゲートウェイが起動時に設定する。None なら記録しない）
+    capture: Optional[FrameCapture] = None
+
+    def __init__(self) -> None:
+        self.name: str = "noname"
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.siz_namsiz = 4
+        self.siz_msgsiz = 8
+        self.cap_chan: int = 0
+
+    async def connect(self, ip: str = "127.0.0.1", port: int = 50001) -> bool:
+        """接続処理
+
+        Args:
+            ip (str): 接続先IPアドレス
+            port (int): 接続先ポート番号
+
+        Returns:
+            True: 正常終了
+            False: 異常終了
+        """
+        try:
+            reader, writer = await asyncio.open_connection(ip, port)
+        except OSError:
+            return False
+        self.build(reader, writer)
+        return True
+
+    def close(self) -> None:
+        """切断処理"""
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def abort(self) -> None:
+        """切断処理（送信バッファの書き切りを待たない）"""
+        if self.writer is not None:
+            self.writer.transport.abort()
+        self.reader = None
+        self.writer = None
+
+    def build(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """構築処理"""
+        self.reader = reader
+        self.writer = writer
+
+    def set_name(self, name: str) -> None:
+        """命名処理"""
+        self.name = name
+        # ジョブソケットはユニット名がチャネル番号
+        self.cap_chan = int(name) if name.isdigit() else 0
+
+    def send_raw(self, data: bytes) -> None:
+        """生送信
+
+        送信バッファへ積むだけで待ち合わせない。送信完了は drain で待つ。
+
+        Args:
+            data (bytes): 送信データ
+        Returns:
+            なし
+        """
+        if self.writer is None:
+            return
+        if self.capture is not None:
+            self.capture.record(DIR_SEND, FRAME_RAW, self.cap_chan, data)
+        self.writer.write(data)
+
+    async def drain(self) -> bool:
+        """送信バッファの掃き出し待ち
+
+        Returns:
+            True: 正常終了
+            False: 切断検知
+        """
+        if self.writer is None:
+            return False
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return False
+        return True
+
+    async def receive_raw(self, length: int) -> Optional[bytes]:
+        """生受信
+
+        Args:
+            length (int): 受信バイト数（負の場合は届いた分だけ最大4096バイト）
+        Returns:
+            None: 切断検知
+            data (bytes): 受信データ
+        """
+        if self.reader is None:
+            return None
+        try:
+            if length < 0:
+                data = await self.reader.read(4096)
+            else:
+                data = await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        if not data:
+            return None
+        # 電文の一部として読んだ分は receive で電文単位に記録する
+        if length < 0 and self.capture is not None:
+            self.capture.record(DIR_RECV, FRAME_RAW, self.cap_chan, data)
+        return data
+
+    async def receive(self) -> Tuple[str, int, bytes]:
+        """受信処理
+
+        Returns:
+            (ユニット名, サイズ, データ)。切断時はユニット名が空文字
+        """
+        bt_unit = await self.receive_raw(self.siz_namsiz)
+        if bt_unit is None:
+            return ("", 0, b"")
+        st_unit = bt_unit.decode()
+
+        bt_size = await self.receive_raw(self.siz_msgsiz)
+        if bt_size is None:
+            return ("", 0, b"")
+        it_size = int(bt_size.decode())
+
+        bt_data = b""
+        if it_size > 0:
+            d = await self.receive_raw(it_size)
+            if d is None:
+                return ("", 0, b"")
+            bt_data = d
+
+        if self.capture is not None:
+            ftype, chan = parse_unit(st_unit)
+            self.capture.record(DIR_RECV, ftype, chan, bt_data)
+        return (st_unit, it_size, bt_data)
+
+    def send(self, unit: str, bt_data: bytes) -> None:
+        """送信処理
+
+        ヘッダとデータを続けて送信バッファへ積む（途中で他タスクは割り込まない）。
+
+        Args:
+            unit (str): ユニット文字列
+            bt_data (bytes): 送信データ
+        """
+        bt_unit = unit.ljust(self.siz_namsiz).encode()
+        bt_size = str(len(bt_data)).zfill(self.siz_msgsiz).encode()
+
+        if self.writer is None:
+            return
+        if self.capture is not None:
+            ftype, chan = parse_unit(unit)
+            self.capture.record(DIR_SEND, ftype, chan, bt_data)
+        self.writer.write(bt_unit + bt_size)
+        if len(bt_data) > 0:
+            self.writer.write(bt_data)
@@ -0,0 +1,70 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+from typing import Dict
+from typing import List
+
+
+class BufferPool:
+    """受信バッファの再利用プール
+
+    よく使う大きさ（2のべき乗）ごとに bytearray を溜めておき、
+    電文ごとの確保と解放を避ける。上限を超える大きさはその都度確保する。
+    """
+
+    def __init__(self, min_size: int = 4096, max_size: int = 1048576, keep: int = 8) -> None:
+        """コンストラクタ
+
+        Args:
+            min_size (int): 最小のバッファサイズ
+            max_size (int): プールで保持する最大のバッファサイズ
+            keep (int): 大きさごとに保持するバッファ数
+        """
+        self.min_size: int = min_size
+        self.max_size: int = max_size
+        self.keep: int = keep
+        self.free: Dict[int, List[bytearray]] = {}
+
+    def size_class(self, size: int) -> int:
+        """要求サイズを収められる大きさ（2のべき乗）を求める"""
+        cls = self.min_size
+        while cls < size:
+            cls <<= 1
+        return cls
+
+    def acquire(self, size: int) -> bytearray:
+        """バッファの取得
+
+        Args:
+            size (int): 必要なバイト数
+
+        Returns:
+            bytearray: size バイト以上のバッファ
+        """
+        if size > self.max_size:
+            return bytearray(size)
+        cls = self.size_class(size)
+        lst = self.free.get(cls)
+        if lst:
+            return lst.pop()
+        return bytearray(cls)
+
+    def release(self, buf: bytearray) -> None:
+        """バッファの返却
+
+        Args:
+            buf (bytearray): acquire で取得したバッファ
+        """
+        cls = len(buf)
+        if cls > self.max_size or cls < self.min_size or cls & (cls - 1):
+            return
+        lst = self.free.setdefault(cls, [])
+        if len(lst) < self.keep:
+            lst.append(buf)
+
+
+# プロセス内で共有するプール
+POOL = BufferPool()
@@ -0,0 +1,177 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import os
+import mmap
+import time
+import struct
+
+from typing import Iterator
+from typing import NamedTuple
+from typing import Optional
+
+# 記録ファイルの形式
+#   ヘッダ(64バイト): 識別子 "TCAP", 版数, 予備, リングサイズ, 書込位置, 最古位置, 記録数, 省略サイズ
+#   リング: 記録を8バイト境界で並べる。末尾に収まらない記録は先頭へ回し、残りは長さ0で埋める
+#   記録: 記録長, 時刻, 方向, 電文種別, チャネル番号, データサイズ, 記録したデータサイズ + データ
+# 位置はリング先頭からの通算バイト数（リングサイズで割った余りが実際の位置）
+CAPTURE_MAGIC = b"TCAP"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct("!4sHHQQQQq")
+CAPTURE_HEADER_SIZE = 64
+CAPTURE_RECORD = struct.Struct("!IdBBIII")
+CAPTURE_ALIGN = 8
+
+# 方向
+DIR_SEND = 0
+DIR_RECV = 1
+
+# 電文の形を持たない生データ（ジョブソケット・交渉）の電文種別
+FRAME_RAW = 0x00
+
+# 既定のリングサイズ
+CAPTURE_SIZE = 67108864
+
+
+class CaptureRecord(NamedTuple):
+    """記録1件"""
+    ts: float
+    direction: int
+    ftype: int
+    chan: int
+    length: int
+    data: bytes
+
+
+class FrameCapture:
+    """送受信した電文の記録器
+
+    mmap したファイルをリングバッファとして使い、古い記録から上書きする。
+    書き込みはメモリへの複写だけで済み、プロセスが落ちても書いた分はファイルに残る。
+    """
+
+    def __init__(self, path: str, size: int = CAPTURE_SIZE, snap: int = 0) -> None:
+        """コンストラクタ
+
+        Args:
+            path (str): 記録ファイルのパス（既存の内容は捨てる）
+            size (int): リングサイズ
+            snap (int): 記録するデータの最大バイト数（0: ヘッダのみ, 負: すべて）
+
+        Raises:
+            ValueError: リングサイズが小さすぎる（記録2件分に満たない）
+        """
+        self.size: int = size // CAPTURE_ALIGN * CAPTURE_ALIGN
+        # 1件の記録長の上限（リングの半分まで。折り返しの埋め分と合わせてもリングに収まる）
+        self.max_reclen: int = self.size // 2 // CAPTURE_ALIGN * CAPTURE_ALIGN
+        if self.max_reclen < CAPTURE_RECORD.size:
+            raise ValueError("リングサイズが小さすぎる: " + str(size))
+        self.snap: int = snap
+        self.wpos: int = 0
+        self.rpos: int = 0
+        self.count: int = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, CAPTURE_HEADER_SIZE + self.size)
+            self.mm: Optional[mmap.mmap] = mmap.mmap(fd, CAPTURE_HEADER_SIZE + self.size)
+        finally:
+            os.close(fd)
+        self.write_header()
+
+    def write_header(self) -> None:
+        """ヘッダの更新"""
+        if self.mm is None:
+            return
+        CAPTURE_HEADER.pack_into(self.mm, 0, CAPTURE_MAGIC, CAPTURE_VERSION, 0,
+            self.size, self.wpos, self.rpos, self.count, self.snap)
+
+    def record(self, direction: int, ftype: int, chan: int, data: bytes) -> None:
+        """電文1件の記録
+
+        Args:
+            direction (int): DIR_SEND / DIR_RECV
+            ftype (int): 電文種別（生データは FRAME_RAW）
+            chan (int): チャネル番号
+            data (bytes): データ
+        """
+        mm = self.mm
+        if mm is None:
+            return
+        length = len(data)
+        caplen = length if self.snap < 0 else min(length, self.snap)
+        caplen = min(caplen, self.max_reclen - CAPTURE_RECORD.size)
+        reclen = (CAPTURE_RECORD.size + caplen + CAPTURE_ALIGN - 1) // CAPTURE_ALIGN * CAPTURE_ALIGN
+
+        # 末尾に収まらない場合は先頭へ回す
+        start = self.wpos
+        off = start % self.size
+        if off + reclen > self.size:
+            start += self.size - off
+
+        # 上書きされる古い記録を捨てる（書込位置より先は記録がないので読まない）
+        while start + reclen - self.rpos > self.size and self.rpos < self.wpos:
+            roff = self.rpos % self.size
+            rlen = struct.unpack_from("!I", mm, CAPTURE_HEADER_SIZE + roff)[0]
+            if rlen == 0:
+                self.rpos += self.size - roff
+            else:
+                self.rpos += rlen
+                self.count -= 1
+        if self.rpos >= self.wpos:
+            # すべて捨てた場合は折り返しの埋め分も飛ばす
+            self.rpos = start
+            self.count = 0
+
+        if start != self.wpos:
+            struct.pack_into("!I", mm, CAPTURE_HEADER_SIZE + off, 0)
+        pos = CAPTURE_HEADER_SIZE + start % self.size
+        CAPTURE_RECORD.pack_into(mm, pos, reclen, time.time(), direction, ftype, chan, length, caplen)
+        if caplen > 0:
+            pos += CAPTURE_RECORD.size
+            mm[pos:pos + caplen] = data[:caplen]
+        self.wpos = start + reclen
+        self.count += 1
+        self.write_header()
+
+    def close(self) -> None:
+        """終了処理"""
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """記録ファイルの読み出し（古い順）
+
+    Args:
+        path (str): 記録ファイルのパス
+
+    Returns:
+        記録の並び
+
+    Raises:
+        ValueError: 記録ファイルの形式ではない
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+    magic, version, _, size, wpos, rpos, _, _ = CAPTURE_HEADER.unpack_from(buf, 0)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError("記録ファイルではない: " + path)
+
+    pos = rpos
+    while pos < wpos:
+        off = pos % size
+        base = CAPTURE_HEADER_SIZE + off
+        reclen, ts, direction, ftype, chan, length, caplen = CAPTURE_RECORD.unpack_from(buf, base) \
+            if off + CAPTURE_RECORD.size <= size else (0, 0.0, 0, 0, 0, 0, 0)
+        if reclen == 0:
+            pos += size - off
+            continue
+        data = buf[base + CAPTURE_RECORD.size:base + CAPTURE_RECORD.size + caplen]
+        yield CaptureRecord(ts, direction, ftype, chan, length, data)
+        pos += reclen
@@ -4,19 +4,82 @@ import warnings
 sys.dont_write_bytecode = True
 warnings.filterwarnings('ignore')
 
+import errno
 import socket
 import select
+import selectors
+
+from collections import deque
 
 from typing import Optional
+from typing import Dict
+from typing import Iterator
+from typing import Deque
 from typing import Union
 from typing import List
+from typing import Tuple
+
+from telegram.telegram_frame import PROTO_V1
+from telegram.telegram_frame import PROTO_V2
+from telegram.telegram_frame import FRAME_HELLO
+from telegram.telegram_frame import HELLO_UNIT
+from telegram.telegram_frame import HELLO_TIMEOUT
+from telegram.telegram_frame import pack_v1
+from telegram.telegram_frame import pack_v2
+from telegram.telegram_frame import unit_name
+from telegram.telegram_frame import encode_caps
+from telegram.telegram_frame import decode_caps
+from telegram.telegram_frame import FrameDecoder
+from telegram.telegram_capture import FrameCapture
+from telegram.telegram_capture import FRAME_RAW
+from telegram.telegram_capture import DIR_SEND
+from telegram.telegram_capture import DIR_RECV
+from telegram.telegram_buffer import POOL
+
+# 1回の sendmsg に渡すバッファ数の上限（IOV_MAX 以下）
+IOV_MAX = 512
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# 送信待ちの上限（これを超えたら送信元からの受信を止め、下限まで減ったら再開）
+WQ_HIGH = 1048576
+WQ_LOW = 262144
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+# 非ブロッキング接続で「接続中」を表す connect_ex の戻り値
+CONNECT_PENDING = (errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
 
 class TelSocket:
 
+    # 電文の記録器（ゲートウェイが起動時に設定する。None なら記録しない）
+    capture: Optional[FrameCapture] = None
+
     def __init__(self) -> None:
         self.name: str = "noname"
         self.sock: Optional[socket.socket] = None
+        self.registry: Optional["SocketRegistry"] = None
         self.siz_msgsiz = 8
+        self.proto: int = PROTO_V1
+        self.decoder: FrameDecoder = FrameDecoder(self.proto)
+        self.recv_chunk: int = 262144
+        self.recv_buf: Optional[bytearray] = None
+        self.out_vec: List[bytes] = []
+        self.nonblock: bool = False
+        self.want_read: bool = True
+        self.closing: bool = False
+        self.connecting: bool = False
+        self.wq: Deque[memoryview] = deque()
+        self.wq_bytes: int = 0
+        self.sent_total: int = 0
+        # 統計（受信量、システムコール回数、送信電文数）
+        self.stat_recv_bytes: int = 0
+        self.stat_recv_calls: int = 0
+        self.stat_send_calls: int = 0
+        self.stat_frames_sent: int = 0
+        self.high_water: int = WQ_HIGH
+        self.low_water: int = WQ_LOW
+        self.cap_chan: int = 0
 
     def connect(self, ip: str = "127.0.0.1", port: int = 50001) -> bool:
         """接続処理
@@ -33,10 +96,54 @@ class TelSocket:
         try:
             sock.connect((ip, port))
         except:
+            sock.close()
             return False
         self.build(sock)
         return True
 
+    def connect_nb(self, ip: str = "127.0.0.1", port: int = 50001) -> bool:
+        """非ブロッキング接続の開始
+
+        接続の完了を待たずに戻る。接続中は書き込み可能を監視し、
+        可能になったら finish_connect で結果を確かめる。
+        接続中の送信は送信待ちに積み、接続完了後に書き出す。
+
+        Args:
+            ip (str): 接続先IPアドレス
+            port (int): 接続先ポート番号
+
+        Returns:
+            True: 接続中または接続済み
+            False: 異常終了
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((ip, port))
+        if err != 0 and err not in CONNECT_PENDING:
+            sock.close()
+            return False
+        self.build(sock)
+        self.nonblock = True
+        self.set_nodelay()
+        self.connecting = err != 0
+        return True
+
+    def finish_connect(self) -> bool:
+        """非ブロッキング接続の完了確認（書き込み可能になった時点で呼ぶ）
+
+        Returns:
+            True: 接続完了
+            False: 接続失敗
+        """
+        if self.sock is None:
+            return False
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            return False
+        self.connecting = False
+        if self.registry is not None:
+            self.registry.update(self)
+        return True
+
     def close(self) -> None:
         """切断処理
 
@@ -46,9 +153,13 @@ class TelSocket:
         Returns:
             なし
         """
+        if self.registry is not None:
+            self.registry.unregister(self)
         if self.sock is not None:
             self.sock.close()
         self.sock = None
+        self.wq.clear()
+        self.wq_bytes = 0
 
     def build(self, sock: socket.socket) -> None:
         """構築処理"""
@@ -57,6 +168,8 @@ class TelSocket:
     def set_name(self, name: str) -> None:
         """命名処理"""
         self.name = name
+        # ジョブソケットはユニット名がチャネル番号
+        self.cap_chan = int(name) if name.isdigit() else 0
 
     def send_raw(self, data: bytes) -> None:
         """生送信
@@ -68,36 +181,49 @@ class TelSocket:
         """
         if self.sock is None:
             return
+        if self.capture is not None:
+            self.capture.record(DIR_SEND, FRAME_RAW, self.cap_chan, data)
+        if self.nonblock:
+            self.send_vec([data])
+            return
         self.sock.sendall(data)
+        self.stat_send_calls += 1
+        self.sent_total += len(data)
 
     def receive_raw(self, length: int) -> Optional[bytes]:
         """生受信
 
         Args:
-            length (int): 受信バイト数
+            length (int): 受信バイト数（負の場合は最大4096バイト、非ブロッキング時は最大 length バイト）
         Returns:
+            None: 切断検知
+            b"": 受信データなし（非ブロッキング時）
             data (bytes): 受信データ
         """
         if self.sock is None:
             return None
-        if length < 0:
-            length = 4096
-            data = self.sock.recv(length)
+        data: Optional[bytes]
+        if length < 0 or self.nonblock:
+            if length < 0:
+                length = 4096
+            try:
+                data = self.sock.recv(length)
+            except (BlockingIOError, InterruptedError):
+                # 非ブロッキング時に受信データなし
+                return b""
+            except (ConnectionError, OSError):
+                return None
+            if data:
+                self.stat_recv_calls += 1
+                self.stat_recv_bytes += len(data)
         else:
-            rem_length = length
-            con = True
-            data = b""
-            while con:
-                d = self.sock.recv(rem_length)
-                data += d
-                rem_length -= len(d)
-                if rem_length <= 0:
-                    con = False
-    
-#            data = self.sock.recv(length)
-        
+            # 再利用バッファへ直接受信する（途中で切断された場合は None）
+            data = self.receive_exact(length)
+
         if not data:
             return None
+        if self.capture is not None:
+            self.capture.record(DIR_RECV, FRAME_RAW, self.cap_chan, data)
         return data
 
     def send(self, message: str) -> None:
@@ -139,6 +265,396 @@ class TelSocket:
 
         return data
 
+    def receive_into(self, view: memoryview) -> bool:
+        """指定領域が埋まるまで受信
+
+        受信済みの部分を連結し直さないため、分割して届く大きな電文でも複写は1回で済む。
+
+        Args:
+            view (memoryview): 受信先の領域
+        Returns:
+            True: 正常終了
+            False: 切断検知
+        """
+        if self.sock is None:
+            return False
+        got = 0
+        length = len(view)
+        while got < length:
+            try:
+                n = self.sock.recv_into(view[got:])
+            except (ConnectionError, OSError):
+                return False
+            if n == 0:
+                return False
+            got += n
+            self.stat_recv_calls += 1
+        self.stat_recv_bytes += length
+        return True
+
+    def receive_exact(self, length: int) -> Optional[bytes]:
+        """指定バイト数の受信
+
+        Args:
+            length (int): 受信バイト数
+        Returns:
+            None: 切断検知
+            data (bytes): 受信データ
+        """
+        buf = POOL.acquire(length)
+        with memoryview(buf) as mv:
+            view = mv[:length]
+            ok = self.receive_into(view)
+            data = bytes(view) if ok else None
+            view.release()
+        POOL.release(buf)
+        return data
+
+    def send_frame(self, ftype: int, chan: int, bt_data: bytes) -> None:
+        """電文送信（交渉済みのバージョンの形式で送る）
+
+        Args:
+            ftype (int): 電文種別
+            chan (int): チャネル番号
+            bt_data (bytes): 送信データ
+        """
+        self.queue_frame(ftype, chan, bt_data)
+        self.flush()
+
+    def queue_frame(self, ftype: int, chan: int, bt_data: bytes) -> None:
+        """電文の送信待ち登録（flush でまとめて送る）
+
+        Args:
+            ftype (int): 電文種別
+            chan (int): チャネル番号
+            bt_data (bytes): 送信データ
+        """
+        if self.capture is not None:
+            self.capture.record(DIR_SEND, ftype, chan, bt_data)
+        if self.proto == PROTO_V2:
+            bt_head = pack_v2(ftype, chan, len(bt_data))
+        else:
+            bt_head = pack_v1(unit_name(chan), len(bt_data))
+        self.stat_frames_sent += 1
+        self.out_vec.append(bt_head)
+        if len(bt_data) > 0:
+            self.out_vec.append(bt_data)
+
+    def flush(self) -> None:
+        """送信待ちの電文をまとめて送信"""
+        if len(self.out_vec) == 0:
+            return
+        vec = self.out_vec
+        self.out_vec = []
+        self.send_vec(vec)
+
+    def send_vec(self, bufs: List[bytes]) -> None:
+        """複数バッファの一括送信
+
+        ヘッダとデータを連結せずに sendmsg で送る。
+        sendmsg がない環境（Windows）では連結して送る。
+
+        Args:
+            bufs (List[bytes]): 送信データの並び
+        """
+        if self.sock is None:
+            return
+        if self.nonblock:
+            # 送信待ちに積んで書けるだけ書く
+            for b in bufs:
+                if len(b) > 0:
+                    self.wq.append(memoryview(b))
+                    self.wq_bytes += len(b)
+            self.write_pending()
+            return
+        if not HAS_SENDMSG:
+            data = b"".join(bufs)
+            self.sock.sendall(data)
+            self.stat_send_calls += 1
+            self.sent_total += len(data)
+            return
+
+        views = [memoryview(b) for b in bufs if len(b) > 0]
+        idx = 0
+        while idx < len(views):
+            n = self.sock.sendmsg(views[idx:idx + IOV_MAX])
+            self.stat_send_calls += 1
+            self.sent_total += n
+            # 送信できた分を先頭から外す
+            while n > 0:
+                length = len(views[idx])
+                if n >= length:
+                    n -= length
+                    idx += 1
+                else:
+                    views[idx] = views[idx][n:]
+                    n = 0
+
+    def set_proto(self, proto: int) -> None:
+        """電文形式の切り替え（以降の送受信に適用）"""
+        self.proto = proto
+        self.decoder.proto = proto
+
+    def fill(self) -> bool:
+        """受信できた分をまとめて復号器へ取り込む
+
+        1回の受信で複数の電文を読み込むため、電文ごとの受信回数を減らせる。
+
+        Returns:
+            True: 正常終了
+            False: 切断検知
+        """
+        if self.sock is None:
+            return False
+        if self.recv_buf is None:
+            self.recv_buf = bytearray(self.recv_chunk)
+        try:
+            n = self.sock.recv_into(self.recv_buf)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except (ConnectionError, OSError):
+            return False
+        if n == 0:
+            return False
+        self.stat_recv_calls += 1
+        self.stat_recv_bytes += n
+        with memoryview(self.recv_buf) as mv:
+            self.decoder.feed(mv[:n])
+        return True
+
+    def frames(self) -> Iterator[Tuple[int, int, bytes]]:
+        """取り込み済みの完結した電文をすべて取り出す"""
+        if self.capture is None:
+            return self.decoder.frames()
+        return self.captured(self.decoder.frames())
+
+    def captured(self, frames: Iterator[Tuple[int, int, bytes]]) -> Iterator[Tuple[int, int, bytes]]:
+        """取り出した電文を記録しながら渡す"""
+        for frame in frames:
+            if self.capture is not None:
+                self.capture.record(DIR_RECV, frame[0], frame[1], frame[2])
+            yield frame
+
+    def next_frame(self) -> Optional[Tuple[int, int, bytes]]:
+        """取り込み済みの完結した電文を1つ取り出す
+
+        Returns:
+            None: 完結した電文がない
+            (電文種別, チャネル番号, データ)
+        """
+        frame = self.decoder.next_frame()
+        if frame is not None and self.capture is not None:
+            self.capture.record(DIR_RECV, frame[0], frame[1], frame[2])
+        return frame
+
+    def receive_frame(self) -> Optional[Tuple[int, int, bytes]]:
+        """電文受信（交渉済みのバージョンの形式で受ける）
+
+        Returns:
+            None: 切断検知
+            (電文種別, チャネル番号, データ)
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.fill():
+                return None
+
+    def wait_frame(self, timeout: float) -> Optional[Tuple[int, int, bytes]]:
+        """時間制限付きの電文受信
+
+        Returns:
+            None: 時間切れまたは切断検知
+            (電文種別, チャネル番号, データ)
+        """
+        if self.sock is None:
+            return None
+        frame = self.next_frame()
+        if frame is not None:
+            return frame
+        rs, _, _ = select.select([self.sock], [], [], timeout)
+        if len(rs) == 0:
+            return None
+        return self.receive_frame()
+
+    def hello_client(self, caps: Dict[str, str], timeout: float = HELLO_TIMEOUT) -> Tuple[Dict[str, str], Optional[Tuple[int, int, bytes]]]:
+        """バージョン交渉（接続する側）
+
+        v1形式で空の HELO を送り、相手の機能一覧を待つ。
+        旧版の相手は空の電文を読み捨てるため、応答がなければ v1 のまま続ける。
+
+        Args:
+            caps (Dict[str, str]): 自側の機能一覧
+            timeout (float): 応答待ち時間（秒）
+
+        Returns:
+            (合意した機能一覧, 交渉中に受信した通常電文（なければ None）)
+        """
+        self.send_raw(pack_v1(HELLO_UNIT, 0))
+
+        frame = self.wait_frame(timeout)
+        if frame is None or frame[0] != FRAME_HELLO:
+            # 旧版の相手
+            return ({}, frame)
+
+        offered = decode_caps(frame[2])
+        agreed: Dict[str, str] = {}
+        for k, v in caps.items():
+            if k in offered:
+                agreed[k] = v
+        bt_caps = encode_caps(agreed)
+        self.send_raw(pack_v1(HELLO_UNIT, len(bt_caps)) + bt_caps)
+
+        if "v2" in agreed:
+            self.set_proto(PROTO_V2)
+        return (agreed, None)
+
+    def hello_server(self, caps: Dict[str, str], timeout: float = HELLO_TIMEOUT) -> Tuple[Dict[str, str], Optional[Tuple[int, int, bytes]]]:
+        """バージョン交渉（接続を受け付けた側）
+
+        空の HELO を受けたら自側の機能一覧を返し、相手が選んだ一覧を受けて切り替える。
+        時間内に HELO が来なければ旧版の相手として v1 のまま続ける。
+
+        Args:
+            caps (Dict[str, str]): 自側の機能一覧
+            timeout (float): HELO 待ち時間（秒）
+
+        Returns:
+            (合意した機能一覧, 交渉中に受信した通常電文（なければ None）)
+        """
+        frame = self.wait_frame(timeout)
+        if frame is None or frame[0] != FRAME_HELLO:
+            # 旧版の相手
+            return ({}, frame)
+
+        bt_caps = encode_caps(caps)
+        self.send_raw(pack_v1(HELLO_UNIT, len(bt_caps)) + bt_caps)
+
+        frame = self.wait_frame(timeout)
+        if frame is None or frame[0] != FRAME_HELLO:
+            return ({}, frame)
+
+        agreed = decode_caps(frame[2])
+        if "v2" in agreed:
+            self.set_proto(PROTO_V2)
+        return (agreed, None)
+
+    def set_nonblocking(self) -> None:
+        """非ブロッキング化
+
+        以降の送信は送信待ちに積み、書き込み可能になった時点で書き出す。
+        """
+        if self.sock is None:
+            return
+        self.sock.setblocking(False)
+        self.nonblock = True
+        self.set_nodelay()
+
+    def set_nodelay(self) -> None:
+        """Nagle アルゴリズムの無効化
+
+        非ブロッキング時の送信は flush で1周回分をまとめて書き出すため、
+        小さい電文（CREDIT など）を相手の遅延 ACK まで止めておく必要はない。
+        """
+        if self.sock is None:
+            return
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    def events(self) -> int:
+        """監視すべき事象（受信停止中は受信を、送信待ちがあれば送信を監視）"""
+        if self.connecting:
+            # 接続完了は書き込み可能で分かる
+            return EVENT_WRITE
+        ev = 0
+        if self.want_read and not self.closing:
+            ev |= EVENT_READ
+        if self.wq_bytes > 0:
+            ev |= EVENT_WRITE
+        return ev
+
+    def pause_read(self) -> None:
+        """受信停止（送信先が詰まっている間）"""
+        if not self.want_read:
+            return
+        self.want_read = False
+        if self.registry is not None:
+            self.registry.update(self)
+
+    def resume_read(self) -> None:
+        """受信再開"""
+        if self.want_read:
+            return
+        self.want_read = True
+        if self.registry is not None:
+            self.registry.update(self)
+
+    def congested(self) -> bool:
+        """送信待ちが上限を超えているか"""
+        return self.wq_bytes >= self.high_water
+
+    def drained(self) -> bool:
+        """送信待ちが下限まで減ったか"""
+        return self.wq_bytes <= self.low_water
+
+    def write_pending(self) -> bool:
+        """送信待ちを書けるだけ書く
+
+        Returns:
+            True: 正常終了（書き切れなかった分は次の書き込み可能時に書く）
+            False: 切断検知
+        """
+        if self.sock is None:
+            return False
+        if self.connecting:
+            return True
+        wq = self.wq
+        while wq:
+            try:
+                if HAS_SENDMSG:
+                    n = self.sock.sendmsg([wq[k] for k in range(min(len(wq), IOV_MAX))])
+                else:
+                    n = self.sock.send(wq[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            except (ConnectionError, OSError):
+                wq.clear()
+                self.wq_bytes = 0
+                return False
+            self.stat_send_calls += 1
+            self.wq_bytes -= n
+            self.sent_total += n
+            # 送信できた分を先頭から外す
+            while n > 0:
+                head = wq[0]
+                if n >= len(head):
+                    n -= len(head)
+                    wq.popleft()
+                else:
+                    wq[0] = head[n:]
+                    n = 0
+
+        if self.closing and self.wq_bytes == 0:
+            self.close()
+            return True
+        if self.registry is not None:
+            self.registry.update(self)
+        return True
+
+    def close_after_flush(self) -> None:
+        """送信待ちを書き切ってから切断する"""
+        if self.wq_bytes == 0:
+            self.close()
+            return
+        self.closing = True
+        if self.registry is not None:
+            self.registry.update(self)
+
+
+
 class AcpSocket:
     """接続受付ソケットのクラス"""
 
@@ -149,6 +665,7 @@ class AcpSocket:
         self.port: int = 0
         self.listen_count: int = 0
         self.sock: Optional[socket.socket] = None
+        self.registry: Optional["SocketRegistry"] = None
         return
 
     def open(self, ip: str = "127.0.0.1", port: int = 50001, num: int = 64) -> bool:
@@ -195,7 +712,13 @@ class AcpSocket:
 
         return res
 
+    def events(self) -> int:
+        """監視すべき事象"""
+        return EVENT_READ
+
     def close(self) -> None:
+        if self.registry is not None:
+            self.registry.unregister(self)
         if self.sock is None:
             return
         
@@ -223,3 +746,94 @@ class SocketSelect:
         if srv is not None and srv.sock in rs:
             filterd_clts.append(srv)
         return filterd_clts
+
+
+class SocketRegistry:
+    """常駐型の受信待ち登録簿
+
+    selectors.DefaultSelector（Linux では epoll）にソケットを一度だけ登録し、
+    TelSocket/AcpSocket 自体を登録データとして保持する。
+    SocketSelect.select と異なり、待ち合わせのたびに一覧を作り直さない。
+    """
+
+    def __init__(self) -> None:
+        """コンストラクタ"""
+        self.sel = selectors.DefaultSelector()
+
+    def register(self, obj: Union[AcpSocket, TelSocket]) -> None:
+        """登録処理（接続受付・接続完了時に呼ぶ）
+
+        Args:
+            obj (AcpSocket | TelSocket): 登録対象
+        """
+        if obj.sock is None:
+            return
+        obj.registry = self
+        self.update(obj)
+
+    def update(self, obj: Union[AcpSocket, TelSocket]) -> None:
+        """監視する事象の更新（受信停止・送信待ちの有無を反映）
+
+        Args:
+            obj (AcpSocket | TelSocket): 登録対象
+        """
+        if obj.sock is None:
+            return
+        events = obj.events()
+        try:
+            key: Optional[selectors.SelectorKey] = self.sel.get_key(obj.sock)
+        except KeyError:
+            key = None
+        if events == 0:
+            if key is not None:
+                self.sel.unregister(obj.sock)
+        elif key is None:
+            self.sel.register(obj.sock, events, obj)
+        elif key.events != events:
+            self.sel.modify(obj.sock, events, obj)
+
+    def unregister(self, obj: Union[AcpSocket, TelSocket]) -> None:
+        """登録解除処理（切断時に close から呼ばれる）
+
+        Args:
+            obj (AcpSocket | TelSocket): 登録解除対象
+        """
+        obj.registry = None
+        if obj.sock is None:
+            return
+        try:
+            self.sel.unregister(obj.sock)
+        except (KeyError, ValueError):
+            pass
+
+    def select(self, timeout: float = 5) -> List[Union[AcpSocket, TelSocket]]:
+        """受信待ち
+
+        Args:
+            timeout (float): 待ち時間（秒）
+
+        Returns:
+            受信可能になった登録対象の一覧
+        """
+        events = self.sel.select(timeout)
+        return [key.data for key, _ in events]
+
+    def select_events(self, timeout: float = 5) -> List[Tuple[Union[AcpSocket, TelSocket], int]]:
+        """事象待ち
+
+        Args:
+            timeout (float): 待ち時間（秒）
+
+        Returns:
+            (登録対象, 発生した事象 EVENT_READ/EVENT_WRITE の論理和) の一覧
+        """
+        events = self.sel.select(timeout)
+        return [(key.data, mask) for key, mask in events]
+
+    def count(self) -> int:
+        """登録数"""
+        return len(self.sel.get_map())
+
+    def close(self) -> None:
+        """終了処理"""
+        self.sel.close()
@@ -0,0 +1,114 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import time
+
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from telegram.telegram_frame import FRAME_HELLO
+from telegram.telegram_frame import HELLO_UNIT
+from telegram.telegram_frame import HELLO_TIMEOUT
+from telegram.telegram_frame import PROTO_V2
+from telegram.telegram_frame import pack_v1
+from telegram.telegram_frame import encode_caps
+from telegram.telegram_frame import decode_caps
+from telegram.telegram_common import TelSocket
+
+
+class Handshake:
+    """非ブロッキングのバージョン交渉
+
+    TelSocket.hello_client / hello_server と同じ手順を、受信のたびに1段ずつ進める。
+    交渉中も中継処理の周回を止めないよう、ソケットは非ブロッキングにして
+    SocketRegistry に登録しておき、受信可能になったら on_readable、
+    周回ごとに expired を呼ぶ。done になったら agreed と pending を使う。
+    """
+
+    def __init__(self, sck: TelSocket, caps: Dict[str, str], server: bool, timeout: float = HELLO_TIMEOUT) -> None:
+        """コンストラクタ（接続する側は空の HELO を送る）
+
+        Args:
+            sck (TelSocket): 接続済みの制御ソケット（非ブロッキング）
+            caps (Dict[str, str]): 自側の機能一覧
+            server (bool): 接続を受け付けた側か
+            timeout (float): 相手の電文を待つ時間（秒、段ごと）
+        """
+        self.sck: TelSocket = sck
+        self.caps: Dict[str, str] = caps
+        self.server: bool = server
+        self.timeout: float = timeout
+        self.deadline: float = time.monotonic() + timeout
+        # 受け付けた側で自側の機能一覧を送ったか
+        self.offered: bool = False
+        self.done: bool = False
+        # 合意した機能一覧と交渉中に受信した通常電文
+        self.agreed: Dict[str, str] = {}
+        self.pending: Optional[Tuple[int, int, bytes]] = None
+        if not server:
+            sck.send_raw(pack_v1(HELLO_UNIT, 0))
+
+    def on_readable(self) -> bool:
+        """受信して交渉を進める（交渉後に続けて届いた電文は復号器に残す）
+
+        Returns:
+            True: 正常
+            False: 切断検知または復号できない電文（相手が中継装置でない）
+        """
+        if not self.sck.fill():
+            return False
+        while not self.done:
+            try:
+                frame = self.sck.next_frame()
+            except ValueError:
+                return False
+            if frame is None:
+                break
+            self.on_frame(frame)
+        return True
+
+    def on_frame(self, frame: Tuple[int, int, bytes]) -> None:
+        """相手の電文1つ分の処理"""
+        if frame[0] != FRAME_HELLO:
+            # 旧版の相手
+            self.finish({}, frame)
+            return
+
+        if self.server and not self.offered:
+            bt_caps = encode_caps(self.caps)
+            self.sck.send_raw(pack_v1(HELLO_UNIT, len(bt_caps)) + bt_caps)
+            self.offered = True
+            self.deadline = time.monotonic() + self.timeout
+            return
+
+        if self.server:
+            agreed = decode_caps(frame[2])
+        else:
+            offered = decode_caps(frame[2])
+            agreed = {k: v for k, v in self.caps.items() if k in offered}
+            bt_caps = encode_caps(agreed)
+            self.sck.send_raw(pack_v1(HELLO_UNIT, len(bt_caps)) + bt_caps)
+        if "v2" in agreed:
+            self.sck.set_proto(PROTO_V2)
+        self.finish(agreed, None)
+
+    def expired(self, now: float) -> bool:
+        """時間切れの確認（応答がなければ旧版の相手として v1 のまま終える）
+
+        Returns:
+            True: 今回の呼び出しで時間切れにより終えた
+        """
+        if self.done or now < self.deadline:
+            return False
+        self.finish({}, None)
+        return True
+
+    def finish(self, agreed: Dict[str, str], pending: Optional[Tuple[int, int, bytes]]) -> None:
+        """交渉の終了"""
+        self.agreed = agreed
+        self.pending = pending
+        self.done = True
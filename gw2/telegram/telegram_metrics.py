@@ -0,0 +1,245 @@
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import bisect
+import threading
+
+from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from telegram.telegram_common import TelSocket
+    from telegram.telegram_sched import FrameScheduler
+
+# 処理時間のヒストグラムの区切り（秒）
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+# 公開するパス
+METRICS_PATH = "/metrics"
+
+
+class Histogram:
+    """累積ヒストグラム（Prometheus の histogram と同じ形で出力する）"""
+
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS) -> None:
+        """コンストラクタ
+
+        Args:
+            buckets (List[float]): 区切りの値（昇順）
+        """
+        self.buckets: List[float] = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.total: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        """値の記録"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, out: List[str]) -> None:
+        """出力行の追加"""
+        acc = 0
+        for le, n in zip(self.buckets, self.counts):
+            acc += n
+            out.append('%s_bucket{le="%s"} %d' % (name, le, acc))
+        out.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        out.append("%s_sum %.6f" % (name, self.total))
+        out.append("%s_count %d" % (name, self.count))
+
+
+class ChanStats:
+    """チャネルごとの計数（up: ジョブソケット→制御ソケット, down: 制御ソケット→ジョブソケット）"""
+
+    __slots__ = ("bytes_up", "bytes_down", "frames_up", "frames_down")
+
+    def __init__(self) -> None:
+        self.bytes_up: int = 0
+        self.bytes_down: int = 0
+        self.frames_up: int = 0
+        self.frames_down: int = 0
+
+
+class Metrics:
+    """チャネル・制御ソケットの統計
+
+    計数は中継処理のスレッドだけが更新し、出力は HTTP のスレッドが読むだけにする。
+    ソケットの計数（送受信量・システムコール回数・送信待ち）は TelSocket が持つ値を
+    出力時に読み出す。
+    """
+
+    def __init__(self) -> None:
+        """コンストラクタ"""
+        self.chans: Dict[int, ChanStats] = {}
+        self.opened: int = 0
+        self.closed: int = 0
+        # 終了したチャネルも含む累計
+        self.bytes_up: int = 0
+        self.bytes_down: int = 0
+        self.frames_up: int = 0
+        self.frames_down: int = 0
+        # 受信1周回の処理時間、スケジューラでの待ち時間
+        self.loop: Histogram = Histogram()
+        self.sched_delay: Histogram = Histogram()
+        # 出力時に読み出す中継処理の状態（attach で設定）
+        self.links: List["TelSocket"] = []
+        self.scheds: List["FrameScheduler"] = []
+        self.job_soks: Dict[int, "TelSocket"] = {}
+
+    def attach(self, links: List["TelSocket"], scheds: List["FrameScheduler"], job_soks: Dict[int, "TelSocket"]) -> None:
+        """中継処理の状態の登録（同じオブジェクトを参照し続ける）"""
+        self.links = links
+        self.scheds = scheds
+        self.job_soks = job_soks
+        for sched in scheds:
+            sched.delays = self.sched_delay
+
+    def open(self, chan: int) -> None:
+        """チャネルの開始"""
+        self.chans[chan] = ChanStats()
+        self.opened += 1
+
+    def close(self, chan: int) -> None:
+        """チャネルの終了（開始していないチャネルは無視）"""
+        if self.chans.pop(chan, None) is not None:
+            self.closed += 1
+
+    def on_up(self, chan: int, size: int) -> None:
+        """ジョブソケットから受信したデータ"""
+        self.bytes_up += size
+        self.frames_up += 1
+        cs = self.chans.get(chan)
+        if cs is not None:
+            cs.bytes_up += size
+            cs.frames_up += 1
+
+    def on_down(self, chan: int, size: int) -> None:
+        """ジョブソケットへ送信したデータ"""
+        self.bytes_down += size
+        self.frames_down += 1
+        cs = self.chans.get(chan)
+        if cs is not None:
+            cs.bytes_down += size
+            cs.frames_down += 1
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式で出力"""
+        out: List[str] = []
+
+        def head(name: str, kind: str, text: str) -> None:
+            out.append("# HELP " + name + " " + text)
+            out.append("# TYPE " + name + " " + kind)
+
+        # 中継処理のスレッドが書き換える辞書は先に複写する
+        chans = list(self.chans.items())
+        job_soks = dict(self.job_soks)
+        links = list(self.links)
+        scheds = list(self.scheds)
+
+        head("gw_chans_opened_total", "counter", "開始したチャネル数")
+        out.append("gw_chans_opened_total %d" % self.opened)
+        head("gw_chans_closed_total", "counter", "終了したチャネル数")
+        out.append("gw_chans_closed_total %d" % self.closed)
+        head("gw_chans_active", "gauge", "中継中のチャネル数")
+        out.append("gw_chans_active %d" % len(chans))
+
+        head("gw_bytes_total", "counter", "全チャネルの中継量（終了したチャネルを含む）")
+        out.append('gw_bytes_total{dir="up"} %d' % self.bytes_up)
+        out.append('gw_bytes_total{dir="down"} %d' % self.bytes_down)
+        head("gw_frames_total", "counter", "全チャネルの中継回数（終了したチャネルを含む）")
+        out.append('gw_frames_total{dir="up"} %d' % self.frames_up)
+        out.append('gw_frames_total{dir="down"} %d' % self.frames_down)
+
+        head("gw_chan_bytes_total", "counter", "チャネルごとの中継量")
+        for chan, cs in chans:
+            out.append('gw_chan_bytes_total{chan="%d",dir="up"} %d' % (chan, cs.bytes_up))
+            out.append('gw_chan_bytes_total{chan="%d",dir="down"} %d' % (chan, cs.bytes_down))
+        head("gw_chan_frames_total", "counter", "チャネルごとの中継回数")
+        for chan, cs in chans:
+            out.append('gw_chan_frames_total{chan="%d",dir="up"} %d' % (chan, cs.frames_up))
+            out.append('gw_chan_frames_total{chan="%d",dir="down"} %d' % (chan, cs.frames_down))
+        head("gw_chan_queue_bytes", "gauge", "チャネルごとの送信待ち（dir=up: スケジューラ, dir=down: ジョブソケット）")
+        for chan, _ in chans:
+            sched_pending = scheds[chan % len(scheds)].pending(chan) if len(scheds) > 0 else 0
+            job_sock = job_soks.get(chan)
+            out.append('gw_chan_queue_bytes{chan="%d",dir="up"} %d' % (chan, sched_pending))
+            out.append('gw_chan_queue_bytes{chan="%d",dir="down"} %d' % (chan, job_sock.wq_bytes if job_sock is not None else 0))
+        head("gw_chan_syscalls_total", "counter", "チャネルごとのジョブソケットのシステムコール回数")
+        for chan, _ in chans:
+            job_sock = job_soks.get(chan)
+            if job_sock is None:
+                continue
+            out.append('gw_chan_syscalls_total{chan="%d",op="recv"} %d' % (chan, job_sock.stat_recv_calls))
+            out.append('gw_chan_syscalls_total{chan="%d",op="send"} %d' % (chan, job_sock.stat_send_calls))
+
+        head("gw_link_bytes_total", "counter", "制御ソケットごとの送受信量")
+        for idx, link in enumerate(links):
+            out.append('gw_link_bytes_total{link="%d",dir="recv"} %d' % (idx, link.stat_recv_bytes))
+            out.append('gw_link_bytes_total{link="%d",dir="send"} %d' % (idx, link.sent_total))
+        head("gw_link_frames_total", "counter", "制御ソケットごとの送受信電文数")
+        for idx, link in enumerate(links):
+            out.append('gw_link_frames_total{link="%d",dir="recv"} %d' % (idx, link.decoder.count))
+            out.append('gw_link_frames_total{link="%d",dir="send"} %d' % (idx, link.stat_frames_sent))
+        head("gw_link_syscalls_total", "counter", "制御ソケットごとのシステムコール回数")
+        for idx, link in enumerate(links):
+            out.append('gw_link_syscalls_total{link="%d",op="recv"} %d' % (idx, link.stat_recv_calls))
+            out.append('gw_link_syscalls_total{link="%d",op="send"} %d' % (idx, link.stat_send_calls))
+        head("gw_link_queue_bytes", "gauge", "制御ソケットごとの送信待ち（where=socket: 送信待ち, where=sched: スケジューラ）")
+        for idx, link in enumerate(links):
+            backlog = sum(scheds[idx].backlog.values()) if idx < len(scheds) else 0
+            out.append('gw_link_queue_bytes{link="%d",where="socket"} %d' % (idx, link.wq_bytes))
+            out.append('gw_link_queue_bytes{link="%d",where="sched"} %d' % (idx, backlog))
+
+        head("gw_loop_seconds", "histogram", "受信1周回の処理時間")
+        self.loop.render("gw_loop_seconds", out)
+        head("gw_sched_delay_seconds", "histogram", "電文がスケジューラで待った時間")
+        self.sched_delay.render("gw_sched_delay_seconds", out)
+
+        return "\n".join(out) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """METRICS_PATH への GET に統計を返す"""
+
+    metrics: Optional[Metrics] = None
+
+    def do_GET(self) -> None:
+        if self.path != METRICS_PATH or self.metrics is None:
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        # 要求ごとの標準エラー出力はしない
+        return
+
+
+def start_metrics_server(metrics: Metrics, port: int, ip: str = "127.0.0.1") -> HTTPServer:
+    """統計の HTTP 公開を別スレッドで開始
+
+    Args:
+        metrics (Metrics): 公開する統計
+        port (int): 接続受付ポート番号
+        ip (str): 接続受付IPアドレス（既定はループバックのみ）
+
+    Returns:
+        HTTPServer: 公開用のサーバ
+    """
+    handler = type("Handler", (MetricsHandler,), {"metrics": metrics})
+    srv = HTTPServer((ip, port), handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
@@ -0,0 +1,72 @@
+import os
+import random
+import tempfile
+import unittest
+import importlib.util
+
+from types import ModuleType
+from typing import List
+from typing import Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 小さいリングで何度も折り返させる
+RING_SIZE = 4096
+
+
+def load_capture(tree: str) -> ModuleType:
+    """gw1/gw2 の telegram_capture を読み込む（両方に同じものを置いている）"""
+    path = os.path.join(ROOT, tree, "telegram", "telegram_capture.py")
+    spec = importlib.util.spec_from_file_location("telegram_capture_" + tree, path)
+    assert spec is not None and spec.loader is not None
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+class TestFrameCaptureRing(unittest.TestCase):
+    """FrameCapture のリングの折り返し・上書き"""
+
+    def run_ring(self, tree: str, seed: int, snap: int) -> None:
+        cap_mod = load_capture(tree)
+        rnd = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cap")
+            cap = cap_mod.FrameCapture(path, RING_SIZE, snap)
+            written: List[Tuple[int, bytes]] = []
+            for i in range(3000):
+                # リングの半分を超えるものも混ぜる
+                data = bytes([i % 256]) * rnd.choice([0, 1, 7, 100, 1500, 2100, 5000, rnd.randint(0, 4096)])
+                cap.record(cap_mod.DIR_SEND, 1, i, data)
+                written.append((i, data))
+                self.assertGreaterEqual(cap.count, 1)
+                self.assertLessEqual(cap.rpos, cap.wpos)
+                self.assertLessEqual(cap.wpos - cap.rpos, cap.size)
+            count = cap.count
+            cap.close()
+
+            recs = list(cap_mod.read_capture(path))
+            self.assertEqual(len(recs), count)
+            # 残っているのは最後に書いた分が順に並んだもの
+            for rec, (chan, data) in zip(recs, written[-count:]):
+                self.assertEqual(rec.chan, chan)
+                self.assertEqual(rec.length, len(data))
+                self.assertEqual(rec.data, data[:len(rec.data)])
+            self.assertEqual(recs[-1].chan, written[-1][0])
+
+    def test_wrap_many_times(self) -> None:
+        for tree in ("gw1", "gw2"):
+            for seed in range(5):
+                for snap in (-1, 0, 64):
+                    with self.subTest(tree=tree, seed=seed, snap=snap):
+                        self.run_ring(tree, seed, snap)
+
+    def test_too_small(self) -> None:
+        cap_mod = load_capture("gw1")
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                cap_mod.FrameCapture(os.path.join(tmp, "cap"), 32)
+
+
+if __name__ == "__main__":
+    unittest.main()